@@ -0,0 +1,76 @@
+"""create app tables
+
+The init revision created a `patient` table that the app never used.
+This revision creates the tables as they are in src/models.py, without the hot path indexes.
+
+Databases created by `create_tables()` before migrations existed already have these tables:
+mark them with `alembic stamp 5c0f3e8a9b21` and upgrade from there.
+
+Revision ID: 5c0f3e8a9b21
+Revises: 261ea2959558
+Create Date: 2026-10-18 10:12:41.204512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0f3e8a9b21'
+down_revision = '261ea2959558'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.drop_table('patient')
+
+    op.create_table(
+        'patients',
+        sa.Column('internal_id', sa.Integer, primary_key=True),
+        sa.Column('id', sa.Integer, nullable=False),
+        sa.Column('age', sa.Integer, nullable=False),
+    )
+    op.create_index('ix_patients_internal_id', 'patients', ['internal_id'])
+
+    op.create_table(
+        'admissions',
+        sa.Column('internal_id', sa.Integer, primary_key=True),
+        sa.Column('patient_id', sa.Integer, nullable=False),
+        sa.Column('date_admission', sa.DateTime, nullable=False),
+        sa.Column('date_discharge', sa.DateTime, nullable=True),
+    )
+    op.create_index('ix_admissions_internal_id', 'admissions', ['internal_id'])
+
+    op.create_table(
+        'readmission_predictions',
+        sa.Column('internal_id', sa.Integer, primary_key=True),
+        sa.Column('patient_id', sa.Integer, nullable=False),
+        sa.Column('time_created', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('probability', sa.Float, nullable=False),
+    )
+    op.create_index('ix_readmission_predictions_internal_id', 'readmission_predictions', ['internal_id'])
+
+    op.create_table(
+        'measurements',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('patient_id', sa.Integer, nullable=False),
+        sa.Column('time_created', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column('type', sa.String, nullable=False),
+        sa.Column('value', sa.Float, nullable=False),
+    )
+    op.create_index('ix_measurements_id', 'measurements', ['id'])
+
+
+def downgrade() -> None:
+    op.drop_table('measurements')
+    op.drop_table('readmission_predictions')
+    op.drop_table('admissions')
+    op.drop_table('patients')
+
+    op.create_table(
+        'patient',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('external_id', sa.Integer, nullable=False),
+        sa.Column('age', sa.Integer, nullable=False),
+    )
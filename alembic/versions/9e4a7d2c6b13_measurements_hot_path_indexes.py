@@ -0,0 +1,37 @@
+"""measurements hot path indexes
+
+Every measurement write looks the patient up by `patients.id`, and every read of measurements and predictions
+filters by patient(and type) and orders by `time_created`.
+
+Revision ID: 9e4a7d2c6b13
+Revises: 5c0f3e8a9b21
+Create Date: 2026-10-18 10:31:07.918230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a7d2c6b13'
+down_revision = '5c0f3e8a9b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_patients_id', 'patients', ['id'], unique=True)
+    op.create_index('ix_admissions_patient_id', 'admissions', ['patient_id'])
+    op.create_index('ix_readmission_predictions_patient_id_time_created', 'readmission_predictions',
+                    ['patient_id', 'time_created'])
+    op.create_index('ix_measurements_patient_id_type_time_created', 'measurements',
+                    ['patient_id', 'type', 'time_created'])
+    op.create_index('ix_measurements_patient_id_time_created', 'measurements', ['patient_id', 'time_created'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_measurements_patient_id_time_created', table_name='measurements')
+    op.drop_index('ix_measurements_patient_id_type_time_created', table_name='measurements')
+    op.drop_index('ix_readmission_predictions_patient_id_time_created', table_name='readmission_predictions')
+    op.drop_index('ix_admissions_patient_id', table_name='admissions')
+    op.drop_index('ix_patients_id', table_name='patients')
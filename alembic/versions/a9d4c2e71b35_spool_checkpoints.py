@@ -0,0 +1,30 @@
+"""spool checkpoints
+
+The last item of every write-behind spool that is written to the database.
+
+Revision ID: a9d4c2e71b35
+Revises: f3c8d1e6a902
+Create Date: 2026-10-18 19:42:10.318274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4c2e71b35'
+down_revision = 'f3c8d1e6a902'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('spool_checkpoints',
+                    sa.Column('spool_id', sa.String(), nullable=False),
+                    sa.Column('last_item_id', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('spool_id')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('spool_checkpoints')
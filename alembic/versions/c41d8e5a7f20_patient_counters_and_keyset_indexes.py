@@ -0,0 +1,55 @@
+"""patient counters and keyset indexes
+
+`patient_counters` keeps totals of the history endpoints, it's backfilled from the existing rows.
+The history indexes get the id as the last column, so keyset pagination by (time_created, id) is an index range
+scan on every database, SQLite already has the rowid in its indexes.
+
+Revision ID: c41d8e5a7f20
+Revises: 9e4a7d2c6b13
+Create Date: 2026-10-18 14:52:41.301877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d8e5a7f20'
+down_revision = '9e4a7d2c6b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('patient_counters',
+                    sa.Column('patient_id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(), nullable=False),
+                    sa.Column('value', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('patient_id', 'name')
+                    )
+    op.execute("INSERT INTO patient_counters (patient_id, name, value) "
+               "SELECT patient_id, type, COUNT(*) FROM measurements GROUP BY patient_id, type")
+    op.execute("INSERT INTO patient_counters (patient_id, name, value) "
+               "SELECT patient_id, 'readmission_predictions', COUNT(*) FROM readmission_predictions "
+               "GROUP BY patient_id")
+
+    op.drop_index('ix_measurements_patient_id_time_created', table_name='measurements')
+    op.drop_index('ix_measurements_patient_id_type_time_created', table_name='measurements')
+    op.drop_index('ix_readmission_predictions_patient_id_time_created', table_name='readmission_predictions')
+    op.create_index('ix_readmission_predictions_patient_id_time_created', 'readmission_predictions',
+                    ['patient_id', 'time_created', 'internal_id'])
+    op.create_index('ix_measurements_patient_id_type_time_created', 'measurements',
+                    ['patient_id', 'type', 'time_created', 'id'])
+    op.create_index('ix_measurements_patient_id_time_created', 'measurements', ['patient_id', 'time_created', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_measurements_patient_id_time_created', table_name='measurements')
+    op.drop_index('ix_measurements_patient_id_type_time_created', table_name='measurements')
+    op.drop_index('ix_readmission_predictions_patient_id_time_created', table_name='readmission_predictions')
+    op.create_index('ix_readmission_predictions_patient_id_time_created', 'readmission_predictions',
+                    ['patient_id', 'time_created'])
+    op.create_index('ix_measurements_patient_id_type_time_created', 'measurements',
+                    ['patient_id', 'type', 'time_created'])
+    op.create_index('ix_measurements_patient_id_time_created', 'measurements', ['patient_id', 'time_created'])
+    op.drop_table('patient_counters')
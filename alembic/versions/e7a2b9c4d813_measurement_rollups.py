@@ -0,0 +1,38 @@
+"""measurement rollups
+
+Hourly aggregates per patient and type of raw measurements compacted by the retention job.
+
+Revision ID: e7a2b9c4d813
+Revises: c41d8e5a7f20
+Create Date: 2026-10-18 16:20:05.482614
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2b9c4d813'
+down_revision = 'c41d8e5a7f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('measurement_rollups',
+                    sa.Column('patient_id', sa.Integer(), nullable=False),
+                    sa.Column('type', sa.String(), nullable=False),
+                    sa.Column('hour', sa.DateTime(timezone=True), nullable=False),
+                    sa.Column('count', sa.Integer(), nullable=False),
+                    sa.Column('mean', sa.Float(), nullable=False),
+                    sa.Column('min', sa.Float(), nullable=False),
+                    sa.Column('max', sa.Float(), nullable=False),
+                    sa.Column('m2', sa.Float(), nullable=False),
+                    sa.Column('last_value', sa.Float(), nullable=False),
+                    sa.Column('last_time_created', sa.DateTime(timezone=True), nullable=False),
+                    sa.PrimaryKeyConstraint('patient_id', 'type', 'hour')
+                    )
+
+
+def downgrade() -> None:
+    op.drop_table('measurement_rollups')
@@ -0,0 +1,35 @@
+"""current risk
+
+The latest prediction of every patient, backfilled from the history.
+
+Revision ID: f3c8d1e6a902
+Revises: e7a2b9c4d813
+Create Date: 2026-10-18 18:07:52.119043
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c8d1e6a902'
+down_revision = 'e7a2b9c4d813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('current_risk',
+                    sa.Column('patient_id', sa.Integer(), nullable=False),
+                    sa.Column('time_created', sa.DateTime(timezone=True), nullable=False),
+                    sa.Column('probability', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('patient_id')
+                    )
+    op.execute("INSERT INTO current_risk (patient_id, time_created, probability) "
+               "SELECT p.patient_id, p.time_created, p.probability FROM readmission_predictions p "
+               "WHERE p.internal_id = (SELECT last.internal_id FROM readmission_predictions last "
+               "WHERE last.patient_id = p.patient_id ORDER BY last.time_created DESC, last.internal_id DESC LIMIT 1)")
+
+
+def downgrade() -> None:
+    op.drop_table('current_risk')
@@ -0,0 +1,92 @@
+"""
+Latency and throughput of the sync /v1/measurements against the async /v2/measurements,
+with a growing number of concurrent clients. Start the service first, e.g.
+
+    uvicorn src.main:app --port 8000 --workers 1 --log-level warning
+    python -m benchmarks.async_ingestion --url http://localhost:8000 --requests 2000 --concurrency 1 16 64 256
+
+Every client sends its next measurement as soon as the previous one is answered. Patients are created
+with ids from --first-patient-id, so the benchmark can run against a database with real data.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+PATHS = {"sync": "/v1/measurements", "async": "/v2/measurements"}
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+async def create_patients(client: httpx.AsyncClient, first_patient_id: int, patients: int):
+    for patient_id in range(first_patient_id, first_patient_id + patients):
+        resp = await client.post("/v1/patients/", json={"id": patient_id, "age": 20 + patient_id % 70})
+        if resp.status_code not in (201, 409):
+            raise RuntimeError(f"Can't create patient {patient_id}: {resp.status_code} {resp.text}")
+
+
+async def run(client: httpx.AsyncClient, path: str, requests: int, concurrency: int, first_patient_id: int,
+              patients: int) -> dict:
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async def send():
+        nonlocal errors, sent
+        while sent < requests:
+            sent += 1
+            patient_id = first_patient_id + random.randrange(patients)
+            m = {"patient_id": patient_id, "day": "2021-01-01", "hour": sent % 24,
+                 "parameter": random.choice(TYPES), "value": random.uniform(10, 140)}
+            start = time.perf_counter()
+            try:
+                resp = await client.post(path, json=m)
+                if resp.status_code != 201:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "rps": len(latencies) / elapsed,
+        "errors": errors,
+    }
+
+
+async def main_async(args):
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        await create_patients(client, args.first_patient_id, args.patients)
+        print(f"{'path':<6} {'clients':>7} {'p50':>9} {'p99':>9} {'rps':>8} {'errors':>6}")
+        best = {}
+        for name, path in PATHS.items():
+            for concurrency in args.concurrency:
+                r = await run(client, path, args.requests, concurrency, args.first_patient_id, args.patients)
+                best[name] = max(best.get(name, 0), r["rps"])
+                print(f"{name:<6} {concurrency:>7} {r['p50']:>7.1f}ms {r['p99']:>7.1f}ms {r['rps']:>8.0f} "
+                      f"{r['errors']:>6}")
+        print(", ".join(f"max {name} {rps:.0f} rps" for name, rps in best.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per path and concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16, 64, 256])
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--first-patient-id", type=int, default=1_000_000)
+    args = parser.parse_args()
+    random.seed(42)
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Baseline files of the benchmarks for regression comparison.
+
+A baseline is a JSON file {"results": {benchmark: {metric: value}}, "machine": ...}, saved by --save-baseline.
+A later run with --baseline compares its results to it and fails if a metric got worse by more than --tolerance.
+Baselines only make sense on the machine(and with the configuration) they were recorded on.
+"""
+import json
+import platform
+import sys
+from typing import Dict, Iterable, List
+
+Results = Dict[str, Dict[str, float]]
+
+
+def machine() -> dict:
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor()}
+
+
+def save(path: str, results: Results):
+    with open(path, "w") as f:
+        json.dump({"machine": machine(), "results": results}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load(path: str) -> Results:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def regressions(baseline: Results, results: Results, tolerance: float,
+                higher_is_better: Iterable[str] = ()) -> List[str]:
+    """
+    Metrics that are worse than the baseline by more than tolerance(0.2 is 20%). Benchmarks or metrics
+    missing on either side are skipped.
+    """
+    higher_is_better = set(higher_is_better)
+    found = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            expected = baseline.get(name, {}).get(metric)
+            if not expected:
+                continue
+            change = value / expected - 1
+            worse = -change if metric in higher_is_better else change
+            if worse > tolerance:
+                found.append(f"{name} {metric}: {expected:.4g} -> {value:.4g} ({change:+.0%})")
+    return found
+
+
+def add_arguments(parser, default_tolerance: float = 0.2):
+    parser.add_argument("--baseline", help="Compare with the baseline file and exit with 1 on a regression")
+    parser.add_argument("--save-baseline", help="Save the results as a baseline file")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance,
+                        help="Allowed relative regression against the baseline")
+
+
+def finish(args, results: Results, higher_is_better: Iterable[str] = ()):
+    """
+    Saves or compares the results as asked by the arguments of add_arguments
+    """
+    if args.save_baseline:
+        save(args.save_baseline, results)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        found = regressions(load(args.baseline), results, args.tolerance, higher_is_better)
+        if found:
+            print(f"Regressions against {args.baseline}:")
+            print("\n".join(f"  {r}" for r in found))
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}(tolerance {args.tolerance:.0%})")
@@ -0,0 +1,84 @@
+"""
+Scoring a cohort with the scalar prediction_math loop against the vectorized prediction_math_batch.
+
+    python -m benchmarks.batch_scoring --patients 100000 --measurements-per-patient 20
+
+Both score every patient after all of their measurements and must give the same probabilities.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.measurements import prediction_math, prediction_math_batch
+
+TYPES = np.array(["blood_pressure", "temperature", "respiration_rate", "heart_rate"])
+
+
+def generate(patients: int, per_patient: int, seed: int = 42) -> dict:
+    rng = np.random.default_rng(seed)
+    n = patients * per_patient
+    return {
+        "ages": rng.integers(18, 100, patients),
+        "groups": np.repeat(np.arange(patients), per_patient),
+        "types": TYPES[rng.integers(0, len(TYPES), n)],
+        "values": rng.uniform(30, 140, n),
+        "times": rng.integers(0, 10 ** 6, n),
+    }
+
+
+def score_scalar(data: dict) -> list:
+    by_patient = [{"blood_pressure": [], "temperature": [], "respiration_rate": []} for _ in data["ages"]]
+    for patient, t, value, created in zip(data["groups"].tolist(), data["types"].tolist(), data["values"].tolist(),
+                                          data["times"].tolist()):
+        if t in by_patient[patient]:
+            by_patient[patient][t].append((created, value))
+
+    probabilities = []
+    for age, m in zip(data["ages"].tolist(), by_patient):
+        blood_pressure = max(m["blood_pressure"], key=lambda p: p[0])[1] if m["blood_pressure"] else 0
+        probabilities.append(prediction_math.calculate_probability_v1(
+            age=age,
+            last_blood_pressure=blood_pressure,
+            mean_respiratory_rate=prediction_math.calculate_mean([v for _, v in m["respiration_rate"]]),
+            standard_deviation_temperature=prediction_math.calculate_standard_deviation(
+                [v for _, v in m["temperature"]]),
+        ))
+    return probabilities
+
+
+def score_batch(data: dict) -> np.ndarray:
+    return prediction_math_batch.score_measurements(data["ages"], data["groups"], data["types"], data["values"],
+                                                    data["times"])
+
+
+def best_of(repeat: int, f, *args) -> (float, object):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100_000)
+    parser.add_argument("--measurements-per-patient", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = generate(args.patients, args.measurements_per_patient)
+    (scalar_seconds, scalar) = best_of(args.repeat, score_scalar, data)
+    (batch_seconds, batch) = best_of(args.repeat, score_batch, data)
+
+    measurements = args.patients * args.measurements_per_patient
+    print(f"{'':<7} {'seconds':>8} {'patients/s':>12} {'measurements/s':>15}")
+    for name, seconds in (("scalar", scalar_seconds), ("numpy", batch_seconds)):
+        print(f"{name:<7} {seconds:>8.3f} {args.patients / seconds:>12.0f} {measurements / seconds:>15.0f}")
+    print(f"speedup {scalar_seconds / batch_seconds:.1f}x, "
+          f"max difference {np.max(np.abs(np.array(scalar) - batch)):.1e}")
+
+
+if __name__ == "__main__":
+    main()
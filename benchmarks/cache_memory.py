@@ -0,0 +1,104 @@
+"""
+Memory per patient of the fast model state: legacy pickled keys vs the numeric state hash.
+
+    python -m benchmarks.cache_memory --patients 1000
+    REDIS_URL=redis://localhost:6379/15 python -m benchmarks.cache_memory
+
+With a real Redis the numbers come from MEMORY USAGE. fakeredis doesn't support it,
+so without REDIS_URL the size of keys and values on the wire is reported instead.
+"""
+import argparse
+import datetime
+import os
+import pickle
+import time
+
+import redis
+
+from src import models
+from src.measurements.cache import FastReadmissionRedisCache
+from src.measurements.prediction_model_fast import FastReadmissionState, LAST_BLOOD_PRESSURE, \
+    MEAN_RESPIRATORY_RATE, STANDARD_DEVIATION_TEMPERATURE
+
+
+def new_client() -> redis.Redis:
+    url = os.getenv("REDIS_URL")
+    if url:
+        return redis.Redis.from_url(url)
+    import fakeredis
+    return fakeredis.FakeRedis()
+
+
+def save_legacy_state(client: redis.Redis, patient_id: int, state: FastReadmissionState):
+    (bp_key, rr_key, t_key) = FastReadmissionRedisCache.legacy_keys(patient_id)
+    client.set(bp_key, pickle.dumps(state.last_blood_pressure))
+    client.set(rr_key, pickle.dumps({'mean': state.respiratory_rate_mean, 'count': state.respiratory_rate_count}))
+    client.set(t_key, pickle.dumps({'mean': state.temperature_mean, 'variance': state.temperature_variance,
+                                    'count': state.temperature_count}))
+
+
+def memory_usage(client: redis.Redis, key: str) -> int:
+    try:
+        return client.memory_usage(key)
+    except redis.ResponseError:
+        if client.type(key) == b'hash':
+            return len(key) + sum(len(k) + len(v) for k, v in client.hgetall(key).items())
+        return len(key) + len(client.get(key))
+
+
+def new_state(patient_id: int) -> FastReadmissionState:
+    state = FastReadmissionState(
+        last_blood_pressure=models.Measurement(id=patient_id * 100, patient_id=patient_id, type="blood_pressure",
+                                               value=120.0 + patient_id % 40,
+                                               time_created=datetime.datetime(2021, 1, 1, patient_id % 24)),
+        respiratory_rate_mean=14.0 + patient_id % 7 / 3, respiratory_rate_count=200 + patient_id,
+        temperature_mean=36.6 + patient_id % 10 / 7, temperature_variance=12.5 + patient_id / 11,
+        temperature_count=300 + patient_id,
+    )
+    state.changed = {LAST_BLOOD_PRESSURE, MEAN_RESPIRATORY_RATE, STANDARD_DEVIATION_TEMPERATURE}
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=1000)
+    args = parser.parse_args()
+
+    client = new_client()
+    client.flushdb()
+    cache = FastReadmissionRedisCache(redis_client=client)
+    patient_ids = range(1, args.patients + 1)
+
+    for patient_id in patient_ids:
+        save_legacy_state(client, patient_id, new_state(patient_id))
+    legacy = sum(memory_usage(client, key) for p in patient_ids for key in cache.legacy_keys(p))
+    legacy_raw = {p: client.mget(cache.legacy_keys(p)) for p in patient_ids}
+
+    start = time.perf_counter()
+    for patient_id in patient_ids:
+        cache.migrate_legacy_state(patient_id)
+    migration = time.perf_counter() - start
+    compact = sum(memory_usage(client, cache.key(p)) for p in patient_ids)
+    compact_raw = {p: client.hgetall(cache.key(p)) for p in patient_ids}
+
+    # Decoding of what a request reads from Redis
+    start = time.perf_counter()
+    for values in legacy_raw.values():
+        [pickle.loads(v) for v in values]
+    legacy_decode = time.perf_counter() - start
+    start = time.perf_counter()
+    for patient_id, read in compact_raw.items():
+        cache.new_state(patient_id, read)
+    compact_decode = time.perf_counter() - start
+
+    client.flushdb()
+    print(f"patients:                   {args.patients}")
+    print(f"legacy pickled keys:        {legacy / args.patients:.0f} bytes per patient")
+    print(f"state hash:                 {compact / args.patients:.0f} bytes per patient")
+    print(f"migration:                  {migration / args.patients * 1e6:.1f} us per patient")
+    print(f"state decode:               pickle {legacy_decode / args.patients * 1e6:.1f} us, "
+          f"hash {compact_decode / args.patients * 1e6:.1f} us per patient")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Load test of /v0/measurements(slow model) against /v1/measurements(fast model) at a fixed request rate.
+Start the service first, e.g.
+
+    uvicorn src.main:app --port 8000 --workers 1 --log-level warning
+    python -m benchmarks.load_test --url http://localhost:8000 --rps 50 200 --duration 20 --patients 100
+    python -m benchmarks.load_test --rps 50 200 --save-baseline benchmarks/baselines/load_test.json
+
+Requests are sent on a schedule(open loop), not after the previous answer, and latency is counted from the
+scheduled time. So a service that falls behind shows it in the percentiles instead of slowing the load down.
+Every path has its own patients, and --history measurements of every patient are sent before the measured runs,
+unmeasured, because the cost of v0 grows with the history. Measurements of earlier runs against the same database
+add to it.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+from benchmarks import baseline
+from benchmarks.async_ingestion import create_patients
+
+PATHS = {"v0": "/v0/measurements", "v1": "/v1/measurements"}
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+def measurement(patient_id: int, i: int) -> dict:
+    return {"patient_id": patient_id, "day": "2021-01-01", "hour": i % 24, "parameter": random.choice(TYPES),
+            "value": random.uniform(10, 140)}
+
+
+def percentile(latencies: list, p: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+
+async def fill_history(client: httpx.AsyncClient, path: str, first_patient_id: int, patients: int, history: int):
+    for i in range(history):
+        await asyncio.gather(*(client.post(path, json=measurement(patient_id, i))
+                               for patient_id in range(first_patient_id, first_patient_id + patients)))
+
+
+async def run(client: httpx.AsyncClient, path: str, rps: float, duration: float, first_patient_id: int,
+              patients: int) -> dict:
+    latencies = []
+    errors = 0
+
+    async def send(i: int, scheduled: float):
+        nonlocal errors
+        try:
+            resp = await client.post(path, json=measurement(first_patient_id + random.randrange(patients), i))
+            if resp.status_code not in (201, 202):
+                errors += 1
+        except httpx.HTTPError:
+            errors += 1
+        latencies.append(time.perf_counter() - scheduled)
+
+    tasks = []
+    start = time.perf_counter()
+    for i in range(int(rps * duration)):
+        scheduled = start + i / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(i, scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p90_ms": percentile(latencies, 0.9) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+        "errors": errors,
+    }
+
+
+async def main_async(args) -> baseline.Results:
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    results = {}
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        print(f"{'path':<5} {'target':>7} {'rps':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9} {'errors':>6}")
+        for offset, name in enumerate(args.paths):
+            # Every path gets its own patients, so v1 doesn't run on the history v0 left behind
+            first_patient_id = args.first_patient_id + offset * args.patients
+            await create_patients(client, first_patient_id, args.patients)
+            await fill_history(client, PATHS[name], first_patient_id, args.patients, args.history)
+            for rps in args.rps:
+                r = await run(client, PATHS[name], rps, args.duration, first_patient_id, args.patients)
+                results[f"{name}.rps_{rps:g}"] = r
+                print(f"{name:<5} {rps:>7g} {r['rps']:>8.1f} {r['p50_ms']:>7.1f}ms {r['p90_ms']:>7.1f}ms "
+                      f"{r['p99_ms']:>7.1f}ms {r['max_ms']:>7.1f}ms {r['errors']:>6}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--paths", nargs="+", choices=list(PATHS), default=list(PATHS))
+    parser.add_argument("--rps", type=float, nargs="+", default=[50, 200], help="Target request rates")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per path and request rate")
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--history", type=int, default=10, help="Measurements per patient before the run")
+    parser.add_argument("--first-patient-id", type=int, default=2_000_000)
+    parser.add_argument("--max-connections", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=42)
+    baseline.add_arguments(parser, default_tolerance=0.3)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    results = asyncio.run(main_async(args))
+    baseline.finish(args, results, higher_is_better=["rps"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Latency of the measurement hot path queries with and without the indexes of the
+9e4a7d2c6b13 migration, on a SQLite database with many measurement rows.
+
+    python -m benchmarks.measurement_indexes --rows 10000000 --patients 10000
+
+Rows are generated straight with sqlite3 executemany, the queries go through the app repositories.
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src import models
+from src.config.database import Base
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.patient.repository import PatientSQLiteRepository
+from src.schemas import MeasurementType
+
+HOT_PATH_INDEXES = [
+    "ix_patients_id",
+    "ix_measurements_patient_id_type_time_created",
+    "ix_measurements_patient_id_time_created",
+    "ix_readmission_predictions_patient_id_time_created",
+]
+
+
+def fill(path: str, rows: int, patients: int):
+    types = [t.value for t in MeasurementType]
+    start = datetime.datetime(2021, 1, 1)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO patients (id, age) VALUES (?, ?)", ((p, 20 + p % 70) for p in range(patients)))
+
+    def measurements():
+        for i in range(rows):
+            # Every patient gets a measurement per minute, round robin
+            yield (i % patients, (start + datetime.timedelta(minutes=i // patients)).isoformat(" "),
+                   types[(i // patients) % len(types)], 36.0 + i % 100 / 10)
+
+    conn.executemany("INSERT INTO measurements (patient_id, time_created, type, value) VALUES (?, ?, ?, ?)",
+                     measurements())
+    conn.executemany("INSERT INTO readmission_predictions (patient_id, time_created, probability) VALUES (?, ?, ?)",
+                     ((p, start.isoformat(" "), 0.01) for p in range(patients) for _ in range(10)))
+    conn.commit()
+    conn.close()
+
+
+def measure(db, patients: int, repeat: int) -> dict:
+    patient_repo = PatientSQLiteRepository(db)
+    measurement_repo = MeasurementSQLiteRepository(db)
+    queries = {
+        "patient by id": lambda p: patient_repo.get_by_id(p),
+        "last blood pressure": lambda p: measurement_repo.get_last_measurement(p, "blood_pressure"),
+        "page of temperatures": lambda p: measurement_repo.get_all_measurements(p, "temperature", 0, 100),
+        "page of predictions": lambda p: measurement_repo.get_all_predictions(p, 0, 100),
+        "aggregates": lambda p: measurement_repo.get_measurement_aggregates([p]),
+    }
+    random.seed(42)
+    patient_ids = [random.randrange(patients) for _ in range(repeat)]
+    results = {}
+    for name, query in queries.items():
+        timings = []
+        for p in patient_ids:
+            start = time.perf_counter()
+            query(p)
+            timings.append(time.perf_counter() - start)
+        results[name] = (statistics.median(timings), max(timings))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--patients", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "benchmark.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            for index in HOT_PATH_INDEXES:
+                conn.exec_driver_sql(f"DROP INDEX {index}")
+
+        start = time.perf_counter()
+        fill(path, args.rows, args.patients)
+        print(f"inserted {args.rows} measurements of {args.patients} patients in {time.perf_counter() - start:.1f}s")
+
+        db = sessionmaker(bind=engine)()
+        without_indexes = measure(db, args.patients, args.repeat)
+
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    if index.name in HOT_PATH_INDEXES:
+                        index.create(conn)
+        print(f"created indexes in {time.perf_counter() - start:.1f}s")
+        db.close()
+        db = sessionmaker(bind=engine)()
+        with_indexes = measure(db, args.patients, args.repeat)
+        db.close()
+
+    print(f"{'query':<22}{'no indexes p50':>16}{'max':>10}{'indexes p50':>14}{'max':>10}")
+    for name, (p50, worst) in without_indexes.items():
+        (indexed_p50, indexed_worst) = with_indexes[name]
+        print(f"{name:<22}{p50 * 1000:>14.2f}ms{worst * 1000:>8.2f}ms{indexed_p50 * 1000:>12.2f}ms"
+              f"{indexed_worst * 1000:>8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
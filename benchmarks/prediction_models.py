@@ -0,0 +1,110 @@
+"""
+Micro-benchmarks of prediction_math and of one prediction of the slow(v0) and fast(v1) models, by the length
+of the patient's history.
+
+    python -m benchmarks.prediction_models --history 10 100 1000 10000
+    python -m benchmarks.prediction_models --baseline benchmarks/baselines/prediction_models.json
+
+v0 reads the aggregates of the history from an in-memory SQLite database, v1 updates the state of the patient in
+an in-memory cache(the DummyFastReadmissionCache of the tests), so Redis isn't measured. The time of v0 grows with
+the history, the one of v1 doesn't.
+"""
+import argparse
+import datetime
+import random
+import timeit
+from typing import Callable
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from benchmarks import baseline
+from src import models
+from src.config.database import Base
+from src.measurements import prediction_math
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel
+from src.measurements.prediction_model_slow import SlowReadmissionPredictionModel
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+
+START = datetime.datetime(2021, 1, 1)
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+def microseconds(f: Callable, repeat: int, min_seconds: float = 0.2) -> float:
+    """
+    The best of `repeat` runs of the time of one call, every run calls f for about min_seconds
+    """
+    timer = timeit.Timer(f)
+    (number, _) = timer.autorange()
+    number = max(1, int(number * min_seconds / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 10 ** 6
+
+
+def history(patient_id: int, length: int) -> list:
+    rnd = random.Random(patient_id)
+    return [models.Measurement(patient_id=patient_id, type=rnd.choice(TYPES), value=rnd.uniform(10, 140),
+                               time_created=START + datetime.timedelta(minutes=i)) for i in range(length)]
+
+
+def benchmark_prediction_math(repeat: int) -> dict:
+    values = [random.uniform(30, 40) for _ in range(1000)]
+    functions = {
+        "calculate_probability_v1": lambda: prediction_math.calculate_probability_v1(60, 120.0, 16.0, 0.5),
+        "calculate_mean_and_variance_online": lambda: prediction_math.calculate_mean_and_variance_online(
+            36.6, 12.0, 100, 37.1),
+        "calculate_mean_online": lambda: prediction_math.calculate_mean_online(16.0, 100, 18.0),
+        "calculate_mean(1000)": lambda: prediction_math.calculate_mean(values),
+        "calculate_standard_deviation(1000)": lambda: prediction_math.calculate_standard_deviation(values),
+    }
+    return {f"prediction_math.{name}": {"us": microseconds(f, repeat)} for name, f in functions.items()}
+
+
+def benchmark_models(lengths: list, repeat: int) -> dict:
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    repo = MeasurementSQLiteRepository(db)
+    slow = SlowReadmissionPredictionModel(measurement_repo=repo)
+    fast = FastReadmissionPredictionModel(cache=DummyFastReadmissionCache())
+
+    results = {}
+    for patient_id, length in enumerate(lengths, start=1):
+        patient = models.Patient(id=patient_id, age=60)
+        measurements = history(patient_id, length)
+        repo.save_measurements_with_predictions(measurements, [])
+        for m in measurements[:-1]:
+            fast.calculate(patient, m)
+        last = measurements[-1]
+        results[f"v0.history_{length}"] = {"us": microseconds(lambda: slow.calculate(patient, last), repeat)}
+        results[f"v1.history_{length}"] = {"us": microseconds(lambda: fast.calculate(patient, last), repeat)}
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="Lengths of the patient history")
+    parser.add_argument("--repeat", type=int, default=5)
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+    random.seed(42)
+
+    results = benchmark_prediction_math(args.repeat)
+    for name, r in results.items():
+        print(f"{name:<52} {r['us']:>10.2f}us")
+
+    models_results = benchmark_models(args.history, args.repeat)
+    print(f"\n{'history':>8} {'v0':>10} {'v1':>10} {'v0/v1':>7}")
+    for length in args.history:
+        (v0, v1) = (models_results[f"{model}.history_{length}"]["us"] for model in ("v0", "v1"))
+        print(f"{length:>8} {v0:>8.1f}us {v1:>8.1f}us {v0 / v1:>6.0f}x")
+    results.update(models_results)
+
+    baseline.finish(args, results)
+
+
+if __name__ == "__main__":
+    main()
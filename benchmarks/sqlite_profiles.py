@@ -0,0 +1,116 @@
+"""
+Concurrent writers and readers on a SQLite file with the default and the "wal" engine profiles
+of src.config.database.
+
+    python -m benchmarks.sqlite_profiles --writers 8 --readers 8 --seconds 10
+
+A writer saves a measurement and its prediction in two commits, like /v1/measurements.
+A reader fetches a page of predictions and the aggregates of a patient.
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from src import models
+from src.config.database import Base, create_db_engine, SQLITE_PRAGMAS
+from src.measurements.repository import MeasurementSQLiteRepository
+
+
+def percentile(timings: list, p: float) -> float:
+    timings = sorted(timings) or [0.0]
+    return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+
+def run(profile: str, writers: int, readers: int, seconds: float, patients: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_db_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}", profile=profile)
+        Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        stop = time.monotonic() + seconds
+        timings = {"write": [], "read": []}
+        errors = {"write": 0, "read": 0}
+        lock = threading.Lock()
+
+        def write(worker: int):
+            db = Session()
+            repo = MeasurementSQLiteRepository(db)
+            rnd = random.Random(worker)
+            while time.monotonic() < stop:
+                patient_id = rnd.randrange(patients)
+                t = datetime.datetime(2021, 1, 1) + datetime.timedelta(seconds=rnd.randrange(10 ** 6))
+                start = time.perf_counter()
+                try:
+                    repo.save_measurement(models.Measurement(patient_id=patient_id, type="temperature",
+                                                             value=rnd.uniform(35, 40), time_created=t))
+                    repo.save_prediction(models.ReadmissionPrediction(patient_id=patient_id, time_created=t,
+                                                                      probability=0.5))
+                    kind = "write"
+                except Exception:
+                    db.rollback()
+                    kind = None
+                with lock:
+                    if kind:
+                        timings[kind].append(time.perf_counter() - start)
+                    else:
+                        errors["write"] += 1
+            db.close()
+
+        def read(worker: int):
+            db = Session()
+            repo = MeasurementSQLiteRepository(db)
+            rnd = random.Random(-worker)
+            while time.monotonic() < stop:
+                patient_id = rnd.randrange(patients)
+                start = time.perf_counter()
+                try:
+                    repo.get_all_predictions(patient_id, 0, 100)
+                    repo.get_measurement_aggregates([patient_id])
+                    db.commit()
+                    ok = True
+                except Exception:
+                    db.rollback()
+                    ok = False
+                with lock:
+                    if ok:
+                        timings["read"].append(time.perf_counter() - start)
+                    else:
+                        errors["read"] += 1
+            db.close()
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+        threads += [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        engine.dispose()
+
+    return {kind: (len(timings[kind]) / seconds, statistics.median(timings[kind] or [0]) * 1000,
+                   percentile(timings[kind], 0.99), errors[kind]) for kind in timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--profiles", nargs="+", default=list(SQLITE_PRAGMAS), choices=list(SQLITE_PRAGMAS))
+    args = parser.parse_args()
+
+    print(f"{'profile':<8} {'op':<6} {'per sec':>8} {'p50':>9} {'p99':>9} {'errors':>6}")
+    for profile in args.profiles:
+        results = run(profile, args.writers, args.readers, args.seconds, args.patients)
+        for kind, (rate, p50, p99, errors) in results.items():
+            print(f"{profile:<8} {kind:<6} {rate:>8.0f} {p50:>7.2f}ms {p99:>7.2f}ms {errors:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+MeasurementSQLiteRepository(SQLite file, "wal" profile) against the memory-mapped MeasurementTimeSeriesRepository.
+
+    python -m benchmarks.timeseries_store --patients 100 --measurements 20000 --reads 2000
+
+Measurements are saved one by one like /v1/measurements does, then patients are read at random.
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from src import models
+from src.config.database import Base, create_db_engine
+from src.measurements.repository import MeasurementRepository, MeasurementSQLiteRepository
+from src.measurements.timeseries import MeasurementTimeSeriesRepository
+
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+def run(repo: MeasurementRepository, patients: int, measurements: int, reads: int) -> dict:
+    rnd = random.Random(42)
+    timings = {"save": [], "last": [], "page": [], "aggregates": []}
+    start = datetime.datetime(2021, 1, 1)
+    for i in range(measurements):
+        m = models.Measurement(patient_id=rnd.randrange(patients), type=rnd.choice(TYPES),
+                               value=rnd.uniform(30, 140), time_created=start + datetime.timedelta(seconds=i))
+        t = time.perf_counter()
+        repo.save_measurement(m)
+        timings["save"].append(time.perf_counter() - t)
+
+    reads_of = {
+        "last": lambda patient_id: repo.get_last_measurement(patient_id, "blood_pressure"),
+        "page": lambda patient_id: repo.get_all_measurements(patient_id, "temperature", limit=100),
+        "aggregates": lambda patient_id: repo.get_measurement_aggregates([patient_id]),
+    }
+    for _ in range(reads):
+        patient_id = rnd.randrange(patients)
+        for name, read in reads_of.items():
+            t = time.perf_counter()
+            read(patient_id)
+            timings[name].append(time.perf_counter() - t)
+    return {name: (statistics.median(ts) * 1e6, sorted(ts)[int(len(ts) * 0.99)] * 1e6, len(ts) / sum(ts))
+            for name, ts in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--measurements", type=int, default=20000)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--fsync", action="store_true", help="Sync every append of the time-series store")
+    args = parser.parse_args()
+
+    print(f"{'store':<11} {'op':<11} {'p50':>10} {'p99':>10} {'ops/s':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_db_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}", profile="wal")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        stores = {
+            "sqlite": MeasurementSQLiteRepository(db),
+            "timeseries": MeasurementTimeSeriesRepository(os.path.join(tmp, "series"), fsync=args.fsync),
+        }
+        for name, repo in stores.items():
+            for op, (p50, p99, rate) in run(repo, args.patients, args.measurements, args.reads).items():
+                print(f"{name:<11} {op:<11} {p50:>8.0f}us {p99:>8.0f}us {rate:>9.0f}")
+        db.close()
+        stores["timeseries"].close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
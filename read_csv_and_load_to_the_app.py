@@ -1,88 +1,271 @@
+"""
+Reads patients, admissions and signals from CSV files and loads them to the service.
+
+    python read_csv_and_load_to_the_app.py --url http://localhost:80/v1 --workers 8 --batch-size 500
+
+Signals of one patient are always sent by the same worker in the order of the file,
+so the readmission probabilities are calculated in the same order as with a sequential load.
+"""
 from __future__ import annotations
 
+import argparse
 import csv
+import itertools
+import os
+import queue
+import statistics
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-def stream_patients_csv(url: str, path: str):
-    # Open the CSV file and process in line by line
-    with open(path, "r") as f:
-        reader = csv.DictReader(f, delimiter=";")
-        for row in reader:
-            print("patient: ", row["pat_id"], row["age"])
-            # Send POST request to create patient
-            resp = requests.post("{0}/patients/".format(url),
-                                 headers={
-                                     'Content-Type': 'application/json'
-                                 },
-                                 json={
-                                     "id": int(row["pat_id"]),
-                                     "age": round(float(row["age"])),
-                                 })
-            if resp.status_code != 201:
-                print(str(resp.status_code), resp.text)
-
-
-def stream_admission_csv(url: str, path: str):
-    # Open the CSV file and process in line by line
+class RateLimiter:
+    """
+    Token bucket shared by all workers, `rate` requests per second. 0 means no limit.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                sleep = (1 - self.tokens) / self.rate
+            time.sleep(sleep)
+
+
+class Stats:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.failed = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def add(self, items: int, failed: int, latency: float):
+        with self.lock:
+            self.items += items
+            self.failed += failed
+            self.latencies.append(latency)
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.start
+        latencies = sorted(self.latencies) or [0.0]
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        return (f"{self.name}: {self.items} items({self.failed} failed) in {elapsed:.2f}s, "
+                f"{self.items / elapsed if elapsed else 0:.0f} items/s, {len(self.latencies)} requests, "
+                f"latency p50 {statistics.median(latencies) * 1000:.1f}ms, p95 {percentile(0.95):.1f}ms, "
+                f"p99 {percentile(0.99):.1f}ms")
+
+
+class Loader:
+
+    def __init__(self, url: str, workers: int, batch_size: int, rate: float, retries: int, backoff: float,
+                 verbose: bool = False):
+        self.url = url
+        self.workers = workers
+        self.batch_size = batch_size
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.verbose = verbose
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        # One keep-alive session per worker thread, requests.Session is not thread-safe
+        if not hasattr(self.local, "session"):
+            session = requests.Session()
+            # POSTs aren't idempotent, they are retried only when the service didn't process them: connection
+            # errors, 429 and 503. A read error, 502 or 504 can come after the service saved the request
+            retry = Retry(total=self.retries, read=0, backoff_factor=self.backoff, allowed_methods=None,
+                          status_forcelist=[429, 503], raise_on_status=False)
+            session.mount("http://", HTTPAdapter(pool_maxsize=1, max_retries=retry))
+            session.mount("https://", HTTPAdapter(pool_maxsize=1, max_retries=retry))
+            session.headers.update({'Content-Type': 'application/json'})
+            self.local.session = session
+        return self.local.session
+
+    def post(self, path: str, payload, stats: Stats, items: int = 1) -> requests.Response or None:
+        self.rate_limiter.wait()
+        start = time.monotonic()
+        try:
+            resp = self.session().post(f"{self.url}{path}", json=payload)
+        except requests.RequestException as e:
+            stats.add(items, items, time.monotonic() - start)
+            print(f"POST {path} failed: {e}")
+            return None
+        latency = time.monotonic() - start
+
+        # 202 is a measurement accepted into the write-behind spool
+        accepted = 200 <= resp.status_code < 300
+        failed = 0 if accepted else items
+        if accepted and items > 1:
+            failed = resp.json()["failed"]
+        stats.add(items, failed, latency)
+        if failed and self.verbose:
+            print(str(resp.status_code), resp.text)
+        return resp
+
+    def load_patients(self, path: str, limit: int = None) -> Stats:
+        stats = Stats("patients")
+
+        def send(row):
+            self.post("/patients/", {"id": int(row["pat_id"]), "age": round(float(row["age"]))}, stats)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(send, read_csv(path, limit)))
+        return stats
+
+    def load_admissions(self, path: str, limit: int = None) -> Stats:
+        stats = Stats("admissions")
+
+        def send(row):
+            self.post(f"/patients/{row['pat_id']}/admissions", {
+                "patient_id": int(row["pat_id"]),
+                "date_admission": row["date_admission"],
+                "date_discharge": row["date_discharge"],
+            }, stats)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(send, read_csv(path, limit)))
+        return stats
+
+    def load_signals(self, path: str, limit: int = None) -> Stats:
+        """
+        A reader thread shards signals by patient to per-worker queues. Each worker sends its signals
+        in order, in batches of up to batch_size, or one by one if batch_size is 1.
+        If the reader or a worker fails, the others stop and the error is raised.
+        """
+        stats = Stats("signals")
+        queues = [queue.Queue(maxsize=self.batch_size * 4) for _ in range(self.workers)]
+        done = object()
+        stop = threading.Event()
+        errors = []
+
+        def put(q: queue.Queue, item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    pass
+            return done
+
+        def read():
+            try:
+                for row in read_csv(path, limit):
+                    if not put(queues[int(row["pat_id"]) % self.workers], {
+                        "patient_id": int(row["pat_id"]),
+                        "day": row["day"],
+                        "hour": int(row["hour"]),
+                        "parameter": row["parameter"],
+                        "value": float(row["value"]),
+                    }):
+                        return
+                for q in queues:
+                    put(q, done)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        def send(q: queue.Queue):
+            try:
+                send_queue(q)
+            except Exception:
+                stop.set()
+                raise
+
+        def send_queue(q: queue.Queue):
+            finished = False
+            while not finished:
+                batch = [get(q)]
+                # Take what's already queued, without waiting for a full batch
+                while len(batch) < self.batch_size and batch[-1] is not done:
+                    try:
+                        batch.append(q.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is done:
+                    finished = True
+                    batch.pop()
+                if not batch:
+                    continue
+                if self.batch_size > 1:
+                    self.post("/measurements:batch", batch, stats, items=len(batch))
+                else:
+                    self.post("/measurements", batch[0], stats)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(send, queues))
+        reader.join()
+        if errors:
+            raise errors[0]
+        return stats
+
+
+def read_csv(path: str, limit: int = None):
+    # Open the CSV file and process it line by line
     with open(path, "r") as f:
-        reader = csv.DictReader(f, delimiter=";")
-        for row in reader:
-            print("admission for: ", row["pat_id"])
-            # Send POST request to create patient
-            resp = requests.post("{0}/patients/{1}/admissions".format(url, row["pat_id"]),
-                                 headers={
-                                     'Content-Type': 'application/json'
-                                 },
-                                 json={
-                                     "patient_id": int(row["pat_id"]),
-                                     "date_admission": row["date_admission"],
-                                     "date_discharge": row["date_discharge"],
-                                 })
-            if resp.status_code != 201:
-                print(str(resp.status_code), resp.text)
-
-
-def stream_signal_csv(url: str, csv_path: str):
-    # Open the CSV file and process in line by line
-    with open(csv_path, "r") as f:
-        reader = csv.DictReader(f, delimiter=";")
-        for row in reader:
-            print("signal for: ", row["pat_id"])
-            # Send POST request to create patient
-            resp = requests.post("{0}/measurements".format(url),
-                                 headers={
-                                     'Content-Type': 'application/json'
-                                 },
-                                 json={
-                                     "patient_id": int(row["pat_id"]),
-                                     "day": row["day"],
-                                     "hour": row["hour"],
-                                     "parameter": row["parameter"],
-                                     "value": float(row["value"]),
-                                 })
-            if resp.status_code != 201:
-                print(str(resp.status_code), resp.text)
+        yield from itertools.islice(csv.DictReader(f, delimiter=";"), limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:80/v1")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--only", choices=["patients", "admissions", "signals"], action="append",
+                        help="Load only these files, can be repeated. All files by default")
+    parser.add_argument("--limit", type=int, default=None, help="Load only the first rows of every file")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=500, help="Signals per request, 1 disables batching")
+    parser.add_argument("--rate", type=float, default=0, help="Requests per second, 0 means no limit")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=0.5, help="Backoff factor of retries, in seconds")
+    parser.add_argument("--verbose", action="store_true", help="Print every failed request")
+    args = parser.parse_args()
+
+    loader = Loader(url=args.url, workers=args.workers, batch_size=max(args.batch_size, 1), rate=args.rate,
+                    retries=args.retries, backoff=args.backoff, verbose=args.verbose)
+    only = args.only or ["patients", "admissions", "signals"]
+    summaries = []
+    if "patients" in only:
+        summaries.append(loader.load_patients(os.path.join(args.data_dir, "age.csv"), args.limit).summary())
+    if "admissions" in only:
+        summaries.append(loader.load_admissions(os.path.join(args.data_dir, "admission.csv"), args.limit).summary())
+    if "signals" in only:
+        summaries.append(loader.load_signals(os.path.join(args.data_dir, "signal.csv"), args.limit).summary())
+    print("\n".join(summaries))
 
 
 if __name__ == "__main__":
-    url = "http://localhost:80/v1"
-    start = time.monotonic()
-    csv_path = "data/age.csv"
-    stream_patients_csv(url, csv_path)
-    end = time.monotonic()
-    print(f"loaded patients in {end - start:.6f} seconds")
-
-    start = time.monotonic()
-    csv_path = "data/admission.csv"
-    stream_admission_csv(url, csv_path)
-    end = time.monotonic()
-    print(f"loaded admissions in {end - start:.6f} seconds")
-
-    start = time.monotonic()
-    csv_path = "data/signal.csv"
-    stream_signal_csv(url, csv_path)
-    end = time.monotonic()
-    print(f"loaded signals in {end - start:.6f} seconds")
+    main()
@@ -1,17 +1,54 @@
+import asyncio
 import os
+import weakref
 
 import redis
+import redis.asyncio
+
+_connection_pool = None
+# asyncio connections belong to the event loop they were opened in
+_async_connection_pools = weakref.WeakKeyDictionary()
+
+
+def get_connection_pool() -> redis.ConnectionPool:
+    """
+    Returns the application-wide Redis connection pool, so requests reuse open connections instead of
+    doing a TCP connect each time. When all connections are busy, a request waits for a free one.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = redis.BlockingConnectionPool(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            db=int(os.getenv("REDIS_DB", 0)),
+            password=os.getenv("REDIS_PASSWORD", None),
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+            timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 5)),
+        )
+    return _connection_pool
+
+
+def get_async_connection_pool() -> redis.asyncio.ConnectionPool:
+    """
+    The same as get_connection_pool for redis.asyncio, one pool per event loop
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_connection_pools:
+        _async_connection_pools[loop] = redis.asyncio.BlockingConnectionPool(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            db=int(os.getenv("REDIS_DB", 0)),
+            password=os.getenv("REDIS_PASSWORD", None),
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+            timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 5)),
+        )
+    return _async_connection_pools[loop]
 
 
 def get_cache():
-    # TODO: Set up redis connection pool
-    cache = redis.Redis(
-        host=os.getenv("REDIS_HOST", "localhost"),
-        port=os.getenv("REDIS_PORT", 6379),
-        db=os.getenv("REDIS_DB", 0),
-        password=os.getenv("REDIS_PASSWORD", None),
-    )
-    try:
-        yield cache
-    finally:
-        cache.close()
+    # The client is cheap to create, connections are borrowed from the shared pool and returned after each command
+    yield redis.Redis(connection_pool=get_connection_pool())
+
+
+async def get_async_cache():
+    yield redis.asyncio.Redis(connection_pool=get_async_connection_pool())
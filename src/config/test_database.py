@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+
+from sqlalchemy.pool import QueuePool, StaticPool, NullPool
+
+from src.config.database import create_db_engine, engine_options, async_database_url
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def test_sqlite_wal_profile(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'test.db'}", profile="wal")
+    assert isinstance(engine.pool, QueuePool)
+    with engine.connect() as conn:
+        pragmas = [conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in ("journal_mode", "synchronous")]
+    assert pragmas == ["wal", 1]
+    engine.dispose()
+
+
+def test_engine_options(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "7")
+    assert engine_options("sqlite://")["poolclass"] is StaticPool
+    assert engine_options("sqlite+aiosqlite:///./app.db")["poolclass"] is NullPool
+    options = engine_options("postgresql://user:password@db/app")
+    assert (options["pool_size"], options["pool_pre_ping"]) == (7, True)
+    assert async_database_url("postgresql://user:password@db/app") == "postgresql+asyncpg://user:password@db/app"
+    assert async_database_url("sqlite:///./app.db") == "sqlite+aiosqlite:///./app.db"
+
+
+def test_sync_database_works_without_the_async_driver(tmp_path):
+    # A fresh interpreter, where aiosqlite can't be imported
+    script = "\n".join([
+        "import sys",
+        "sys.modules['aiosqlite'] = None",
+        "from src.config import database",
+        "database.create_tables()",
+        "assert database._async_session_local is None",
+    ])
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'test.db'}")
+    subprocess.run([sys.executable, "-c", script], env=env, check=True, cwd=ROOT)
@@ -1,14 +1,85 @@
-from typing import TypeVar, Generic
+import base64
+import datetime
+import hmac
+import json
+import os
+from typing import Callable, TypeVar, Generic, List, Optional, Tuple, Union
 
-from fastapi import Header, HTTPException
-from pydantic import Field
+import redis
+import redis.asyncio
+from fastapi import Header, HTTPException, Query, Request, status, Depends
+from pydantic import Field, ValidationError
 from pydantic.generics import GenericModel
 
+from src.config.cache import get_cache, get_connection_pool, get_async_cache
+from src.diagnostics import ProfileStore
+from src.http_cache import ConditionalGet, ResponseCache
+from src.measurements.cache import FastReadmissionRedisCache, FastReadmissionRedisScriptCache, \
+    FastReadmissionLRUCache, AsyncFastReadmissionRedisCache
+from src.measurements.prediction_model_fast import FastReadmissionCache, AsyncFastReadmissionCache
+from src.measurements.ranking import ReadmissionRanking, AsyncReadmissionRanking
+from src.measurements.write_behind import MeasurementSpool
+from src.patient.versions import PatientVersionRedisStore, AsyncPatientVersionRedisStore
+from src.schemas import MeasurementIn
+
+MAX_MEASUREMENT_BATCH_SIZE = 10000
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
 
 class PaginationParams:
-    def __init__(self, offset: int = 0, limit: int = 100):
+    """
+    `cursor` is the `next_cursor` of the previous page. With a cursor the page starts right after the last item
+    of the previous one, so deep pages cost the same as the first one. `offset` is ignored then.
+    """
+
+    def __init__(self, offset: int = Query(0, ge=0), limit: int = Query(100, ge=0), cursor: str = None):
         self.offset = offset
         self.limit = limit
+        self.cursor = cursor
+        self.before = decode_cursor(cursor) if cursor else None
+
+
+# Patients of one bulk read, e.g. all beds of a dashboard
+MAX_PATIENT_IDS = 1000
+
+
+def patient_ids(ids: List[str] = Query(..., description="Patient IDs, comma-separated or repeated",
+                                       example="42,43")) -> List[int]:
+    """
+    Unique patient IDs in the order of the request
+    """
+    try:
+        result = [int(i) for value in ids for i in value.split(",") if i.strip()]
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ids must be integers")
+    if len(result) > MAX_PATIENT_IDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At most {MAX_PATIENT_IDS} ids are allowed")
+    return list(dict.fromkeys(result))
+
+
+def encode_cursor(time_created: datetime.datetime, item_id: int) -> str:
+    raw = json.dumps([time_created.isoformat(), item_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def next_cursor(items: list, limit: int, key: Callable[[object], Tuple[datetime.datetime, int]]) -> Optional[str]:
+    """
+    Cursor of a page read with one extra item, None on the last page. A page of limit=0 has no last item
+    to continue from.
+    """
+    if limit <= 0 or len(items) <= limit:
+        return None
+    return encode_cursor(*key(items[limit - 1]))
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        (time_created, item_id) = json.loads(raw)
+        return datetime.datetime.fromisoformat(time_created), int(item_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
 
 T = TypeVar('T')
@@ -18,4 +89,176 @@ class PaginationResponse(GenericModel, Generic[T]):
     offset: int = Field(example=0)
     limit: int = Field(example=100)
     total: int = Field(example=1)
+    next_cursor: Optional[str] = Field(default=None, description="Cursor of the next page, if there is one")
     items: list[T]
+
+
+async def measurement_batch(request: Request) -> List[Tuple[int, Union[MeasurementIn, str]]]:
+    """
+    Parses a batch of measurements from a JSON array or from NDJSON(one measurement per line).
+
+    Every item is validated separately, so one bad row doesn't reject the whole batch:
+    a valid item is returned as MeasurementIn, an invalid one as the error description.
+    """
+    body = await request.body()
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    try:
+        if content_type in NDJSON_CONTENT_TYPES:
+            raw_items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            raw_items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Malformed batch: {e}")
+    if not isinstance(raw_items, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Batch must be a list of measurements")
+    if len(raw_items) > MAX_MEASUREMENT_BATCH_SIZE:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"Batch is limited to {MAX_MEASUREMENT_BATCH_SIZE} measurements")
+
+    items = []
+    for index, raw in enumerate(raw_items):
+        try:
+            items.append((index, MeasurementIn.parse_obj(raw)))
+        except ValidationError as e:
+            items.append((index, str(e)))
+    return items
+
+
+_fast_readmission_lru_cache = None
+
+
+def get_fast_readmission_cache(cache: redis.Redis = Depends(get_cache)) -> FastReadmissionCache:
+    """
+    FAST_CACHE_BACKEND=script updates the cached state atomically with a Lua script,
+    which is required when several workers receive measurements of the same patient.
+    FAST_CACHE_LRU_SIZE>0 keeps that many patient states in the worker memory for FAST_CACHE_LRU_TTL seconds.
+    With the keys backend it needs sticky routing of patients to workers, with the script one updates still go
+    to Redis atomically.
+    """
+    lru_size = int(os.getenv("FAST_CACHE_LRU_SIZE", 0))
+    if lru_size > 0:
+        return get_fast_readmission_lru_cache(lru_size)
+    return new_fast_readmission_redis_cache(cache)
+
+
+def new_fast_readmission_redis_cache(cache: redis.Redis) -> FastReadmissionCache:
+    if os.getenv("FAST_CACHE_BACKEND", "keys") == "script":
+        return FastReadmissionRedisScriptCache(redis_client=cache)
+    return FastReadmissionRedisCache(redis_client=cache)
+
+
+def get_fast_readmission_lru_cache(size: int) -> FastReadmissionLRUCache:
+    # The LRU lives as long as the worker, so it has its own client on the shared connection pool
+    global _fast_readmission_lru_cache
+    if _fast_readmission_lru_cache is None:
+        _fast_readmission_lru_cache = FastReadmissionLRUCache(
+            cache=new_fast_readmission_redis_cache(redis.Redis(connection_pool=get_connection_pool())),
+            max_size=size,
+            ttl=float(os.getenv("FAST_CACHE_LRU_TTL", 30)),
+        )
+    return _fast_readmission_lru_cache
+
+
+def get_async_fast_readmission_cache(
+        cache: redis.asyncio.Redis = Depends(get_async_cache)) -> AsyncFastReadmissionCache:
+    # The async path always updates the state with the Lua script, the in-process LRU is not supported there
+    return AsyncFastReadmissionRedisCache(redis_client=cache)
+
+
+_measurement_spool = None
+
+
+def get_measurement_spool() -> MeasurementSpool or None:
+    """
+    MEASUREMENT_WRITE_BEHIND=true answers /v1/measurements with 202 after the measurement is in the spool
+    at MEASUREMENT_SPOOL_PATH, see src.measurements.write_behind
+    """
+    global _measurement_spool
+    if os.getenv("MEASUREMENT_WRITE_BEHIND", "false").lower() not in ("1", "true"):
+        return None
+    if _measurement_spool is None:
+        _measurement_spool = MeasurementSpool(os.getenv("MEASUREMENT_SPOOL_PATH", "./measurement_spool.db"))
+    return _measurement_spool
+
+
+def get_patient_versions(cache: redis.Redis = Depends(get_cache)) -> PatientVersionRedisStore or None:
+    """
+    HTTP_CONDITIONAL_GET=true tracks versions of patients in Redis, writes bump them and GETs of patient data
+    send an ETag, see src.http_cache. It must be set on all workers.
+    """
+    if os.getenv("HTTP_CONDITIONAL_GET", "false").lower() not in ("1", "true"):
+        return None
+    return PatientVersionRedisStore(redis_client=cache)
+
+
+async def get_async_patient_versions(
+        cache: redis.asyncio.Redis = Depends(get_async_cache)) -> AsyncPatientVersionRedisStore or None:
+    if os.getenv("HTTP_CONDITIONAL_GET", "false").lower() not in ("1", "true"):
+        return None
+    return AsyncPatientVersionRedisStore(redis_client=cache)
+
+
+_response_cache = None
+
+
+def get_response_cache() -> ResponseCache or None:
+    """
+    HTTP_RESPONSE_CACHE_SIZE>0 keeps that many response bodies of conditional GETs in the worker memory
+    for HTTP_RESPONSE_CACHE_TTL seconds
+    """
+    global _response_cache
+    size = int(os.getenv("HTTP_RESPONSE_CACHE_SIZE", 0))
+    if size <= 0:
+        return None
+    if _response_cache is None:
+        _response_cache = ResponseCache(max_size=size, ttl=float(os.getenv("HTTP_RESPONSE_CACHE_TTL", 5)))
+    return _response_cache
+
+
+def patient_conditional_get(patient_id: int, request: Request,
+                            versions: PatientVersionRedisStore = Depends(get_patient_versions),
+                            response_cache: ResponseCache = Depends(get_response_cache)) -> ConditionalGet:
+    return ConditionalGet(request, [patient_id], versions=versions, response_cache=response_cache)
+
+
+def patients_conditional_get(request: Request, ids: List[int] = Depends(patient_ids),
+                             versions: PatientVersionRedisStore = Depends(get_patient_versions),
+                             response_cache: ResponseCache = Depends(get_response_cache)) -> ConditionalGet:
+    return ConditionalGet(request, ids, versions=versions, response_cache=response_cache)
+
+
+def get_readmission_ranking(cache: redis.Redis = Depends(get_cache)) -> ReadmissionRanking:
+    return ReadmissionRanking(redis_client=cache)
+
+
+async def get_async_readmission_ranking(
+        cache: redis.asyncio.Redis = Depends(get_async_cache)) -> AsyncReadmissionRanking:
+    return AsyncReadmissionRanking(redis_client=cache)
+
+
+_profile_store = None
+
+
+def get_profile_store() -> ProfileStore or None:
+    """
+    PROFILE_SAMPLE_RATE>0 or PROFILE_ALLOW_HEADER=true profiles requests through MeasurementService and keeps
+    the last PROFILE_KEEP of them that took at least PROFILE_SLOW_MS, see src.diagnostics
+    """
+    global _profile_store
+    if float(os.getenv("PROFILE_SAMPLE_RATE", 0)) <= 0 and \
+            os.getenv("PROFILE_ALLOW_HEADER", "false").lower() not in ("1", "true"):
+        return None
+    if _profile_store is None:
+        _profile_store = ProfileStore(size=int(os.getenv("PROFILE_KEEP", 20)))
+    return _profile_store
+
+
+def admin_token(x_admin_token: str = Header(None)):
+    """
+    Admin endpoints exist only if ADMIN_TOKEN is set and need it in the X-Admin-Token header
+    """
+    expected = os.getenv("ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), expected.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token")
@@ -0,0 +1,191 @@
+"""
+Diagnostics of single requests.
+
+* ServerTimingMiddleware adds a Server-Timing header to every response: the stages of src.metrics that ran
+  for the request(patient_lookup, cache_update, probability...), `db` for the time in repository calls and `total`.
+* Profiling is opt-in: a sample of requests(PROFILE_SAMPLE_RATE) or requests with `X-Profile: 1`
+  (if PROFILE_ALLOW_HEADER=true) run MeasurementService under cProfile. Profiles of requests slower than
+  PROFILE_SLOW_MS are kept in a ProfileStore and served by /admin/profiles.
+
+Timings are collected in a per-request object in a context variable. Sync endpoints run in the threadpool with
+a copy of the context, which refers to the same object.
+"""
+import cProfile
+import datetime
+import functools
+import inspect
+import io
+import itertools
+import logging
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import List, Optional
+
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+
+
+class RequestDiagnostics:
+
+    def __init__(self, profile_requested: bool = False):
+        self.timings = {}
+        self.profile_requested = profile_requested
+        self.profile: Optional[cProfile.Profile] = None
+
+
+_request: ContextVar[Optional[RequestDiagnostics]] = ContextVar("request_diagnostics", default=None)
+
+
+def record(name: str, seconds: float):
+    """
+    Adds the duration to the Server-Timing entry of the current request, if there is one
+    """
+    request = _request.get()
+    if request is not None:
+        request.timings[name] = request.timings.get(name, 0.0) + seconds
+
+
+def server_timing(timings: dict, total: float) -> str:
+    entries = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(entries)
+
+
+class Profile:
+
+    def __init__(self, profile_id: int, method: str, path: str, duration: float, stats: pstats.Stats):
+        self.id = profile_id
+        self.time_created = datetime.datetime.utcnow()
+        self.method = method
+        self.path = path
+        self.duration_ms = duration * 1000
+        self.stats = stats
+
+    def text(self, sort: str = "cumulative", limit: int = 50) -> str:
+        # Sorting and the stream are state of a Stats, so every call prints a copy and admin requests
+        # reading the same profile don't mix their output
+        out = io.StringIO()
+        stats = pstats.Stats(stream=out).add(self.stats)
+        stats.sort_stats(sort).print_stats(limit)
+        stats.print_callees(limit)
+        return out.getvalue()
+
+
+class ProfileStore:
+    """
+    The last `size` profiles of slow requests, newest first
+    """
+
+    def __init__(self, size: int = 20):
+        self.profiles = deque(maxlen=size)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, method: str, path: str, duration: float, profile: cProfile.Profile) -> Profile:
+        stats = pstats.Stats(profile)
+        with self.lock:
+            p = Profile(next(self.ids), method, path, duration, stats)
+            self.profiles.appendleft(p)
+        return p
+
+    def list(self) -> List[Profile]:
+        with self.lock:
+            return list(self.profiles)
+
+    def get(self, profile_id: int) -> Profile or None:
+        return next((p for p in self.list() if p.id == profile_id), None)
+
+
+class ServerTimingMiddleware:
+    """
+    Pure ASGI middleware, so streaming responses aren't buffered. For them the header has the timings
+    until the response started.
+    """
+
+    def __init__(self, app, profiles: ProfileStore = None, sample_rate: float = 0.0, allow_header: bool = False,
+                 slow_seconds: float = 0.1, server_timing_header: bool = True):
+        self.app = app
+        self.profiles = profiles
+        self.sample_rate = sample_rate
+        self.allow_header = allow_header
+        self.slow_seconds = slow_seconds
+        self.server_timing_header = server_timing_header
+
+    def profile_requested(self, scope) -> bool:
+        if self.profiles is None:
+            return False
+        if self.allow_header and (PROFILE_HEADER.encode(), b"1") in scope["headers"]:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestDiagnostics(profile_requested=self.profile_requested(scope))
+        token = _request.set(request)
+        start = time.perf_counter()
+
+        async def send_with_server_timing(message):
+            if message["type"] == "http.response.start" and self.server_timing_header:
+                MutableHeaders(scope=message).append("Server-Timing",
+                                                     server_timing(request.timings, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            _request.reset(token)
+            duration = time.perf_counter() - start
+            if request.profile is not None and duration >= self.slow_seconds:
+                self.profiles.add(scope["method"], scope["path"], duration, request.profile)
+
+
+def profiled(method):
+    """
+    Runs the decorated method(sync or async) under cProfile if the current request asked for a profile.
+    The profiler of a sync method only sees its thread. The one of an async method sees everything
+    on the event loop while it waits, including other requests.
+    """
+    def start() -> cProfile.Profile or None:
+        request = _request.get()
+        if request is None or not request.profile_requested or request.profile is not None:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            logger.debug("Profiler is busy, the request is not profiled")
+            return None
+        request.profile = profile
+        return profile
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def profiled_async(*args, **kwargs):
+            profile = start()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                if profile:
+                    profile.disable()
+        return profiled_async
+
+    @functools.wraps(method)
+    def profiled_sync(*args, **kwargs):
+        profile = start()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            if profile:
+                profile.disable()
+    return profiled_sync
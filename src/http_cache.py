@@ -0,0 +1,121 @@
+"""
+Conditional GETs of patient data.
+
+The ETag of a response is a hash of the URL and the versions of the patients in it(see src.patient.versions),
+so a poll with a matching If-None-Match is answered with 304 after one Redis read. With a ResponseCache,
+polls without validators get the cached body of the same ETag, also without the database.
+"""
+import email.utils
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List
+
+import redis
+from fastapi import Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import parse_obj_as
+
+from src.patient.versions import PatientVersionRedisStore
+
+logger = logging.getLogger(__name__)
+
+# Last-Modified has whole seconds, it's only sent when no write in the same second can follow,
+# with a second to spare for clock differences between workers
+LAST_MODIFIED_MIN_AGE = 2.0
+
+
+class ResponseCache:
+    """
+    Bounded in-process LRU of response bodies by ETag. A new version of a patient is a new ETag,
+    so entries are never stale, `ttl` only limits how long unused bodies take memory.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 5.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, etag: str) -> bytes or None:
+        with self.lock:
+            cached = self.bodies.get(etag)
+            if cached and cached[0] > self.clock():
+                self.bodies.move_to_end(etag)
+                return cached[1]
+            return None
+
+    def put(self, etag: str, body: bytes):
+        with self.lock:
+            self.bodies[etag] = (self.clock() + self.ttl, body)
+            self.bodies.move_to_end(etag)
+            while len(self.bodies) > self.max_size:
+                self.bodies.popitem(last=False)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # Weak comparison, as RFC 7232 requires for If-None-Match
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def not_modified_since(if_modified_since: str, modified: float) -> bool:
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return since.tzinfo is not None and int(modified) <= since.timestamp()
+
+
+class ConditionalGet:
+    """
+    Answers a GET of the data of `patient_ids` with 304 or a cached body when possible, calls `read` otherwise.
+    Without a version store, or when Redis is unavailable, `read` is always called and no validators are sent.
+    """
+
+    def __init__(self, request: Request, patient_ids: List[int], versions: PatientVersionRedisStore = None,
+                 response_cache: ResponseCache = None):
+        self.request = request
+        self.patient_ids = patient_ids
+        self.versions = versions
+        self.response_cache = response_cache
+
+    def respond(self, read: Callable[[], Any], response_model: Any) -> Any:
+        if not self.versions:
+            return read()
+        # Versions are read before the data: a write in between makes the body newer than its ETag, never older
+        try:
+            versions = self.versions.get_versions(self.patient_ids)
+        except redis.RedisError:
+            logger.warning("Patient versions are not available, answering without validators", exc_info=True)
+            return read()
+
+        digest = hashlib.sha1(str(self.request.url.path).encode())
+        digest.update(self.request.url.query.encode())
+        for patient_id in self.patient_ids:
+            digest.update(f"|{patient_id}={versions[patient_id].token}".encode())
+        etag = f'"{digest.hexdigest()}"'
+        modified = max((v.modified for v in versions.values()), default=0.0)
+
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if modified and time.time() - modified >= LAST_MODIFIED_MIN_AGE:
+            headers["Last-Modified"] = email.utils.formatdate(modified, usegmt=True)
+
+        if_none_match = self.request.headers.get("if-none-match")
+        if_modified_since = self.request.headers.get("if-modified-since")
+        if if_none_match is not None:
+            if etag_matches(if_none_match, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        elif if_modified_since and "Last-Modified" in headers and not_modified_since(if_modified_since, modified):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        body = self.response_cache.get(etag) if self.response_cache else None
+        if body is None:
+            body = JSONResponse(content=jsonable_encoder(parse_obj_as(response_model, read()))).body
+            if self.response_cache:
+                self.response_cache.put(etag, body)
+        return Response(content=body, media_type="application/json", headers=headers)
@@ -1,40 +1,113 @@
+import datetime
+import logging
+import os
+import threading
+from typing import List, Optional
+
 import redis
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Response, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from src.config.cache import get_cache
-from src.config.database import create_tables, get_db
-from src.dependencies import PaginationParams, PaginationResponse
+from src import models
+from src.config.cache import get_connection_pool
+from src.config.database import create_tables, get_db, SessionLocal, get_async_db
+from src.dependencies import PaginationParams, PaginationResponse, measurement_batch, get_fast_readmission_cache, \
+    get_async_fast_readmission_cache, get_measurement_spool, next_cursor, patient_ids, get_patient_versions, \
+    get_async_patient_versions, patient_conditional_get, patients_conditional_get, get_readmission_ranking, \
+    get_async_readmission_ranking, get_profile_store, admin_token, MAX_PATIENT_IDS
+from src.diagnostics import ProfileStore, ServerTimingMiddleware
+from src.http_cache import ConditionalGet
 from src.measurements.cache import FastReadmissionRedisCache
-from src.measurements.prediction_model_fast import FastReadmissionPredictionModel
+from src.measurements.export import export_chunks, measurements_query, predictions_query, MEASUREMENT_COLUMNS, \
+    PREDICTION_COLUMNS, MEDIA_TYPES
+from src.measurements.prediction_model_fast import FastReadmissionCache, AsyncFastReadmissionCache
+from src.measurements.prediction_model_resilient import ResilientReadmissionPredictionModel, \
+    AsyncResilientReadmissionPredictionModel
 from src.measurements.prediction_model_slow import SlowReadmissionPredictionModel
-from src.measurements.repository import MeasurementSQLiteRepository
-from src.measurement_service import MeasurementService
+from src.measurements.ranking import ReadmissionRanking, AsyncReadmissionRanking, rebuild_ranking
+from src.measurements.repository import MeasurementSQLiteRepository, MeasurementAsyncSQLiteRepository, history_key
+from src.measurements.warm_cache import warm_cache
+from src.measurements.write_behind import MeasurementSpool, WriteBehindFlusher
+from src.measurement_service import MeasurementService, AsyncMeasurementService
 from src.patient.exceptions import PatientNotFoundException, PatientAlreadyExistsException
-from src.patient.repository import PatientSQLiteRepository
+from src.patient.repository import PatientSQLiteRepository, PatientAsyncSQLiteRepository
+from src.patient.versions import PatientVersionRedisStore, AsyncPatientVersionRedisStore
 
 from src.patient_service import PatientService
 from src.schemas import MeasurementIn, ReadmissionProbabilityOut, MeasurementOut, MeasurementType, PatientOut, \
-    AdmissionOut, AdmissionIn, PatientIn
+    AdmissionOut, AdmissionIn, PatientIn, MeasurementBatchOut, MeasurementBatchItemOut, MeasurementBatchItemStatus, \
+    MeasurementHourlyOut, ExportFormat, ProfileOut
 
 from starlette_prometheus import metrics, PrometheusMiddleware
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(
     responses={404: {"description": "Not found"}},
 )
 app.add_middleware(PrometheusMiddleware)
+app.add_middleware(ServerTimingMiddleware, profiles=get_profile_store(),
+                   sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", 0)),
+                   allow_header=os.getenv("PROFILE_ALLOW_HEADER", "false").lower() in ("1", "true"),
+                   slow_seconds=float(os.getenv("PROFILE_SLOW_MS", 100)) / 1000,
+                   server_timing_header=os.getenv("SERVER_TIMING", "true").lower() in ("1", "true"))
 app.add_route("/metrics", metrics)
 
 # Create tables in the local SQLite database if they don't exist
 create_tables()
 
 
+@app.on_event("startup")
+def start_cache_warm_up():
+    # Restores the fast model cache in the background, so a restart after a Redis flush has no latency cliff
+    if os.getenv("FAST_CACHE_WARM_ON_STARTUP", "false").lower() not in ("1", "true"):
+        return
+
+    def warm_up():
+        db = SessionLocal()
+        try:
+            warm_cache(db, FastReadmissionRedisCache(redis_client=redis.Redis(connection_pool=get_connection_pool())))
+            rebuild_ranking(db, ReadmissionRanking(redis.Redis(connection_pool=get_connection_pool())))
+        except Exception:
+            logger.exception("Cache warm up failed")
+        finally:
+            db.close()
+
+    threading.Thread(target=warm_up, name="cache-warm-up", daemon=True).start()
+
+
+_spool_flusher = None
+
+
+@app.on_event("startup")
+def start_spool_flusher():
+    global _spool_flusher
+    spool = get_measurement_spool()
+    if spool:
+        # Whatever was left in the spool by a crash is written first
+        versions = get_patient_versions(redis.Redis(connection_pool=get_connection_pool()))
+        _spool_flusher = WriteBehindFlusher(spool, SessionLocal,
+                                            batch_size=int(os.getenv("MEASUREMENT_SPOOL_BATCH_SIZE", 1000)),
+                                            versions=versions)
+        _spool_flusher.start()
+
+
+@app.on_event("shutdown")
+def stop_spool_flusher():
+    if _spool_flusher:
+        _spool_flusher.stop()
+
+
 # TODO: SSL/HTTPS is not set up
 # TODO: Authentication is not set up. We assume that only 1 hospital uses our service, so patient_id is unique only under this hospital.
 
 # Example of slow endpoint
 @app.post("/v0/measurements", response_model=None, status_code=status.HTTP_201_CREATED)
-def handle_measurement(m: MeasurementIn, db: Session = Depends(get_db)):
+def handle_measurement(m: MeasurementIn, db: Session = Depends(get_db),
+                       versions: PatientVersionRedisStore = Depends(get_patient_versions),
+                       ranking: ReadmissionRanking = Depends(get_readmission_ranking)):
     """
         Save a measurement to the database and calculate the probability of readmission based on data in the database.
     """
@@ -42,6 +115,8 @@ def handle_measurement(m: MeasurementIn, db: Session = Depends(get_db)):
         patient_repo=PatientSQLiteRepository(db),
         measurement_repo=MeasurementSQLiteRepository(db),
         prediction_model=SlowReadmissionPredictionModel(measurement_repo=MeasurementSQLiteRepository(db)),
+        versions=versions,
+        ranking=ranking,
     )
     try:
         measurement_service.save_measurement(measurement=m)
@@ -50,30 +125,109 @@ def handle_measurement(m: MeasurementIn, db: Session = Depends(get_db)):
     return
 
 
-@app.post("/v1/measurements", response_model=None, status_code=status.HTTP_201_CREATED)
+@app.post("/v1/measurements", response_model=None, status_code=status.HTTP_201_CREATED,
+          responses={202: {"description": "Accepted to the write-behind spool"}})
 def handle_measurement(m: MeasurementIn,
+                       response: Response,
                        db: Session = Depends(get_db),
-                       cache: redis.Redis = Depends(get_cache)
+                       cache: FastReadmissionCache = Depends(get_fast_readmission_cache),
+                       spool: MeasurementSpool = Depends(get_measurement_spool),
+                       versions: PatientVersionRedisStore = Depends(get_patient_versions),
+                       ranking: ReadmissionRanking = Depends(get_readmission_ranking),
                        ):
     """
     Save a measurement to the database and calculate the probability of readmission based on data in the cache.
+    In write-behind mode the measurement is saved to the database later and the response is 202.
     """
     measurement_service = MeasurementService(
         patient_repo=PatientSQLiteRepository(db),
         measurement_repo=MeasurementSQLiteRepository(db),
-        prediction_model=FastReadmissionPredictionModel(cache=FastReadmissionRedisCache(redis_client=cache)),
+        prediction_model=ResilientReadmissionPredictionModel(cache=cache,
+                                                            measurement_repo=MeasurementSQLiteRepository(db)),
+        spool=spool,
+        versions=versions,
+        ranking=ranking,
     )
     try:
         measurement_service.save_measurement(measurement=m)
     except PatientNotFoundException:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {m.patient_id} not found")
+    if spool:
+        response.status_code = status.HTTP_202_ACCEPTED
     return
 
 
+@app.post("/v2/measurements", response_model=None, status_code=status.HTTP_201_CREATED)
+async def handle_measurement_async(m: MeasurementIn,
+                                   db: AsyncSession = Depends(get_async_db),
+                                   cache: AsyncFastReadmissionCache = Depends(get_async_fast_readmission_cache),
+                                   versions: AsyncPatientVersionRedisStore = Depends(get_async_patient_versions),
+                                   ranking: AsyncReadmissionRanking = Depends(get_async_readmission_ranking),
+                                   ):
+    """
+    The same as /v1/measurements, but with async database and Redis clients, so it runs on the event loop
+    instead of the threadpool.
+    """
+    measurement_service = AsyncMeasurementService(
+        patient_repo=PatientAsyncSQLiteRepository(db),
+        measurement_repo=MeasurementAsyncSQLiteRepository(db),
+        prediction_model=AsyncResilientReadmissionPredictionModel(cache=cache,
+                                                                 measurement_repo=MeasurementAsyncSQLiteRepository(db)),
+        versions=versions,
+        ranking=ranking,
+    )
+    try:
+        await measurement_service.save_measurement(measurement=m)
+    except PatientNotFoundException:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {m.patient_id} not found")
+    return
+
+
+@app.post("/v1/measurements:batch", response_model=MeasurementBatchOut, status_code=status.HTTP_200_OK,
+          openapi_extra={"requestBody": {"content": {
+              "application/json": {"schema": {"type": "array", "items": MeasurementIn.schema()}},
+              "application/x-ndjson": {"schema": {"type": "string"}},
+          }, "required": True}})
+def handle_measurements_batch(batch: list = Depends(measurement_batch),
+                              db: Session = Depends(get_db),
+                              cache: FastReadmissionCache = Depends(get_fast_readmission_cache),
+                              spool: MeasurementSpool = Depends(get_measurement_spool),
+                              versions: PatientVersionRedisStore = Depends(get_patient_versions),
+                              ranking: ReadmissionRanking = Depends(get_readmission_ranking),
+                              ):
+    """
+    Save a batch of measurements(JSON array or NDJSON) in one transaction and calculate the probability of
+    readmission for each of them based on data in the cache. Returns the status of every item.
+    In write-behind mode created items are in the spool and saved to the database later.
+    """
+    measurement_service = MeasurementService(
+        patient_repo=PatientSQLiteRepository(db),
+        measurement_repo=MeasurementSQLiteRepository(db),
+        prediction_model=ResilientReadmissionPredictionModel(cache=cache,
+                                                            measurement_repo=MeasurementSQLiteRepository(db)),
+        spool=spool,
+        versions=versions,
+        ranking=ranking,
+    )
+    valid = [(index, m) for index, m in batch if isinstance(m, MeasurementIn)]
+    saved = measurement_service.save_measurements([m for _, m in valid])
+
+    items = [MeasurementBatchItemOut(index=index, status=MeasurementBatchItemStatus.INVALID, detail=m)
+             for index, m in batch if not isinstance(m, MeasurementIn)]
+    for (index, _), item in zip(valid, saved):
+        item.index = index
+        items.append(item)
+    items.sort(key=lambda item: item.index)
+
+    created = sum(1 for item in items if item.status == MeasurementBatchItemStatus.CREATED)
+    return MeasurementBatchOut(created=created, failed=len(items) - created, items=items)
+
+
 @app.post("/v1/patients/", response_model=PatientOut, status_code=status.HTTP_201_CREATED)
 def save_patient(p: PatientIn,
-                 db: Session = Depends(get_db)):
-    svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+                 db: Session = Depends(get_db),
+                 versions: PatientVersionRedisStore = Depends(get_patient_versions)):
+    svc = PatientService(patient_repo=PatientSQLiteRepository(db), versions=versions)
     try:
         created_patient = svc.save_patient(patient=p)
     except PatientAlreadyExistsException:
@@ -82,8 +236,14 @@ def save_patient(p: PatientIn,
 
 
 @app.post("/v1/patients/{patient_id}/admissions", response_model=AdmissionOut, status_code=status.HTTP_201_CREATED)
-def save_admission(patient_id: int, admission: AdmissionIn, db: Session = Depends(get_db)):
-    svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+def save_admission(patient_id: int, admission: AdmissionIn, db: Session = Depends(get_db),
+                   versions: PatientVersionRedisStore = Depends(get_patient_versions),
+                   ranking: ReadmissionRanking = Depends(get_readmission_ranking)):
+    """
+    An admission with a discharge date removes the patient from the readmission ranking, a later admission without
+    one brings them back
+    """
+    svc = PatientService(patient_repo=PatientSQLiteRepository(db), versions=versions, ranking=ranking)
     try:
         return svc.save_admission(patient_id=patient_id, admission=admission)
     except PatientNotFoundException:
@@ -93,19 +253,23 @@ def save_admission(patient_id: int, admission: AdmissionIn, db: Session = Depend
 @app.get("/v1/patients/{patient_id}/admissions", response_model=PaginationResponse[AdmissionOut])
 def get_admissions(patient_id: int,
                    pagination: PaginationParams = Depends(PaginationParams),
-                   db: Session = Depends(get_db)):
-    svc = PatientService(patient_repo=PatientSQLiteRepository(db))
-    try:
-        svc.get_patient(patient_id=patient_id)
-    except PatientNotFoundException:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} is not found")
-    items = svc.get_admissions(patient_id=patient_id, offset=pagination.offset, limit=pagination.limit)
-    response = {}
-    response.update({"total": len(items)})
-    response.update({"limit": pagination.limit})
-    response.update({"offset": pagination.offset})
-    response.update({"items": items})
-    return response
+                   db: Session = Depends(get_db),
+                   conditional_get: ConditionalGet = Depends(patient_conditional_get)):
+    def read():
+        svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+        try:
+            svc.get_patient(patient_id=patient_id)
+        except PatientNotFoundException:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} is not found")
+        items = svc.get_admissions(patient_id=patient_id, offset=pagination.offset, limit=pagination.limit)
+        response = {}
+        response.update({"total": len(items)})
+        response.update({"limit": pagination.limit})
+        response.update({"offset": pagination.offset})
+        response.update({"items": items})
+        return response
+
+    return conditional_get.respond(read, PaginationResponse[AdmissionOut])
 
 
 @app.get("/v1/patients/}", response_model=PaginationResponse[PatientOut])
@@ -123,20 +287,112 @@ def get_patients(db: Session = Depends(get_db),
 
 
 @app.get("/v1/patients/{patient_id}", response_model=PatientOut)
-def get_patient(patient_id: int, db: Session = Depends(get_db)):
-    svc = PatientService(patient_repo=PatientSQLiteRepository(db))
-    try:
-        return svc.get_patient(patient_id=patient_id)
-    except PatientNotFoundException:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
+def get_patient(patient_id: int, db: Session = Depends(get_db),
+                conditional_get: ConditionalGet = Depends(patient_conditional_get)):
+    def read():
+        svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+        try:
+            return svc.get_patient(patient_id=patient_id)
+        except PatientNotFoundException:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
+
+    return conditional_get.respond(read, PatientOut)
+
+
+def measurement_out(item) -> MeasurementOut:
+    if isinstance(item, models.MeasurementRollup):
+        return MeasurementOut(id=None, patient_id=item.patient_id, time_created=item.hour, type=item.type,
+                              value=item.mean, count=item.count, rollup=True)
+    return MeasurementOut.from_orm(item)
 
 
 @app.get("/v1/patients/{patient_id}/measurements/{measurement_type}", response_model=PaginationResponse[MeasurementOut])
 def get_patient_measurements(patient_id: int, measurement_type: MeasurementType,
                              pagination: PaginationParams = Depends(PaginationParams),
-                             db: Session = Depends(get_db)):
+                             db: Session = Depends(get_db),
+                             conditional_get: ConditionalGet = Depends(patient_conditional_get)):
+    """
+    Get all measurements of a patient by measurement type. Hours compacted by retention are items with
+    `rollup` true, counted once in `total`.
+    """
+    def read():
+        svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+        try:
+            svc.get_patient(patient_id=patient_id)
+        except PatientNotFoundException:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
+
+        svc2 = MeasurementService(patient_repo=PatientSQLiteRepository(db),
+                                  measurement_repo=MeasurementSQLiteRepository(db), prediction_model=None)
+        # One extra item tells if there is a next page
+        its = svc2.measurement_repo.get_measurement_history(
+            patient_id=patient_id,
+            measurement_type=measurement_type,
+            offset=pagination.offset,
+            limit=pagination.limit + 1,
+            before=pagination.before,
+        )
+        items = []
+        if len(its) > 0:
+            items = [measurement_out(m) for m in its[:pagination.limit]]
+
+        response = {}
+        response.update({"total": svc2.measurement_repo.count_measurements(patient_id, measurement_type) +
+                                  svc2.measurement_repo.count_measurement_rollups(patient_id, measurement_type)})
+        response.update({"limit": pagination.limit})
+        response.update({"offset": pagination.offset})
+        response.update({"next_cursor": next_cursor(its, pagination.limit, history_key)})
+        response.update({"items": items})
+        return response
+
+    return conditional_get.respond(read, PaginationResponse[MeasurementOut])
+
+
+@app.get("/v1/patients/{patient_id}/measurements/{measurement_type}/hourly",
+         response_model=List[MeasurementHourlyOut])
+def get_patient_hourly_measurements(patient_id: int, measurement_type: MeasurementType,
+                                    since: Optional[datetime.datetime] = None,
+                                    until: Optional[datetime.datetime] = None,
+                                    db: Session = Depends(get_db),
+                                    conditional_get: ConditionalGet = Depends(patient_conditional_get)):
+    """
+    Hourly aggregates of a patient's measurements by type in [since, until), oldest hour first.
+    Compacted hours come from rollups, recent hours are aggregated from raw measurements.
+    """
+    def read():
+        svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+        try:
+            svc.get_patient(patient_id=patient_id)
+        except PatientNotFoundException:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
+
+        hours = MeasurementSQLiteRepository(db).get_hourly_measurements(patient_id, measurement_type.value, since,
+                                                                        until)
+        return [MeasurementHourlyOut.from_orm(h) for h in hours]
+
+    return conditional_get.respond(read, List[MeasurementHourlyOut])
+
+
+EXPORT_RESPONSES = {200: {"content": {media_type: {} for media_type in MEDIA_TYPES.values()}}}
+
+
+def export_response(chunks, export_format: ExportFormat, filename: str) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[export_format], headers={
+        "Content-Disposition": f'attachment; filename="{filename}.{export_format.value}"'})
+
+
+@app.get("/v1/patients/{patient_id}/measurements:export", response_class=StreamingResponse,
+         responses=EXPORT_RESPONSES)
+def export_patient_measurements(patient_id: int,
+                                measurement_type: Optional[MeasurementType] = Query(None, alias="type"),
+                                since: Optional[datetime.datetime] = None,
+                                until: Optional[datetime.datetime] = None,
+                                export_format: ExportFormat = Query(ExportFormat.NDJSON, alias="format"),
+                                db: Session = Depends(get_db)):
     """
-    Get all measurements of a patient by measurement type
+    Streams all measurements of a patient in [since, until), oldest first, optionally of one type,
+    as NDJSON or CSV. Compacted hours are rows with `rollup` true. Memory doesn't depend on the length of
+    the history.
     """
     svc = PatientService(patient_repo=PatientSQLiteRepository(db))
     try:
@@ -144,24 +400,9 @@ def get_patient_measurements(patient_id: int, measurement_type: MeasurementType,
     except PatientNotFoundException:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
 
-    svc2 = MeasurementService(patient_repo=PatientSQLiteRepository(db),
-                              measurement_repo=MeasurementSQLiteRepository(db))
-    its = svc2.measurement_repo.get_all_measurements(
-        patient_id=patient_id,
-        measurement_type=measurement_type,
-        offset=pagination.offset,
-        limit=pagination.limit
-    )
-    items = []
-    if len(its) > 0:
-        items = [MeasurementOut.from_orm(m) for m in its]
-
-    response = {}
-    response.update({"total": len(items)})
-    response.update({"limit": pagination.limit})
-    response.update({"offset": pagination.offset})
-    response.update({"items": items})
-    return response
+    statement = measurements_query(patient_id, measurement_type.value if measurement_type else None, since, until)
+    return export_response(export_chunks(SessionLocal, statement, MEASUREMENT_COLUMNS, export_format), export_format,
+                           f"patient-{patient_id}-measurements")
 
 
 @app.get("/v1/patients/{patient_id}/readmission-probability",
@@ -169,31 +410,126 @@ def get_patient_measurements(patient_id: int, measurement_type: MeasurementType,
 def get_patient_readmission_probability(
         patient_id: int,
         pagination: PaginationParams = Depends(PaginationParams),
-        db: Session = Depends(get_db)
+        db: Session = Depends(get_db),
+        conditional_get: ConditionalGet = Depends(patient_conditional_get),
 ):
     """
     Get the readmission probabilities for a patient over time.
     """
+    def read():
+        svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+        try:
+            p = svc.get_patient(patient_id=patient_id)
+        except PatientNotFoundException:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
+
+        svc2 = MeasurementService(patient_repo=PatientSQLiteRepository(db),
+                                  measurement_repo=MeasurementSQLiteRepository(db), prediction_model=None)
+        its = svc2.measurement_repo.get_all_predictions(patient_id=patient_id, offset=pagination.offset,
+                                                        limit=pagination.limit + 1, before=pagination.before)
+        items = []
+        if its and len(its) > 0:
+            items = [ReadmissionProbabilityOut.from_orm(m) for m in its[:pagination.limit]]
+
+        response = {}
+        response.update({"total": svc2.measurement_repo.count_predictions(patient_id)})
+        response.update({"limit": pagination.limit})
+        response.update({"offset": pagination.offset})
+        response.update({"next_cursor": next_cursor(its, pagination.limit,
+                                                    lambda p: (p.time_created, p.internal_id))})
+        response.update({"items": items})
+        return response
+
+    return conditional_get.respond(read, PaginationResponse[ReadmissionProbabilityOut])
+
+
+@app.get("/v1/patients/{patient_id}/readmission-probability:export", response_class=StreamingResponse,
+         responses=EXPORT_RESPONSES)
+def export_patient_readmission_probability(patient_id: int,
+                                           since: Optional[datetime.datetime] = None,
+                                           until: Optional[datetime.datetime] = None,
+                                           export_format: ExportFormat = Query(ExportFormat.NDJSON, alias="format"),
+                                           db: Session = Depends(get_db)):
+    """
+    Streams all readmission probabilities of a patient in [since, until), oldest first, as NDJSON or CSV.
+    """
     svc = PatientService(patient_repo=PatientSQLiteRepository(db))
     try:
-        p = svc.get_patient(patient_id=patient_id)
+        svc.get_patient(patient_id=patient_id)
     except PatientNotFoundException:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
 
-    svc2 = MeasurementService(patient_repo=PatientSQLiteRepository(db),
-                              measurement_repo=MeasurementSQLiteRepository(db), prediction_model=None)
-    its = svc2.measurement_repo.get_all_predictions(patient_id=patient_id, offset=pagination.offset,
-                                                    limit=pagination.limit)
-    items = []
-    if its and len(its) > 0:
-        items = [ReadmissionProbabilityOut.from_orm(m) for m in its]
+    statement = predictions_query(patient_id, since, until)
+    return export_response(export_chunks(SessionLocal, statement, PREDICTION_COLUMNS, export_format), export_format,
+                           f"patient-{patient_id}-readmission-probability")
 
-    response = {}
-    response.update({"total": len(items)})
-    response.update({"limit": pagination.limit})
-    response.update({"offset": pagination.offset})
-    response.update({"items": items})
-    return response
+
+@app.get("/v1/patients/{patient_id}/readmission-probability/latest", response_model=ReadmissionProbabilityOut)
+def get_patient_current_risk(patient_id: int, db: Session = Depends(get_db),
+                             conditional_get: ConditionalGet = Depends(patient_conditional_get)):
+    """
+    The latest readmission probability of a patient, one primary key lookup in current_risk
+    """
+    def read():
+        risks = MeasurementSQLiteRepository(db).get_current_risk([patient_id])
+        if risks:
+            return ReadmissionProbabilityOut.from_orm(risks[0])
+
+        svc = PatientService(patient_repo=PatientSQLiteRepository(db))
+        try:
+            svc.get_patient(patient_id=patient_id)
+        except PatientNotFoundException:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Patient {patient_id} not found")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Patient {patient_id} has no readmission probability yet")
+
+    return conditional_get.respond(read, ReadmissionProbabilityOut)
+
+
+@app.get("/v1/readmission-probability/latest", response_model=List[ReadmissionProbabilityOut])
+def get_current_risks(ids: List[int] = Depends(patient_ids), db: Session = Depends(get_db),
+                      conditional_get: ConditionalGet = Depends(patients_conditional_get)):
+    """
+    The latest readmission probabilities of many patients in one query, in the order of `ids`.
+    Patients without a probability are left out. The ETag covers the versions of all of them.
+    """
+    def read():
+        risks = {r.patient_id: r for r in MeasurementSQLiteRepository(db).get_current_risk(ids)}
+        return [ReadmissionProbabilityOut.from_orm(risks[patient_id]) for patient_id in ids if patient_id in risks]
+
+    return conditional_get.respond(read, List[ReadmissionProbabilityOut])
+
+
+@app.get("/v1/readmission-probability/top", response_model=List[ReadmissionProbabilityOut])
+def get_top_risks(k: int = Query(20, ge=1, le=MAX_PATIENT_IDS, description="Amount of patients"),
+                  ranking: ReadmissionRanking = Depends(get_readmission_ranking)):
+    """
+    The k admitted patients with the highest latest readmission probability, highest first.
+    Read from a ranking that is maintained with every prediction, so it doesn't depend on the amount of patients.
+    """
+    try:
+        risks = ranking.top(k)
+    except redis.RedisError:
+        logger.warning("Readmission ranking is not available", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="The readmission ranking is not available")
+    return [ReadmissionProbabilityOut.from_orm(r) for r in risks]
+
+
+@app.get("/admin/profiles", response_model=List[ProfileOut], dependencies=[Depends(admin_token)])
+def get_profiles(profiles: ProfileStore = Depends(get_profile_store)):
+    if profiles is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is disabled")
+    return [ProfileOut.from_orm(p) for p in profiles.list()]
+
+
+@app.get("/admin/profiles/{profile_id}", response_class=PlainTextResponse, dependencies=[Depends(admin_token)])
+def get_profile(profile_id: int, sort: str = Query("cumulative", regex="^(cumulative|tottime|ncalls)$"),
+                profiles: ProfileStore = Depends(get_profile_store)):
+    profile = profiles.get(profile_id) if profiles else None
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return profile.text(sort=sort)
 
 
 @app.get("/v1/")
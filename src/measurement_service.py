@@ -1,10 +1,16 @@
 import datetime
+from typing import List
 
 from src import schemas, models
-from src.measurements.prediction_model import ReadmissionPredictionModel
-from src.measurements.repository import MeasurementRepository
+from src.diagnostics import profiled
+from src.measurements.prediction_model import ReadmissionPredictionModel, AsyncReadmissionPredictionModel
+from src.measurements.ranking import ReadmissionRanking, AsyncReadmissionRanking
+from src.measurements.repository import MeasurementRepository, AsyncMeasurementRepository
+from src.measurements.write_behind import MeasurementSpool
+from src.metrics import stage
 from src.patient.exceptions import PatientNotFoundException
-from src.patient.repository import PatientRepository
+from src.patient.repository import PatientRepository, AsyncPatientRepository
+from src.patient.versions import PatientVersionRedisStore, AsyncPatientVersionRedisStore
 
 
 def get_timestamp_from_date_and_hour(day: str, hour: int) -> datetime.datetime:
@@ -19,27 +25,51 @@ class MeasurementService:
                  patient_repo: PatientRepository,
                  measurement_repo: MeasurementRepository,
                  prediction_model: ReadmissionPredictionModel,
+                 spool: MeasurementSpool = None,
+                 versions: PatientVersionRedisStore = None,
+                 ranking: ReadmissionRanking = None,
                  ):
+        """
+        With a spool, measurements and predictions are appended to it and written to the database later
+        by WriteBehindFlusher, which bumps the versions of the patients then.
+        The ranking of the patients most at risk is updated with every prediction.
+        """
         self.patient_repo = patient_repo
         self.measurement_repo = measurement_repo
         self.prediction_model = prediction_model
+        self.spool = spool
+        self.versions = versions
+        self.ranking = ranking
 
+    @profiled
     def save_measurement(self, measurement: schemas.MeasurementIn) -> None:
+        model = self.prediction_model.name
         # Check that patient exists
-        patient = self.patient_repo.get_by_id(patient_id=measurement.patient_id)
+        with stage("patient_lookup", model):
+            patient = self.patient_repo.get_by_id(patient_id=measurement.patient_id)
         if not patient:
             raise PatientNotFoundException(measurement.patient_id)
 
-        # TODO: Depending on latencies and availability requirements, this code block can be moved to a queue layer
+        new_measurement = self.new_measurement(measurement)
+        if self.spool:
+            probability = self.prediction_model.calculate(patient=patient, last_measurement=new_measurement)
+            prediction = models.ReadmissionPrediction(patient_id=measurement.patient_id,
+                                                      time_created=new_measurement.time_created,
+                                                      probability=probability)
+            with stage("spool_append", model):
+                try:
+                    self.spool.append([(new_measurement, prediction)])
+                except Exception:
+                    self.prediction_model.forget([measurement.patient_id])
+                    raise
+            if self.ranking:
+                with stage("post_write", model):
+                    self.ranking.update([prediction])
+            return
 
         # Save measurement to DB
-        new_measurement = models.Measurement(
-            patient_id=measurement.patient_id,
-            type=measurement.parameter.value,
-            value=measurement.value,
-            time_created=get_timestamp_from_date_and_hour(measurement.day, measurement.hour)
-        )
-        self.measurement_repo.save_measurement(new_measurement)
+        with stage("measurement_save", model):
+            self.measurement_repo.save_measurement(new_measurement)
 
         # Calculate probability of readmission
         # TODO: we need to check patients admissions, because measurements from prev admission can impact the outcome.
@@ -49,4 +79,116 @@ class MeasurementService:
                                                   time_created=new_measurement.time_created,
                                                   probability=probability)
         # Save the prediction to DB
-        self.measurement_repo.save_prediction(prediction)
+        with stage("prediction_save", model):
+            self.measurement_repo.save_prediction(prediction)
+        with stage("post_write", model):
+            if self.versions:
+                self.versions.bump([measurement.patient_id])
+            if self.ranking:
+                self.ranking.update([prediction])
+
+    @profiled
+    def save_measurements(self, measurements: List[schemas.MeasurementIn]) -> List[schemas.MeasurementBatchItemOut]:
+        """
+        Save a batch of measurements with their predictions.
+
+        Patients are resolved with one query, predictions are calculated in the order of the batch,
+        so the model sees the same sequence as with single requests, and everything is saved in one transaction.
+        """
+        patients = {p.id: p for p in self.patient_repo.get_by_ids(m.patient_id for m in measurements)}
+
+        results = []
+        new_measurements = []
+        predictions = []
+        for index, measurement in enumerate(measurements):
+            patient = patients.get(measurement.patient_id)
+            if not patient:
+                results.append(schemas.MeasurementBatchItemOut(
+                    index=index,
+                    status=schemas.MeasurementBatchItemStatus.PATIENT_NOT_FOUND,
+                    patient_id=measurement.patient_id,
+                    detail=PatientNotFoundException(measurement.patient_id).message,
+                ))
+                continue
+
+            new_measurement = self.new_measurement(measurement)
+            probability = self.prediction_model.calculate(patient=patient, last_measurement=new_measurement)
+            new_measurements.append(new_measurement)
+            predictions.append(models.ReadmissionPrediction(patient_id=measurement.patient_id,
+                                                            time_created=new_measurement.time_created,
+                                                            probability=probability))
+            results.append(schemas.MeasurementBatchItemOut(
+                index=index,
+                status=schemas.MeasurementBatchItemStatus.CREATED,
+                patient_id=measurement.patient_id,
+                probability=probability,
+            ))
+
+        try:
+            if new_measurements and self.spool:
+                self.spool.append(list(zip(new_measurements, predictions)))
+            elif new_measurements:
+                self.measurement_repo.save_measurements_with_predictions(new_measurements, predictions)
+        except Exception:
+            # The model has already applied the measurements, it must not keep the ones that weren't saved
+            self.prediction_model.forget({m.patient_id for m in new_measurements})
+            raise
+        if new_measurements and not self.spool and self.versions:
+            self.versions.bump(m.patient_id for m in new_measurements)
+        if predictions and self.ranking:
+            self.ranking.update(predictions)
+        return results
+
+    @staticmethod
+    def new_measurement(measurement: schemas.MeasurementIn) -> models.Measurement:
+        return models.Measurement(
+            patient_id=measurement.patient_id,
+            type=measurement.parameter.value,
+            value=measurement.value,
+            time_created=get_timestamp_from_date_and_hour(measurement.day, measurement.hour)
+        )
+
+
+class AsyncMeasurementService:
+    """
+    MeasurementService.save_measurement for the async ingestion path(/v2/measurements).
+    Waiting for the database and Redis doesn't hold a threadpool thread, so concurrency is limited by the
+    event loop instead of the size of the threadpool.
+    """
+
+    def __init__(self,
+                 patient_repo: AsyncPatientRepository,
+                 measurement_repo: AsyncMeasurementRepository,
+                 prediction_model: AsyncReadmissionPredictionModel,
+                 versions: AsyncPatientVersionRedisStore = None,
+                 ranking: AsyncReadmissionRanking = None,
+                 ):
+        self.patient_repo = patient_repo
+        self.measurement_repo = measurement_repo
+        self.prediction_model = prediction_model
+        self.versions = versions
+        self.ranking = ranking
+
+    @profiled
+    async def save_measurement(self, measurement: schemas.MeasurementIn) -> None:
+        model = self.prediction_model.name
+        with stage("patient_lookup", model):
+            patient = await self.patient_repo.get_by_id(patient_id=measurement.patient_id)
+        if not patient:
+            raise PatientNotFoundException(measurement.patient_id)
+
+        new_measurement = MeasurementService.new_measurement(measurement)
+        with stage("measurement_save", model):
+            await self.measurement_repo.save_measurement(new_measurement)
+
+        probability = await self.prediction_model.calculate(patient=patient, last_measurement=new_measurement)
+        prediction = models.ReadmissionPrediction(patient_id=measurement.patient_id,
+                                                  time_created=new_measurement.time_created,
+                                                  probability=probability)
+        with stage("prediction_save", model):
+            await self.measurement_repo.save_prediction(prediction)
+        with stage("post_write", model):
+            if self.versions:
+                await self.versions.bump([measurement.patient_id])
+            if self.ranking:
+                await self.ranking.update([prediction])
@@ -0,0 +1,314 @@
+"""
+Columnar archive of measurement and prediction history, for moving cold data out of the database.
+
+    python -m src.measurements.archive --since 2021-01-01 --until 2021-02-01 --out archive/2021-01.mca
+
+One file holds both tables of a time range. Every column is a raw little-endian numpy array, rows are ordered by
+patient and time:
+
+* `type` is dictionary-encoded to uint8 codes, the dictionary is in the footer
+* timestamps are deltas in microseconds from the previous row of the same patient, uint32 when they fit
+* the patient index(patient ids, first rows and first timestamps) is stored as columns too
+
+    MAGIC | columns, 64-byte aligned | footer JSON | footer length(uint64) | MAGIC
+
+MeasurementArchive memory-maps the file, a query reads only the index and the rows of one patient.
+"""
+import argparse
+import datetime
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from src import models
+from src.config.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"MCARCH01"
+ALIGNMENT = 64
+CHUNK_SIZE = 10000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Columns of every table besides time and the patient index
+TABLES = {
+    "measurements": {"id": "<i8", "type": "u1", "value": "<f8"},
+    "predictions": {"id": "<i8", "probability": "<f8"},
+}
+
+
+def to_micros(t: datetime.datetime) -> int:
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (t - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+class TableWriter:
+    """
+    Appends rows of one table, ordered by patient and time, to a temporary file per column
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.name = name
+        self.dtypes = dict(TABLES[name], time_delta="<i8")
+        self.files = {column: open(os.path.join(directory, f"{name}.{column}"), "wb") for column in self.dtypes}
+        self.buffers = {column: [] for column in self.dtypes}
+        self.index = {"patient_id": [], "start": [], "base_time": []}
+        self.types = {}
+        self.rows = 0
+        self.last = None
+        self.max_delta = 0
+
+    def add(self, patient_id: int, time_created: datetime.datetime, **values):
+        micros = to_micros(time_created)
+        if self.last is None or patient_id != self.last[0]:
+            if self.last is not None and patient_id < self.last[0]:
+                raise ValueError(f"Rows of {self.name} are not ordered by patient")
+            self.index["patient_id"].append(patient_id)
+            self.index["start"].append(self.rows)
+            self.index["base_time"].append(micros)
+            delta = 0
+        else:
+            delta = micros - self.last[1]
+            if delta < 0:
+                raise ValueError(f"Rows of {self.name} of patient {patient_id} are not ordered by time")
+        self.last = (patient_id, micros)
+        self.max_delta = max(self.max_delta, delta)
+
+        if "type" in values:
+            code = self.types.setdefault(values["type"], len(self.types))
+            if code > 255:
+                raise ValueError("More than 256 measurement types")
+            values["type"] = code
+        values["time_delta"] = delta
+        for column, buffer in self.buffers.items():
+            buffer.append(values[column])
+        self.rows += 1
+        if len(self.buffers["id"]) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        for column, buffer in self.buffers.items():
+            np.asarray(buffer, dtype=self.dtypes[column]).tofile(self.files[column])
+            buffer.clear()
+
+    def write_to(self, out) -> dict:
+        """
+        Copies the columns to the archive and returns the footer of the table
+        """
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.index["start"].append(self.rows)
+        columns = {}
+
+        def write_column(column: str, dtype: str, data=None, path: str = None):
+            out.write(b"\0" * (-out.tell() % ALIGNMENT))
+            columns[column] = {"offset": out.tell(), "dtype": dtype}
+            if data is not None:
+                out.write(np.asarray(data, dtype=dtype).tobytes())
+                columns[column]["length"] = len(data)
+            elif dtype == self.dtypes[column]:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+                columns[column]["length"] = self.rows
+            else:
+                with open(path, "rb") as f:
+                    while True:
+                        chunk = np.fromfile(f, dtype=self.dtypes[column], count=CHUNK_SIZE)
+                        if not len(chunk):
+                            break
+                        out.write(chunk.astype(dtype).tobytes())
+                columns[column]["length"] = self.rows
+
+        for column in TABLES[self.name]:
+            write_column(column, self.dtypes[column], path=self.files[column].name)
+        write_column("time_delta", "<u4" if self.max_delta < 2 ** 32 else "<i8", path=self.files["time_delta"].name)
+        write_column("index_patient_id", "<i8", data=self.index["patient_id"])
+        write_column("index_start", "<i8", data=self.index["start"])
+        write_column("index_base_time", "<i8", data=self.index["base_time"])
+        return {"rows": self.rows, "columns": columns,
+                "types": [t for t, _ in sorted(self.types.items(), key=lambda item: item[1])]}
+
+
+def write_archive(path: str, measurements: Iterable = (), predictions: Iterable = (),
+                  since: datetime.datetime = None, until: datetime.datetime = None) -> Dict[str, int]:
+    """
+    Writes rows with patient_id, time_created and the columns of TABLES(`internal_id` for predictions),
+    ordered by patient and time, to a new archive. Returns the amount of rows per table.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp:
+        tables = {name: TableWriter(tmp, name) for name in TABLES}
+        for m in measurements:
+            tables["measurements"].add(m.patient_id, m.time_created, id=m.id, type=m.type, value=m.value)
+        for p in predictions:
+            tables["predictions"].add(p.patient_id, p.time_created, id=p.internal_id, probability=p.probability)
+
+        with open(path + ".tmp", "wb") as out:
+            out.write(MAGIC)
+            footer = {"version": 1, "since": since.isoformat() if since else None,
+                      "until": until.isoformat() if until else None,
+                      "tables": {name: table.write_to(out) for name, table in tables.items()}}
+            footer = json.dumps(footer).encode()
+            out.write(footer + struct.pack("<Q", len(footer)) + MAGIC)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(path + ".tmp", path)
+    return {name: table.rows for name, table in tables.items()}
+
+
+def export_archive(db: Session, path: str, since: datetime.datetime = None, until: datetime.datetime = None,
+                   batch_size: int = CHUNK_SIZE) -> Dict[str, int]:
+    """
+    Streams measurements and predictions created in [since, until) from the database to an archive
+    """
+
+    def rows(model, id_column):
+        query = select(model.patient_id, model.time_created, id_column, *[
+            getattr(model, c) for c in ("type", "value", "probability") if hasattr(model, c)])
+        if since:
+            query = query.where(model.time_created >= since)
+        if until:
+            query = query.where(model.time_created < until)
+        query = query.order_by(model.patient_id, model.time_created, id_column)
+        yield from db.execute(query.execution_options(yield_per=batch_size))
+
+    return write_archive(path, rows(models.Measurement, models.Measurement.id),
+                         rows(models.ReadmissionPrediction, models.ReadmissionPrediction.internal_id), since, until)
+
+
+class MeasurementArchive:
+    """
+    Read-only view of an archive with the queries of MeasurementRepository. Columns are numpy arrays over
+    the memory-mapped file, so only the pages of the requested patient are read.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        tail = len(MAGIC) + 8
+        if self.mm[:len(MAGIC)] != MAGIC or self.mm[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a measurement archive")
+        (footer_length,) = struct.unpack("<Q", self.mm[-tail:-len(MAGIC)])
+        self.footer = json.loads(self.mm[-tail - footer_length:-tail])
+        self.columns = {}
+
+    def column(self, table: str, name: str) -> np.ndarray:
+        key = (table, name)
+        if key not in self.columns:
+            c = self.footer["tables"][table]["columns"][name]
+            self.columns[key] = np.frombuffer(self.mm, dtype=c["dtype"], count=c["length"], offset=c["offset"])
+        return self.columns[key]
+
+    def patient_ids(self, table: str = "measurements") -> List[int]:
+        return self.column(table, "index_patient_id").tolist()
+
+    def patient_rows(self, table: str, patient_id: int) -> (int, int, np.ndarray):
+        """
+        Returns the first and the end row of the patient and timestamps of the rows in microseconds
+        """
+        ids = self.column(table, "index_patient_id")
+        i = int(np.searchsorted(ids, patient_id))
+        if i == len(ids) or ids[i] != patient_id:
+            return 0, 0, np.empty(0, dtype=np.int64)
+        starts = self.column(table, "index_start")
+        (start, stop) = (int(starts[i]), int(starts[i + 1]))
+        times = np.cumsum(self.column(table, "time_delta")[start:stop], dtype=np.int64)
+        return start, stop, times + self.column(table, "index_base_time")[i]
+
+    def page(self, table: str, patient_id: int, mask, offset: int, limit: int,
+             before: Tuple[datetime.datetime, int]) -> (np.ndarray, np.ndarray):
+        """
+        Row numbers and timestamps of a page of a patient's rows, newest first like the repository queries.
+        `mask` filters the rows of the patient.
+        """
+        (start, stop, times) = self.patient_rows(table, patient_id)
+        rows = np.arange(start, stop)
+        if mask is not None:
+            keep = mask(start, stop)
+            (rows, times) = (rows[keep], times[keep])
+        ids = self.column(table, "id")[rows]
+        # Rows are ordered by time and id, newest first is the reverse
+        (rows, times, ids) = (rows[::-1], times[::-1], ids[::-1])
+        if before:
+            before_micros = to_micros(before[0])
+            keep = (times < before_micros) | ((times == before_micros) & (ids < before[1]))
+            (rows, times) = (rows[keep], times[keep])
+            offset = 0
+        return rows[offset:offset + limit], times[offset:offset + limit]
+
+    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100,
+                             before: Tuple[datetime.datetime, int] = None) -> List[models.Measurement]:
+        mask = None
+        if measurement_type:
+            types = self.footer["tables"]["measurements"]["types"]
+            if measurement_type not in types:
+                return []
+            code = types.index(measurement_type)
+
+            def mask(start: int, stop: int) -> np.ndarray:
+                return self.column("measurements", "type")[start:stop] == code
+        (rows, times) = self.page("measurements", patient_id, mask, offset, limit, before)
+        types = self.footer["tables"]["measurements"]["types"]
+        (ids, codes, values) = (self.column("measurements", c)[rows].tolist() for c in ("id", "type", "value"))
+        return [models.Measurement(id=i, patient_id=patient_id, type=types[code], value=value,
+                                   time_created=from_micros(t))
+                for i, code, value, t in zip(ids, codes, values, times.tolist())]
+
+    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100,
+                            before: Tuple[datetime.datetime, int] = None) -> List[models.ReadmissionPrediction]:
+        (rows, times) = self.page("predictions", patient_id, None, offset, limit, before)
+        (ids, probabilities) = (self.column("predictions", c)[rows].tolist() for c in ("id", "probability"))
+        return [models.ReadmissionPrediction(internal_id=i, patient_id=patient_id, probability=probability,
+                                             time_created=from_micros(t))
+                for i, probability, t in zip(ids, probabilities, times.tolist())]
+
+    def close(self):
+        # Arrays over the map have to go first
+        self.columns.clear()
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--batch-size", type=int, default=CHUNK_SIZE, help="Rows fetched from the database at once")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    start = time.monotonic()
+    try:
+        rows = export_archive(db, args.out, args.since, args.until, args.batch_size)
+    finally:
+        db.close()
+    print(f"exported {rows['measurements']} measurements and {rows['predictions']} predictions "
+          f"to {args.out}({os.path.getsize(args.out)} bytes) in {time.monotonic() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Imports patients, admissions and signals from CSV files straight into the database, without the HTTP API.
+Meant for backfills and disaster recovery of millions of signals.
+
+    python -m src.measurements.bulk_import --data-dir data
+
+* Rows are inserted with executemany in chunks, inside transactions of --transaction-size rows.
+* Predictions of the imported signals are calculated afterwards, in one pass per patient ordered by time,
+  with the same math as the fast model.
+* The fast model cache is seeded with the final state of every imported patient. States cached before
+  the import don't include the imported signals, they are replaced.
+* A rerun after a failure skips the rows and predictions that are already stored.
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import logging
+import os
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, List
+
+import redis
+from sqlalchemy import insert, select, func
+from sqlalchemy.engine import Connection, Engine
+
+from src import models
+from src.config.cache import get_connection_pool
+from src.config.database import engine as default_engine, SessionLocal
+from src.measurements.cache import FastReadmissionRedisCache, to_timestamp
+from src.measurements.prediction_math import calculate_probability_v1
+from src.measurements.repository import increment_counters_statement, rollup_aggregates_query, aggregates_from_rows, \
+    upsert_current_risk_statement, current_risk_rows
+from src.measurements.prediction_model_fast import FastReadmissionState, FastReadmissionCache, apply_measurement, \
+    STATE_PARTS
+from src.measurements.prediction_model_resilient import state_from_aggregates
+from src.measurements.ranking import ReadmissionRanking, rebuild_ranking
+from src.measurement_service import get_timestamp_from_date_and_hour
+from src.patient.versions import PatientVersionRedisStore
+from src.schemas import MeasurementType
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10000
+
+
+def read_csv(path: str) -> Iterable[dict]:
+    with open(path, "r") as f:
+        yield from csv.DictReader(f, delimiter=";")
+
+
+def chunks(rows: Iterable, size: int) -> Iterable[list]:
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert_rows(engine: Engine, table, rows: Iterable[dict], transaction_size: int,
+                counter: Callable[[dict], str] = None) -> int:
+    """
+    Inserts rows with executemany, CHUNK_SIZE rows per statement and transaction_size rows per transaction.
+    With `counter`, the patient counter it returns for a row is incremented in the same transaction.
+    """
+    inserted = 0
+    for transaction in chunks(rows, transaction_size):
+        with engine.begin() as conn:
+            for chunk in chunks(transaction, CHUNK_SIZE):
+                conn.execute(insert(table), chunk)
+            if counter:
+                increment_counters(conn, Counter((row["patient_id"], counter(row)) for row in transaction))
+        inserted += len(transaction)
+        logger.info("Inserted %d rows into %s", inserted, table.name)
+    return inserted
+
+
+def import_patients(engine: Engine, path: str, transaction_size: int) -> int:
+    with engine.connect() as conn:
+        existing = set(conn.execute(select(models.Patient.id)).scalars())
+    rows = ({"id": int(row["pat_id"]), "age": round(float(row["age"]))} for row in read_csv(path))
+    return insert_rows(engine, models.Patient.__table__, (r for r in rows if r["id"] not in existing),
+                       transaction_size)
+
+
+def import_admissions(engine: Engine, path: str, transaction_size: int) -> int:
+    """
+    Admissions that already exist(the same patient and admission date) are skipped, so the import can be rerun
+    after a partial failure
+    """
+    a = models.Admission
+    with engine.connect() as conn:
+        existing = set(conn.execute(select(a.patient_id, a.date_admission)).all())
+
+    def parse(day: str):
+        return datetime.datetime.strptime(day, '%d/%m/%Y') if day else None
+
+    def rows():
+        for row in read_csv(path):
+            admission = (int(row["pat_id"]), parse(row["date_admission"]))
+            if admission in existing:
+                continue
+            existing.add(admission)
+            yield {"patient_id": admission[0], "date_admission": admission[1],
+                   "date_discharge": parse(row["date_discharge"])}
+
+    return insert_rows(engine, a.__table__, rows(), transaction_size)
+
+
+def import_signals(engine: Engine, path: str, transaction_size: int) -> (int, List[int]):
+    """
+    Inserts signals of known patients, returns the amount of inserted signals and the patients of the file.
+    Signals that are already stored(the same patient, type and time) are skipped, as many times as they are stored.
+    """
+    m = models.Measurement
+    with engine.connect() as conn:
+        patients = set(conn.execute(select(models.Patient.id)).scalars())
+        existing = Counter((patient_id, measurement_type, to_timestamp(time_created)) for
+                           (patient_id, measurement_type, time_created) in
+                           conn.execute(select(m.patient_id, m.type, m.time_created)))
+    types = {t.value for t in MeasurementType}
+    imported_patients = set()
+
+    def rows():
+        for row in read_csv(path):
+            patient_id = int(row["pat_id"])
+            if patient_id not in patients or row["parameter"] not in types:
+                logger.debug("Skipping signal %s", row)
+                continue
+            imported_patients.add(patient_id)
+            time_created = get_timestamp_from_date_and_hour(row["day"], int(row["hour"]))
+            key = (patient_id, row["parameter"], to_timestamp(time_created))
+            if existing[key]:
+                existing[key] -= 1
+                continue
+            yield {
+                "patient_id": patient_id,
+                "type": row["parameter"],
+                "value": float(row["value"]),
+                "time_created": time_created,
+            }
+
+    inserted = insert_rows(engine, m.__table__, rows(), transaction_size, counter=lambda row: row["type"])
+    return inserted, sorted(imported_patients)
+
+
+def increment_counters(conn: Connection, counts: Counter):
+    conn.execute(increment_counters_statement(conn.dialect.name),
+                 [{"patient_id": patient_id, "name": name, "value": value} for (patient_id, name), value in
+                  counts.items()])
+
+
+def calculate_predictions(engine: Engine, patient_ids: Iterable[int], patients_per_pass: int = 1000) -> Dict[
+    int, FastReadmissionState]:
+    """
+    Calculates predictions of the patients' measurements that don't have one yet and returns the final state of
+    every patient. Measurements of a patient are applied in the order of time, the ones with a prediction of
+    their time only restore the state, so a rerun continues where a failed one stopped.
+    """
+    with engine.connect() as conn:
+        ages = dict(conn.execute(select(models.Patient.id, models.Patient.age)).all())
+
+    states = {}
+    for patient_chunk in chunks(sorted(patient_ids), patients_per_pass):
+        with engine.begin() as conn:
+            predictions = calculate_chunk(conn, patient_chunk, ages, states)
+            for chunk in chunks(predictions, CHUNK_SIZE):
+                conn.execute(insert(models.ReadmissionPrediction.__table__), chunk)
+            if predictions:
+                increment_counters(conn, Counter((p["patient_id"], models.PREDICTIONS_COUNTER) for p in predictions))
+                conn.execute(upsert_current_risk_statement(conn.dialect.name),
+                             current_risk_rows(SimpleNamespace(**p) for p in predictions))
+        logger.info("Calculated predictions of %d patients", len(states))
+    return states
+
+
+def calculate_chunk(conn: Connection, patient_ids: List[int], ages: Dict[int, int],
+                    states: Dict[int, FastReadmissionState]) -> List[dict]:
+    # Compacted measurements are only in the hourly rollups, they are the starting state
+    rollups = aggregates_from_rows(conn.execute(rollup_aggregates_query(patient_ids)).all())
+    states.update((patient_id, state_from_aggregates(a)) for patient_id, a in rollups.items())
+
+    p = models.ReadmissionPrediction
+    predicted = Counter((patient_id, to_timestamp(time_created)) for (patient_id, time_created) in
+                        conn.execute(select(p.patient_id, p.time_created).where(p.patient_id.in_(patient_ids))))
+    m = models.Measurement
+    rows = conn.execute(select(m.id, m.patient_id, m.type, m.value, m.time_created).where(
+        m.patient_id.in_(patient_ids)).order_by(m.patient_id, m.time_created, m.id))
+    predictions = []
+    for row in rows:
+        state = states.setdefault(row.patient_id, FastReadmissionState())
+        (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = apply_measurement(state, row)
+        key = (row.patient_id, to_timestamp(row.time_created))
+        if predicted[key]:
+            predicted[key] -= 1
+            continue
+        predictions.append({
+            "patient_id": row.patient_id,
+            "time_created": row.time_created,
+            "probability": calculate_probability_v1(
+                age=ages[row.patient_id],
+                last_blood_pressure=last_blood_pressure,
+                mean_respiratory_rate=mean_respiratory_rate,
+                standard_deviation_temperature=standard_deviation_temperature,
+            ),
+        })
+    return predictions
+
+
+def seed_cache(cache: FastReadmissionCache, states: Dict[int, FastReadmissionState], replace: bool = False,
+               batch_size: int = 1000):
+    """
+    Saves the states to the cache.
+
+    Without `replace`, cached states of the patients are deleted first and the states are saved only where nothing
+    is cached then. A worker that scores a measurement in between restores the state from the database, which
+    already has the imported signals, and the seed doesn't overwrite it.
+    With `replace` the states are overwritten, updates of running workers since the import can be lost.
+    """
+    for batch in chunks(states.items(), batch_size):
+        if replace:
+            for patient_id, state in batch:
+                state.changed = set(STATE_PARTS)
+                cache.save_state(patient_id, state)
+        else:
+            cache.delete_states(patient_id for patient_id, _ in batch)
+            cache.seed_states(dict(batch))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--only", choices=["patients", "admissions", "signals"], action="append",
+                        help="Import only these files, can be repeated. All files by default")
+    parser.add_argument("--transaction-size", type=int, default=100000, help="Rows per transaction")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't seed the fast model cache and the readmission ranking")
+    parser.add_argument("--replace-cache", action="store_true",
+                        help="Overwrite cached states instead of deleting and seeding them. "
+                             "Don't use it while the API is running")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    only = args.only or ["patients", "admissions", "signals"]
+    start = time.monotonic()
+    if "patients" in only:
+        patients = import_patients(default_engine, os.path.join(args.data_dir, "age.csv"), args.transaction_size)
+        print(f"imported {patients} patients in {time.monotonic() - start:.2f} seconds")
+    if "admissions" in only:
+        start = time.monotonic()
+        admissions = import_admissions(default_engine, os.path.join(args.data_dir, "admission.csv"),
+                                       args.transaction_size)
+        print(f"imported {admissions} admissions in {time.monotonic() - start:.2f} seconds")
+    if "signals" in only:
+        start = time.monotonic()
+        (signals, patient_ids) = import_signals(default_engine, os.path.join(args.data_dir, "signal.csv"),
+                                                args.transaction_size)
+        states = calculate_predictions(default_engine, patient_ids)
+        print(f"imported {signals} signals of {len(states)} patients with predictions "
+              f"in {time.monotonic() - start:.2f} seconds")
+        if not args.no_cache:
+            cache = FastReadmissionRedisCache(redis_client=redis.Redis(connection_pool=get_connection_pool()))
+            seed_cache(cache, states, replace=args.replace_cache)
+    if not args.no_cache:
+        db = SessionLocal()
+        try:
+            rebuild_ranking(db, ReadmissionRanking(redis.Redis(connection_pool=get_connection_pool())))
+        finally:
+            db.close()
+    # Responses of conditional GETs cached by clients are out of date now
+    PatientVersionRedisStore(redis.Redis(connection_pool=get_connection_pool())).bump_all()
+
+
+if __name__ == "__main__":
+    main()
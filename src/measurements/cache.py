@@ -1,48 +1,530 @@
+import calendar
+import copy
+import datetime
 import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable
 
 import redis
+import redis.asyncio
 
 from src import models
-from src.measurements.prediction_model_fast import FastReadmissionCache
+from src.measurements.prediction_model_fast import FastReadmissionCache, FastReadmissionState, LAST_BLOOD_PRESSURE, \
+    MEAN_RESPIRATORY_RATE, STANDARD_DEVIATION_TEMPERATURE, STATE_PARTS, apply_measurement, AsyncFastReadmissionCache
+from src.metrics import FAST_CACHE_LRU_LOOKUPS
+from src.schemas import MeasurementType
+
+
+def to_timestamp(t: datetime.datetime) -> float:
+    """
+    Measurement timestamps without timezone are treated as UTC
+    """
+    if t.tzinfo is None:
+        return calendar.timegm(t.utctimetuple()) + t.microsecond / 1e6
+    return t.timestamp()
+
+
+def from_timestamp(ts: float) -> datetime.datetime:
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=ts)
 
 
 class FastReadmissionRedisCache(FastReadmissionCache):
+    """
+    Keeps the state of a patient in one Redis hash of numeric fields:
+    bp_value, bp_time(UTC timestamp), rr_mean, rr_count, t_mean, t_variance, t_count.
+
+    Earlier versions pickled every part of the state into its own key. Such keys are converted to the hash
+    the first time the patient's state is read, see migrate_legacy_state and migrate_all_legacy_states.
+    """
 
     def __init__(self, redis_client: redis.Redis):
         self.redis_client = redis_client
 
-    def get_last_blood_pressure(self, patient_id: int) -> models.Measurement:
-        key = f'patient:{patient_id}:last_blood_pressure'
-        read = self.redis_client.get(key)
+    def get_state(self, patient_id: int) -> FastReadmissionState:
+        # Legacy keys are read in the same round trip, so a patient without a state doesn't pay another one
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hgetall(self.key(patient_id))
+        pipe.mget(self.legacy_keys(patient_id))
+        (read, legacy) = pipe.execute()
         if not read:
+            return self.migrate_legacy_state(patient_id, legacy) or FastReadmissionState()
+        return self.new_state(patient_id, read)
+
+    def save_state(self, patient_id: int, state: FastReadmissionState):
+        mapping = self.state_fields(state)
+        if mapping:
+            self.redis_client.hset(self.key(patient_id), mapping=mapping)
+
+    def seed_state(self, patient_id: int, state: FastReadmissionState):
+        self.seed_states({patient_id: state})
+
+    def delete_states(self, patient_ids: Iterable[int]):
+        keys = [key for patient_id in patient_ids for key in (self.key(patient_id), *self.legacy_keys(patient_id))]
+        if keys:
+            self.redis_client.delete(*keys)
+
+    def seed_states(self, states: Dict[int, FastReadmissionState]):
+        # A state restored from the database must not overwrite one that a worker saved meanwhile
+        seed_script = self.redis_client.register_script(SEED_STATE_SCRIPT)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for patient_id, state in states.items():
+            state.changed = set(STATE_PARTS)
+            fields = self.state_fields(state)
+            seed_script(keys=[self.key(patient_id)], args=[v for item in fields.items() for v in item], client=pipe)
+        pipe.execute()
+
+    def get_last_blood_pressure(self, patient_id: int) -> models.Measurement:
+        (value, time_created) = self.redis_client.hmget(self.key(patient_id), 'bp_value', 'bp_time')
+        if value is None:
             return None
-        m = pickle.loads(read)
-        return m
+        return self.new_blood_pressure(patient_id, float(value), float(time_created))
 
     def save_last_blood_pressure(self, patient_id: int, measurement: models.Measurement):
-        key = f'patient:{patient_id}:last_blood_pressure'
-        self.redis_client.set(key, pickle.dumps(measurement))
+        self.redis_client.hset(self.key(patient_id), mapping=self.blood_pressure_fields(measurement))
 
     def get_mean_respiratory_rate(self, patient_id: int) -> (float, int):
-        key = f'patient:{patient_id}:mean_respiratory_rate'
-        val = self.redis_client.get(key)
-        if not val:
+        (mean, count) = self.redis_client.hmget(self.key(patient_id), 'rr_mean', 'rr_count')
+        if mean is None:
             return 0.0, 0
-        read = pickle.loads(val)
-        return read['mean'], read['count']
+        return float(mean), int(count)
 
-    def save_mean_respiratory_rate(self, patient_id: int, mean: float, count: int) -> (float, int):
-        key = f'patient:{patient_id}:mean_respiratory_rate'
-        self.redis_client.set(key, pickle.dumps({'mean': mean, 'count': count}))
+    def save_mean_respiratory_rate(self, patient_id: int, mean: float, count: int):
+        self.redis_client.hset(self.key(patient_id), mapping=self.respiratory_rate_fields(mean, count))
 
     def get_standard_deviation_temperature(self, patient_id: int) -> (float, float, int):
-        key = f'patient:{patient_id}:standard_deviation_temperature'
-        val = self.redis_client.get(key)
-        if not val:
+        (mean, variance, count) = self.redis_client.hmget(self.key(patient_id), 't_mean', 't_variance', 't_count')
+        if mean is None:
             return 0.0, 0.0, 0
-        read = pickle.loads(val)
-        return read['mean'], read['variance'], read['count']
+        return float(mean), float(variance), int(count)
+
+    def save_standard_deviation_temperature(self, patient_id: int, mean: float, variance: float, count: int):
+        self.redis_client.hset(self.key(patient_id), mapping=self.temperature_fields(mean, variance, count))
+
+    def migrate_legacy_state(self, patient_id: int, values: list = None) -> FastReadmissionState or None:
+        """
+        Converts the pickled keys of a patient to the hash and deletes them, `values` are the keys if they
+        were already read. Returns the converted state or None if the patient has no legacy keys.
+        """
+        legacy_keys = self.legacy_keys(patient_id)
+        if values is None:
+            values = self.redis_client.mget(legacy_keys)
+        state = self.state_from_legacy(patient_id, values)
+        if not state:
+            return None
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        FastReadmissionRedisCache(pipe).save_state(patient_id, state)
+        pipe.delete(*legacy_keys)
+        pipe.execute()
+        state.changed = set()
+        return state
+
+    def migrate_all_legacy_states(self) -> int:
+        """
+        Converts the pickled keys of all patients, returns the amount of converted patients.
+        """
+        suffixes = {key.split(':')[2] for key in self.legacy_keys(0)}
+        seen = set()
+        migrated = 0
+        # Legacy suffixes have an underscore, the state hashes and version keys don't match the pattern
+        for key in self.redis_client.scan_iter(match='patient:*:*_*', count=1000):
+            parts = key.decode().split(':')
+            if len(parts) != 3 or parts[2] not in suffixes or parts[1] in seen:
+                continue
+            seen.add(parts[1])
+            if self.migrate_legacy_state(int(parts[1])):
+                migrated += 1
+        return migrated
+
+    @classmethod
+    def state_from_legacy(cls, patient_id: int, values: list) -> FastReadmissionState or None:
+        """
+        Converts the values of the legacy keys, returns None if there are none
+        """
+        (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = values
+        if not (last_blood_pressure or mean_respiratory_rate or standard_deviation_temperature):
+            return None
+
+        state = FastReadmissionState()
+        if last_blood_pressure:
+            m = pickle.loads(last_blood_pressure)
+            state.last_blood_pressure = cls.new_blood_pressure(patient_id, m.value, to_timestamp(m.time_created))
+            state.changed.add(LAST_BLOOD_PRESSURE)
+        if mean_respiratory_rate:
+            read = pickle.loads(mean_respiratory_rate)
+            state.respiratory_rate_mean, state.respiratory_rate_count = read['mean'], read['count']
+            state.changed.add(MEAN_RESPIRATORY_RATE)
+        if standard_deviation_temperature:
+            read = pickle.loads(standard_deviation_temperature)
+            state.temperature_mean, state.temperature_variance, state.temperature_count = \
+                read['mean'], read['variance'], read['count']
+            state.changed.add(STANDARD_DEVIATION_TEMPERATURE)
+        return state
+
+    @staticmethod
+    def key(patient_id: int) -> str:
+        return f'patient:{patient_id}:state'
+
+    @staticmethod
+    def legacy_keys(patient_id: int) -> (str, str, str):
+        return (f'patient:{patient_id}:last_blood_pressure',
+                f'patient:{patient_id}:mean_respiratory_rate',
+                f'patient:{patient_id}:standard_deviation_temperature')
+
+    @classmethod
+    def state_fields(cls, state: FastReadmissionState) -> dict:
+        """
+        Returns the hash fields of the changed parts of the state
+        """
+        mapping = {}
+        if LAST_BLOOD_PRESSURE in state.changed and state.last_blood_pressure is not None:
+            mapping.update(cls.blood_pressure_fields(state.last_blood_pressure))
+        if MEAN_RESPIRATORY_RATE in state.changed:
+            mapping.update(cls.respiratory_rate_fields(state.respiratory_rate_mean, state.respiratory_rate_count))
+        if STANDARD_DEVIATION_TEMPERATURE in state.changed:
+            mapping.update(cls.temperature_fields(state.temperature_mean, state.temperature_variance,
+                                                  state.temperature_count))
+        return mapping
+
+    @staticmethod
+    def blood_pressure_fields(measurement: models.Measurement) -> dict:
+        # repr keeps all digits of a float, so the state round trips exactly
+        return {'bp_value': repr(float(measurement.value)), 'bp_time': repr(to_timestamp(measurement.time_created))}
+
+    @staticmethod
+    def respiratory_rate_fields(mean: float, count: int) -> dict:
+        return {'rr_mean': repr(float(mean)), 'rr_count': int(count)}
+
+    @staticmethod
+    def temperature_fields(mean: float, variance: float, count: int) -> dict:
+        return {'t_mean': repr(float(mean)), 't_variance': repr(float(variance)), 't_count': int(count)}
+
+    @classmethod
+    def new_state(cls, patient_id: int, read: dict) -> FastReadmissionState:
+        read = {k.decode(): float(v) for k, v in read.items()}
+        state = FastReadmissionState(
+            respiratory_rate_mean=read.get('rr_mean', 0.0),
+            respiratory_rate_count=int(read.get('rr_count', 0)),
+            temperature_mean=read.get('t_mean', 0.0),
+            temperature_variance=read.get('t_variance', 0.0),
+            temperature_count=int(read.get('t_count', 0)),
+        )
+        if 'bp_value' in read:
+            state.last_blood_pressure = cls.new_blood_pressure(patient_id, read['bp_value'], read['bp_time'])
+        return state
+
+    @staticmethod
+    def new_blood_pressure(patient_id: int, value: float, time_created: float) -> models.Measurement:
+        return models.Measurement(patient_id=patient_id, type=MeasurementType.BLOOD_PRESSURE.value, value=value,
+                                  time_created=from_timestamp(time_created))
+
+
+# The same updates as prediction_model_fast.apply_measurement, done by Redis itself, so concurrent workers
+# can't lose each other's updates. Numbers are passed as '%.17g' strings because Redis truncates Lua numbers
+# to integers on return and tostring() keeps only 14 digits.
+# If the patient has no state hash yet, the script returns without changes {'migrate'} when there are legacy
+# pickled keys to convert first, or {'cold'} when the caller asked to restore the state itself(ARGV[4] == '1').
+# Otherwise it returns the 3 inputs of the probability formula followed by the updated hash fields
+# (bp_value and bp_time are '' without a blood pressure), so a local copy can be refreshed without another read.
+UPDATE_STATE_SCRIPT = """
+local key = KEYS[1]
+local measurement_type = ARGV[1]
+local value = tonumber(ARGV[2])
+local time_created = tonumber(ARGV[3])
+local report_cold = ARGV[4] == '1'
+
+local function fmt(x)
+    return string.format('%.17g', x)
+end
+
+if redis.call('EXISTS', key) == 0 then
+    for i = 2, #KEYS do
+        if redis.call('EXISTS', KEYS[i]) == 1 then
+            return {'migrate'}
+        end
+    end
+    if report_cold then
+        return {'cold'}
+    end
+end
+
+local state = redis.call('HMGET', key, 'bp_value', 'bp_time', 'rr_mean', 'rr_count', 't_mean', 't_variance', 't_count')
+local bp_value = tonumber(state[1])
+local bp_time = tonumber(state[2])
+local rr_mean = tonumber(state[3]) or 0
+local rr_count = tonumber(state[4]) or 0
+local t_mean = tonumber(state[5]) or 0
+local t_variance = tonumber(state[6]) or 0
+local t_count = tonumber(state[7]) or 0
+
+local last_blood_pressure = bp_value or 0
+if measurement_type == 'blood_pressure' then
+    -- Compare-and-set: a measurement older than the cached one doesn't replace it
+    if bp_value == nil or bp_time <= time_created then
+        last_blood_pressure = value
+        bp_value = value
+        bp_time = time_created
+        redis.call('HSET', key, 'bp_value', fmt(value), 'bp_time', fmt(time_created))
+    end
+end
+
+if measurement_type == 'respiration_rate' then
+    rr_count = rr_count + 1
+    rr_mean = rr_mean + (value - rr_mean) / rr_count
+    redis.call('HSET', key, 'rr_mean', fmt(rr_mean), 'rr_count', rr_count)
+end
+
+local standard_deviation_temperature = 0
+if measurement_type == 'temperature' then
+    local prev_count = t_count
+    t_count = t_count + 1
+    local delta = value - t_mean
+    t_mean = t_mean + delta / t_count
+    t_variance = t_variance + delta * (value - t_mean)
+    redis.call('HSET', key, 't_mean', fmt(t_mean), 't_variance', fmt(t_variance), 't_count', t_count)
+    if prev_count > 1 then
+        standard_deviation_temperature = math.sqrt(t_variance / (t_count - 1))
+    end
+elseif t_count > 1 then
+    standard_deviation_temperature = math.sqrt(t_variance / (t_count - 1))
+end
+
+return {fmt(last_blood_pressure), fmt(rr_mean), fmt(standard_deviation_temperature),
+        bp_value and fmt(bp_value) or '', bp_time and fmt(bp_time) or '',
+        fmt(rr_mean), rr_count, fmt(t_mean), fmt(t_variance), t_count}
+"""
+
+
+SEED_STATE_SCRIPT = """
+local unpack = table.unpack or unpack
+if redis.call('EXISTS', KEYS[1]) == 0 and #ARGV > 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+end
+"""
+
+
+class FastReadmissionRedisScriptCache(FastReadmissionRedisCache):
+    """
+    Updates the state hash with a registered Lua script(EVALSHA),
+    so every measurement is a single atomic round trip and workers can be scaled horizontally.
+    """
+    atomic_update = True
+
+    def __init__(self, redis_client: redis.Redis):
+        super().__init__(redis_client)
+        self.update_script = redis_client.register_script(UPDATE_STATE_SCRIPT)
+
+    def update(self, patient_id: int, last_measurement: models.Measurement,
+               seed: Callable[[], FastReadmissionState] = None) -> (float, float, float):
+        return self.update_and_get_state(patient_id, last_measurement, seed=seed)[0]
+
+    def update_and_get_state(self, patient_id: int, last_measurement: models.Measurement,
+                             seed: Callable[[], FastReadmissionState] = None) -> ((float, float, float),
+                                                                                  FastReadmissionState):
+        """
+        update, which also returns the state of the patient right after it
+        """
+        args = self.script_args(last_measurement, report_cold=seed is not None)
+        keys = [self.key(patient_id), *self.legacy_keys(patient_id)]
+        read = self.update_script(keys=keys, args=args)
+        if read == [b'migrate']:
+            self.migrate_legacy_state(patient_id)
+            read = self.update_script(keys=keys, args=args)
+        if read == [b'cold']:
+            state = seed()
+            if state:
+                self.seed_state(patient_id, state)
+            args[3] = '0'
+            read = self.update_script(keys=keys, args=args)
+        return self.script_inputs(read), self.script_state(patient_id, read)
+
+    @staticmethod
+    def script_inputs(read: list) -> (float, float, float):
+        (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = [float(v) for v in read[:3]]
+        return last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature
+
+    @classmethod
+    def script_state(cls, patient_id: int, read: list) -> FastReadmissionState:
+        (bp_value, bp_time, rr_mean, rr_count, t_mean, t_variance, t_count) = read[3:]
+        state = FastReadmissionState(respiratory_rate_mean=float(rr_mean), respiratory_rate_count=int(rr_count),
+                                     temperature_mean=float(t_mean), temperature_variance=float(t_variance),
+                                     temperature_count=int(t_count))
+        if bp_value:
+            state.last_blood_pressure = cls.new_blood_pressure(patient_id, float(bp_value), float(bp_time))
+        return state
+
+    @staticmethod
+    def script_args(last_measurement: models.Measurement, report_cold: bool) -> list:
+        return [
+            MeasurementType(last_measurement.type).value,
+            repr(float(last_measurement.value)),
+            repr(to_timestamp(last_measurement.time_created)),
+            '1' if report_cold else '0',
+        ]
+
+
+class AsyncFastReadmissionRedisCache(AsyncFastReadmissionCache):
+    """
+    redis.asyncio version of FastReadmissionRedisScriptCache for the async ingestion path.
+    It uses the same hash and Lua script, so sync and async workers can serve the same patients.
+    """
+
+    def __init__(self, redis_client: redis.asyncio.Redis):
+        self.redis_client = redis_client
+        self.update_script = redis_client.register_script(UPDATE_STATE_SCRIPT)
+        self.seed_script = redis_client.register_script(SEED_STATE_SCRIPT)
+
+    async def update(self, patient_id: int, last_measurement: models.Measurement,
+                     seed: Callable[[], Awaitable[FastReadmissionState]] = None) -> (float, float, float):
+        args = FastReadmissionRedisScriptCache.script_args(last_measurement, report_cold=seed is not None)
+        keys = [FastReadmissionRedisCache.key(patient_id), *FastReadmissionRedisCache.legacy_keys(patient_id)]
+        read = await self.update_script(keys=keys, args=args)
+        if read == [b'migrate']:
+            await self.migrate_legacy_state(patient_id)
+            read = await self.update_script(keys=keys, args=args)
+        if read == [b'cold']:
+            state = await seed()
+            if state:
+                await self.seed_state(patient_id, state)
+            args[3] = '0'
+            read = await self.update_script(keys=keys, args=args)
+        return FastReadmissionRedisScriptCache.script_inputs(read)
+
+    async def delete_states(self, patient_ids: Iterable[int]):
+        keys = [key for patient_id in patient_ids for key in (FastReadmissionRedisCache.key(patient_id),
+                                                              *FastReadmissionRedisCache.legacy_keys(patient_id))]
+        if keys:
+            await self.redis_client.delete(*keys)
+
+    async def seed_state(self, patient_id: int, state: FastReadmissionState):
+        state.changed = set(STATE_PARTS)
+        fields = FastReadmissionRedisCache.state_fields(state)
+        await self.seed_script(keys=[FastReadmissionRedisCache.key(patient_id)],
+                               args=[v for item in fields.items() for v in item])
+
+    async def migrate_legacy_state(self, patient_id: int) -> FastReadmissionState or None:
+        legacy_keys = FastReadmissionRedisCache.legacy_keys(patient_id)
+        state = FastReadmissionRedisCache.state_from_legacy(patient_id, await self.redis_client.mget(legacy_keys))
+        if not state:
+            return None
+
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(FastReadmissionRedisCache.key(patient_id), mapping=FastReadmissionRedisCache.state_fields(state))
+            pipe.delete(*legacy_keys)
+            await pipe.execute()
+        state.changed = set()
+        return state
+
+
+class FastReadmissionLRUCache(FastReadmissionCache):
+    """
+    Bounded in-process LRU of patient states in front of another cache(usually Redis), with write-through.
+
+    A hit scores a measurement without network reads, only the write-through is left. That read-modify-write
+    needs sticky routing, when measurements of a patient go to the same worker: if another worker updates
+    the patient anyway, the local copy is stale for at most `ttl` seconds and updates in between are lost.
+
+    If the wrapped cache updates atomically(FastReadmissionRedisScriptCache), updates go to it and the local
+    copy is refreshed from the state it returns, so nothing is lost without sticky routing either.
+    """
+
+    def __init__(self, cache: FastReadmissionCache, max_size: int = 10000, ttl: float = 30.0,
+                 clock=time.monotonic):
+        self.cache = cache
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        # Measurements of one patient are applied one by one, different patients in parallel
+        self.patient_locks = [threading.Lock() for _ in range(64)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def update(self, patient_id: int, last_measurement: models.Measurement,
+               seed: Callable[[], FastReadmissionState] = None) -> (float, float, float):
+        if self.cache.atomic_update:
+            (inputs, state) = self.cache.update_and_get_state(patient_id, last_measurement, seed=seed)
+            self.remember(patient_id, state)
+            return inputs
+        with self.patient_locks[patient_id % len(self.patient_locks)]:
+            return super().update(patient_id, last_measurement, seed=seed)
+
+    def seed_states(self, states: Dict[int, FastReadmissionState]):
+        self.cache.seed_states(states)
+        for patient_id in states:
+            self.invalidate(patient_id)
+
+    def delete_states(self, patient_ids: Iterable[int]):
+        patient_ids = list(patient_ids)
+        for patient_id in patient_ids:
+            self.invalidate(patient_id)
+        self.cache.delete_states(patient_ids)
+
+    def get_state(self, patient_id: int) -> FastReadmissionState:
+        with self.lock:
+            cached = self.states.get(patient_id)
+            if cached and cached[0] > self.clock():
+                self.states.move_to_end(patient_id)
+                self.hits += 1
+                FAST_CACHE_LRU_LOOKUPS.labels("hit").inc()
+                return self.copy_state(cached[1])
+            self.misses += 1
+            FAST_CACHE_LRU_LOOKUPS.labels("miss").inc()
+
+        state = self.cache.get_state(patient_id)
+        self.remember(patient_id, state)
+        return state
+
+    def save_state(self, patient_id: int, state: FastReadmissionState):
+        self.cache.save_state(patient_id, state)
+        self.remember(patient_id, state)
+
+    def invalidate(self, patient_id: int):
+        with self.lock:
+            self.states.pop(patient_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.states), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def remember(self, patient_id: int, state: FastReadmissionState):
+        with self.lock:
+            self.states[patient_id] = (self.clock() + self.ttl, self.copy_state(state))
+            self.states.move_to_end(patient_id)
+            while len(self.states) > self.max_size:
+                self.states.popitem(last=False)
+                self.evictions += 1
+
+    @staticmethod
+    def copy_state(state: FastReadmissionState) -> FastReadmissionState:
+        # Callers change the state they get, the cached one must stay as it was
+        state = copy.copy(state)
+        state.changed = set()
+        return state
+
+    def get_last_blood_pressure(self, patient_id: int) -> models.Measurement:
+        return self.get_state(patient_id).last_blood_pressure
+
+    def save_last_blood_pressure(self, patient_id: int, measurement: models.Measurement):
+        self.invalidate(patient_id)
+        self.cache.save_last_blood_pressure(patient_id, measurement)
+
+    def get_mean_respiratory_rate(self, patient_id: int) -> (float, int):
+        state = self.get_state(patient_id)
+        return state.respiratory_rate_mean, state.respiratory_rate_count
+
+    def save_mean_respiratory_rate(self, patient_id: int, mean: float, count: int):
+        self.invalidate(patient_id)
+        self.cache.save_mean_respiratory_rate(patient_id, mean, count)
+
+    def get_standard_deviation_temperature(self, patient_id: int) -> (float, float, int):
+        state = self.get_state(patient_id)
+        return state.temperature_mean, state.temperature_variance, state.temperature_count
 
     def save_standard_deviation_temperature(self, patient_id: int, mean: float, variance: float, count: int):
-        key = f'patient:{patient_id}:standard_deviation_temperature'
-        self.redis_client.set(key, pickle.dumps({'mean': mean, 'variance': variance, 'count': int(count)}))
+        self.invalidate(patient_id)
+        self.cache.save_standard_deviation_temperature(patient_id, mean, variance, count)
@@ -0,0 +1,98 @@
+"""
+Streaming export of a patient's history(raw measurements and predictions) as NDJSON or CSV.
+
+Rows are read with yield_per, a server-side cursor where the database supports it, and every batch is encoded
+into one chunk of the response, so memory doesn't grow with the length of the history.
+Measurements that were compacted by retention are exported as their hourly rollups, see measurements_query.
+"""
+import csv
+import datetime
+import io
+import json
+from typing import Callable, Iterator, List, Sequence
+
+from sqlalchemy import literal, null, select, union_all
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from src import models
+from src.schemas import ExportFormat
+
+EXPORT_BATCH_SIZE = 1000
+
+MEASUREMENT_COLUMNS = ("id", "patient_id", "time_created", "type", "value", "count", "rollup")
+PREDICTION_COLUMNS = ("patient_id", "time_created", "probability")
+
+MEDIA_TYPES = {ExportFormat.NDJSON: "application/x-ndjson", ExportFormat.CSV: "text/csv"}
+
+
+def measurements_query(patient_id: int, measurement_type: str = None, since: datetime.datetime = None,
+                       until: datetime.datetime = None) -> Select:
+    """
+    Measurements of the patient in [since, until) and the rollups of compacted hours, oldest first.
+    A rollup row has no id, the start of the hour as time_created, the mean as value and rollup true,
+    like the items of get_measurement_history.
+    """
+    m = models.Measurement
+    raw = select(m.id, m.patient_id, m.time_created, m.type, m.value, literal(1).label("count"),
+                 literal(False).label("rollup"), m.id.label("position")).where(m.patient_id == patient_id)
+    r = models.MeasurementRollup
+    rollups = select(null().label("id"), r.patient_id, r.hour.label("time_created"), r.type, r.mean.label("value"),
+                     r.count, literal(True).label("rollup"), literal(0).label("position")).where(
+        r.patient_id == patient_id)
+    if measurement_type:
+        raw = raw.where(m.type == measurement_type)
+        rollups = rollups.where(r.type == measurement_type)
+    if since:
+        raw = raw.where(m.time_created >= since)
+        rollups = rollups.where(r.hour >= since)
+    if until:
+        raw = raw.where(m.time_created < until)
+        rollups = rollups.where(r.hour < until)
+    history = union_all(raw, rollups).subquery()
+    return select(*(history.c[column] for column in MEASUREMENT_COLUMNS)).order_by(
+        history.c.time_created, history.c.position, history.c.type)
+
+
+def predictions_query(patient_id: int, since: datetime.datetime = None, until: datetime.datetime = None) -> Select:
+    p = models.ReadmissionPrediction
+    statement = select(*(getattr(p, column) for column in PREDICTION_COLUMNS)).where(p.patient_id == patient_id)
+    if since:
+        statement = statement.where(p.time_created >= since)
+    if until:
+        statement = statement.where(p.time_created < until)
+    return statement.order_by(p.time_created, p.internal_id)
+
+
+def plain(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def encode_ndjson(columns: Sequence[str], rows: List[tuple]) -> bytes:
+    return "".join(json.dumps(dict(zip(columns, map(plain, row)))) + "\n" for row in rows).encode()
+
+
+def encode_csv(rows: List[Sequence]) -> bytes:
+    out = io.StringIO()
+    csv.writer(out).writerows([plain(value) for value in row] for row in rows)
+    return out.getvalue().encode()
+
+
+def export_chunks(session_factory: Callable[[], Session], statement: Select, columns: Sequence[str],
+                  export_format: ExportFormat, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """
+    Encoded chunks of batch_size rows, CSV starts with a header. The export has its own session,
+    which lives as long as the response is streamed.
+    """
+    if export_format == ExportFormat.CSV:
+        yield encode_csv([columns])
+    db = session_factory()
+    try:
+        result = db.execute(statement.execution_options(yield_per=batch_size))
+        for rows in result.partitions():
+            if export_format == ExportFormat.CSV:
+                yield encode_csv(rows)
+            else:
+                yield encode_ndjson(columns, rows)
+    finally:
+        db.close()
@@ -0,0 +1,98 @@
+"""
+Vectorized prediction_math for scoring many patients at once: backfills, what-if analysis, cohort re-scoring.
+
+Patients are rows of arrays. Raw measurements are flat arrays where `groups` holds the row of the patient
+a measurement belongs to, see `group_index`. Results match the scalar functions up to float rounding,
+means and variances are computed in two passes instead of Welford's updates.
+The standard deviation of temperature is the population one, like in the slow model.
+"""
+from typing import Tuple
+
+import numpy as np
+
+from src.schemas import MeasurementType
+
+
+def calculate_probability_v1(age, last_blood_pressure, mean_respiratory_rate,
+                             standard_deviation_temperature) -> np.ndarray:
+    """
+    prediction_math.calculate_probability_v1 over arrays(or scalars broadcast against them)
+    """
+    x_beta = -5 + 0.002 * np.asarray(age, dtype=np.float64) + 0.001 * np.asarray(last_blood_pressure, np.float64)
+    x_beta = x_beta + 0.03 * np.asarray(mean_respiratory_rate, dtype=np.float64)
+    x_beta = x_beta + 0.02 * np.asarray(standard_deviation_temperature, dtype=np.float64)
+    e = np.exp(x_beta)
+    return e / (1 + e)
+
+
+def group_index(patient_ids) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns sorted unique patient ids and the row of every measurement in them
+    """
+    return np.unique(np.asarray(patient_ids), return_inverse=True)
+
+
+def group_mean_and_variance(groups: np.ndarray, values: np.ndarray, n: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Mean, sum of squared deviations(`variance` of calculate_mean_and_variance_online) and count per group.
+    Groups without values get zeros.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    count = np.bincount(groups, minlength=n)
+    sums = np.bincount(groups, weights=values, minlength=n)
+    mean = np.divide(sums, count, out=np.zeros(n), where=count > 0)
+    variance = np.bincount(groups, weights=(values - mean[groups]) ** 2, minlength=n)
+    return mean, variance, count
+
+
+def standard_deviation(variance: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """
+    Population standard deviation from a sum of squared deviations, 0 for less than 2 values
+    like prediction_math.calculate_standard_deviation
+    """
+    safe_count = np.maximum(count, 1)
+    return np.where(count > 1, np.sqrt(variance / safe_count), 0.0)
+
+
+def group_last(groups: np.ndarray, times: np.ndarray, values: np.ndarray, n: int, default: float = 0.0) -> np.ndarray:
+    """
+    The value with the latest time per group, the later one in the arrays on equal times
+    """
+    groups = np.asarray(groups)
+    result = np.full(n, default, dtype=np.float64)
+    if not len(groups):
+        return result
+    order = np.lexsort((np.arange(len(groups)), np.asarray(times), groups))
+    sorted_groups = groups[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = sorted_groups[1:] != sorted_groups[:-1]
+    result[sorted_groups[last]] = np.asarray(values, dtype=np.float64)[order[last]]
+    return result
+
+
+def measurement_inputs(groups: np.ndarray, types: np.ndarray, values: np.ndarray, times: np.ndarray,
+                       n: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Inputs of the probability formula per group from raw measurements:
+    last blood pressure, mean respiratory rate and standard deviation of temperature
+    """
+    groups, types, values, times = np.asarray(groups), np.asarray(types), np.asarray(values), np.asarray(times)
+
+    bp = types == MeasurementType.BLOOD_PRESSURE.value
+    last_blood_pressure = group_last(groups[bp], times[bp], values[bp], n)
+
+    rr = types == MeasurementType.RESPIRATION_RATE.value
+    (mean_respiratory_rate, _, _) = group_mean_and_variance(groups[rr], values[rr], n)
+
+    t = types == MeasurementType.TEMPERATURE.value
+    (_, variance, count) = group_mean_and_variance(groups[t], values[t], n)
+    return last_blood_pressure, mean_respiratory_rate, standard_deviation(variance, count)
+
+
+def score_measurements(ages, groups, types, values, times) -> np.ndarray:
+    """
+    Readmission probability per patient after all their measurements. `ages` has a row per patient.
+    """
+    ages = np.asarray(ages)
+    inputs = measurement_inputs(groups, types, values, times, len(ages))
+    return calculate_probability_v1(ages, *inputs)
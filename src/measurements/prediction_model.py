@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod
+from typing import Iterable
 
 from src import models
 
@@ -7,6 +8,8 @@ class ReadmissionPredictionModel(metaclass=ABCMeta):
     """
         Prediction model calculates the probability of readmission for a patient.
     """
+    # The `model` label of metrics, see src.metrics
+    name = "unknown"
 
     @abstractmethod
     def calculate(self, patient: models.Patient, last_measurement: models.Measurement) -> float:
@@ -17,3 +20,21 @@ class ReadmissionPredictionModel(metaclass=ABCMeta):
         Depending on a model, other data can be used.
         """
         pass
+
+    def forget(self, patient_ids: Iterable[int]):
+        """
+        Drops what the model keeps about the patients outside the database, e.g. when measurements it has
+        already seen weren't saved. Models that only read the database have nothing to drop.
+        """
+        pass
+
+
+class AsyncReadmissionPredictionModel(metaclass=ABCMeta):
+    """
+        Prediction model of the async ingestion path, see ReadmissionPredictionModel.
+    """
+    name = "unknown"
+
+    @abstractmethod
+    async def calculate(self, patient: models.Patient, last_measurement: models.Measurement) -> float:
+        pass
@@ -1,6 +1,5 @@
 from abc import ABCMeta, abstractmethod
-
-import redis as redis
+from typing import Awaitable, Callable, Dict, Iterable
 
 import math
 
@@ -8,13 +7,53 @@ from src import models
 from src.measurements.prediction_math import calculate_mean_and_variance_online, calculate_mean_online, \
     calculate_probability_v1
 from src.measurements.prediction_model import ReadmissionPredictionModel
+from src.metrics import stage
 from src.schemas import MeasurementType
 
+LAST_BLOOD_PRESSURE = "last_blood_pressure"
+MEAN_RESPIRATORY_RATE = "mean_respiratory_rate"
+STANDARD_DEVIATION_TEMPERATURE = "standard_deviation_temperature"
+STATE_PARTS = (LAST_BLOOD_PRESSURE, MEAN_RESPIRATORY_RATE, STANDARD_DEVIATION_TEMPERATURE)
+
+
+class FastReadmissionState:
+    """
+    Everything the fast prediction model keeps about a patient.
+    `changed` holds the parts that were updated since the state was read from the cache.
+    """
+
+    def __init__(self,
+                 last_blood_pressure: models.Measurement = None,
+                 respiratory_rate_mean: float = 0.0,
+                 respiratory_rate_count: int = 0,
+                 temperature_mean: float = 0.0,
+                 temperature_variance: float = 0.0,
+                 temperature_count: int = 0):
+        self.last_blood_pressure = last_blood_pressure
+        self.respiratory_rate_mean = respiratory_rate_mean
+        self.respiratory_rate_count = respiratory_rate_count
+        self.temperature_mean = temperature_mean
+        self.temperature_variance = temperature_variance
+        self.temperature_count = temperature_count
+        self.changed = set()
+
+    def is_empty(self) -> bool:
+        return self.last_blood_pressure is None and not self.respiratory_rate_count and not self.temperature_count
+
+    def __repr__(self):
+        return f"FastReadmissionState(last_blood_pressure={self.last_blood_pressure}, " \
+               f"respiratory_rate_mean={self.respiratory_rate_mean}, " \
+               f"respiratory_rate_count={self.respiratory_rate_count}, " \
+               f"temperature_mean={self.temperature_mean}, temperature_variance={self.temperature_variance}, " \
+               f"temperature_count={self.temperature_count})"
+
 
 class FastReadmissionCache(metaclass=ABCMeta):
     """
     Cache saves data necessary for fast readmission prediction model.
     """
+    # Caches with atomic updates also have update_and_get_state, see FastReadmissionRedisScriptCache
+    atomic_update = False
 
     @abstractmethod
     def get_last_blood_pressure(self, patient_id: int) -> models.Measurement:
@@ -40,76 +79,185 @@ class FastReadmissionCache(metaclass=ABCMeta):
     def save_standard_deviation_temperature(self, patient_id: int, mean: float, variance: float, count: int):
         pass
 
+    def get_state(self, patient_id: int) -> FastReadmissionState:
+        """
+        Returns all cached data of a patient. Caches with network access should override it to fetch it at once.
+        """
+        (respiratory_rate_mean, respiratory_rate_count) = self.get_mean_respiratory_rate(patient_id)
+        (temperature_mean, temperature_variance, temperature_count) = self.get_standard_deviation_temperature(
+            patient_id)
+        return FastReadmissionState(
+            last_blood_pressure=self.get_last_blood_pressure(patient_id),
+            respiratory_rate_mean=respiratory_rate_mean,
+            respiratory_rate_count=respiratory_rate_count,
+            temperature_mean=temperature_mean,
+            temperature_variance=temperature_variance,
+            temperature_count=temperature_count,
+        )
+
+    def save_state(self, patient_id: int, state: FastReadmissionState):
+        """
+        Saves the changed parts of the state. Caches with network access should override it to save it at once.
+        """
+        if LAST_BLOOD_PRESSURE in state.changed:
+            self.save_last_blood_pressure(patient_id, state.last_blood_pressure)
+        if MEAN_RESPIRATORY_RATE in state.changed:
+            self.save_mean_respiratory_rate(patient_id, state.respiratory_rate_mean, state.respiratory_rate_count)
+        if STANDARD_DEVIATION_TEMPERATURE in state.changed:
+            self.save_standard_deviation_temperature(patient_id, state.temperature_mean, state.temperature_variance,
+                                                     state.temperature_count)
+
+    def update(self, patient_id: int, last_measurement: models.Measurement,
+               seed: Callable[[], FastReadmissionState] = None) -> (float, float, float):
+        """
+        Applies a new measurement to the cached state and returns the inputs of the probability formula:
+        last blood pressure, mean respiratory rate and standard deviation of temperature.
+        If the cache has nothing for the patient, `seed` is called to restore the state first.
+
+        By default it's a read-modify-write of the state. Caches shared between processes can override it
+        to make the update atomic.
+        """
+        state = self.get_state(patient_id)
+        if seed and state.is_empty():
+            seeded = seed()
+            if seeded:
+                state = seeded
+                state.changed = set(STATE_PARTS)
+        inputs = apply_measurement(state, last_measurement)
+        if state.changed:
+            self.save_state(patient_id, state)
+        return inputs
+
+    def seed_state(self, patient_id: int, state: FastReadmissionState):
+        """
+        Saves the whole state unless the cache already has one for the patient
+        """
+        if self.get_state(patient_id).is_empty():
+            state.changed = set(STATE_PARTS)
+            self.save_state(patient_id, state)
+
+    def seed_states(self, states: Dict[int, FastReadmissionState]):
+        for patient_id, state in states.items():
+            self.seed_state(patient_id, state)
+
+    def delete_states(self, patient_ids: Iterable[int]):
+        """
+        Forgets the patients, the next update restores their state with `seed`.
+        By default an empty state is saved, caches with network access should delete it at once.
+        """
+        for patient_id in patient_ids:
+            state = FastReadmissionState()
+            state.changed = set(STATE_PARTS)
+            self.save_state(patient_id, state)
+
+
+class AsyncFastReadmissionCache(metaclass=ABCMeta):
+    """
+    Cache of the async ingestion path. It only needs the update, which is a single round trip.
+    """
+
+    @abstractmethod
+    async def update(self, patient_id: int, last_measurement: models.Measurement,
+                     seed: Callable[[], Awaitable[FastReadmissionState]] = None) -> (float, float, float):
+        """
+        The same as FastReadmissionCache.update, `seed` is a coroutine function
+        """
+        pass
+
+    async def delete_states(self, patient_ids: Iterable[int]):
+        """
+        The same as FastReadmissionCache.delete_states
+        """
+        pass
+
+
+def apply_measurement(state: FastReadmissionState, last_measurement: models.Measurement) -> (float, float, float):
+    """
+    Updates the state with a new measurement and returns the inputs of the probability formula:
+    last blood pressure, mean respiratory rate and standard deviation of temperature.
+    """
+    return (
+        apply_blood_pressure(state, last_measurement),
+        apply_respiratory_rate(state, last_measurement),
+        apply_temperature(state, last_measurement),
+    )
+
+
+def apply_blood_pressure(state: FastReadmissionState, last_measurement: models.Measurement) -> float:
+    """
+    Returns the last blood pressure measurement(that one in cache or the new one)
+    """
+    last_cached_blood_pressure = state.last_blood_pressure
+    if last_measurement.type != MeasurementType.BLOOD_PRESSURE:
+        if not last_cached_blood_pressure:
+            return 0.0
+        return last_cached_blood_pressure.value
+
+    # If somehow cached value is newer than the last measurement, use it
+    if last_cached_blood_pressure and last_cached_blood_pressure.time_created > last_measurement.time_created:
+        return last_cached_blood_pressure.value
+
+    # If there is nothing in cache or the cached value is older, save and return new value
+    state.last_blood_pressure = last_measurement
+    state.changed.add(LAST_BLOOD_PRESSURE)
+    return last_measurement.value
+
+
+def apply_respiratory_rate(state: FastReadmissionState, last_measurement: models.Measurement) -> float:
+    # Calculate mean value of respiratory rate
+    # IF there is nothing in cache, mean and count are 0s
+    if last_measurement.type != MeasurementType.RESPIRATION_RATE:
+        return state.respiratory_rate_mean
+    (state.respiratory_rate_mean, state.respiratory_rate_count) = calculate_mean_online(
+        state.respiratory_rate_mean, state.respiratory_rate_count, last_measurement.value)
+    state.changed.add(MEAN_RESPIRATORY_RATE)
+    return state.respiratory_rate_mean
+
+
+def apply_temperature(state: FastReadmissionState, last_measurement: models.Measurement) -> float:
+    count = state.temperature_count
+    if last_measurement.type != MeasurementType.TEMPERATURE:
+        return math.sqrt(state.temperature_variance / (count - 1)) if count > 1 else 0
+
+    (state.temperature_mean, state.temperature_variance, state.temperature_count) = \
+        calculate_mean_and_variance_online(state.temperature_mean, state.temperature_variance, count,
+                                           last_measurement.value)
+    state.changed.add(STANDARD_DEVIATION_TEMPERATURE)
+    return math.sqrt(state.temperature_variance / (state.temperature_count - 1)) if count > 1 else 0
+
 
 class FastReadmissionPredictionModel(ReadmissionPredictionModel):
     """
     This prediction model on each new measurement goes to the cache and
     calculates the probability of readmission only for the new increment, so it's always O(1) for each new request
 
-    It fetches from cache:
+    It updates the state of a patient in the cache at once:
     * last blood pressure O(1)
     * mean and count for respiratory rate calculation O(1)
     * mean, variance and count for standard deviation calculation of temperature O(1)
     """
+    name = "v1"
 
     def __init__(self, cache: FastReadmissionCache):
         self.cache = cache
 
+    def forget(self, patient_ids: Iterable[int]):
+        self.cache.delete_states(patient_ids)
+
     def calculate(self, patient: models.Patient, last_measurement: models.Measurement) -> float:
         """
         We calculate the probability only using the latest increment and the cached data.
-        TODO: If cache down, we should fallback to SlowReadmissionPredictionModel
-        """
-        age = patient.age
-        last_blood_pressure = self.get_last_blood_pressure(patient.id, last_measurement)
-        mean_respiratory_rate = self.get_mean_respiratory_rate(patient.id, last_measurement)
-        standard_deviation_temperature = self.get_standard_deviation_temperature(patient.id, last_measurement)
-
-        prob = calculate_probability_v1(
-            age=age,
-            last_blood_pressure=last_blood_pressure,
-            mean_respiratory_rate=mean_respiratory_rate,
-            standard_deviation_temperature=standard_deviation_temperature
-        )
-        return prob
-
-    def get_last_blood_pressure(self, patient_id: int, last_measurement: models.Measurement) -> float:
+        See ResilientReadmissionPredictionModel for the case when the cache is down or empty.
         """
-        Returns the last blood pressure measurement(that one in cache or the new one)
-        """
-        last_cached_blood_pressure = self.cache.get_last_blood_pressure(patient_id)
-        if last_measurement.type != MeasurementType.BLOOD_PRESSURE:
-            if not last_cached_blood_pressure:
-                return 0.0
-            return last_cached_blood_pressure.value
+        with stage("cache_update", self.name):
+            (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = self.cache.update(
+                patient.id, last_measurement)
 
-        # If there is nothing in cache, save and return new value
-        if not last_cached_blood_pressure:
-            self.cache.save_last_blood_pressure(patient_id, last_measurement)
-            return last_measurement.value
-
-        # If somehow cached value is newer than the last measurement, use it
-        if last_cached_blood_pressure.time_created > last_measurement.time_created:
-            return last_cached_blood_pressure.value
-        self.cache.save_last_blood_pressure(patient_id, last_measurement)
-        return last_measurement.value
-
-    def get_mean_respiratory_rate(self, patient_id: int, last_measurement: models.Measurement) -> float:
-        # Calculate mean value of respiratory rate
-        # IF there is nothing in cache, mean and count are 0s
-        (mean, count) = self.cache.get_mean_respiratory_rate(patient_id)
-        if last_measurement.type != MeasurementType.RESPIRATION_RATE:
-            return mean
-        (new_mean, new_count) = calculate_mean_online(mean, count, last_measurement.value)
-        self.cache.save_mean_respiratory_rate(patient_id, new_mean, new_count)
-        return new_mean
-
-    def get_standard_deviation_temperature(self, patient_id: int, last_measurement: models.Measurement) -> float:
-        (mean, variation, count) = self.cache.get_standard_deviation_temperature(patient_id)
-        if last_measurement.type != MeasurementType.TEMPERATURE:
-            return math.sqrt(variation / (count - 1)) if count > 1 else 0
-
-        (new_mean, new_variation, new_count) = calculate_mean_and_variance_online(mean, variation, count,
-                                                                                  last_measurement.value)
-        self.cache.save_standard_deviation_temperature(patient_id, new_mean, new_variation, new_count)
-        return math.sqrt(new_variation / (new_count - 1)) if count > 1 else 0
+        with stage("probability", self.name):
+            prob = calculate_probability_v1(
+                age=patient.age,
+                last_blood_pressure=last_blood_pressure,
+                mean_respiratory_rate=mean_respiratory_rate,
+                standard_deviation_temperature=standard_deviation_temperature
+            )
+        return prob
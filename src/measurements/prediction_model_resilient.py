@@ -0,0 +1,193 @@
+import itertools
+import logging
+import threading
+from typing import Dict, Iterable
+
+import redis
+
+from src import models
+from src.measurements.prediction_math import calculate_probability_v1
+from src.measurements.prediction_model import AsyncReadmissionPredictionModel
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel, FastReadmissionCache, \
+    FastReadmissionState, apply_measurement, AsyncFastReadmissionCache
+from src.measurements.repository import MeasurementRepository, MeasurementAggregates, AsyncMeasurementRepository
+from src.metrics import stage, FAST_CACHE_LOOKUPS
+from src.schemas import MeasurementType
+
+logger = logging.getLogger(__name__)
+
+
+def state_from_aggregates(aggregates: MeasurementAggregates) -> FastReadmissionState:
+    return FastReadmissionState(
+        last_blood_pressure=aggregates.last_blood_pressure,
+        respiratory_rate_mean=aggregates.mean(MeasurementType.RESPIRATION_RATE.value),
+        respiratory_rate_count=aggregates.count(MeasurementType.RESPIRATION_RATE.value),
+        temperature_mean=aggregates.mean(MeasurementType.TEMPERATURE.value),
+        temperature_variance=aggregates.sum_of_squared_deviations(MeasurementType.TEMPERATURE.value),
+        temperature_count=aggregates.count(MeasurementType.TEMPERATURE.value),
+    )
+
+
+class FallbackPatients:
+    """
+    Patients whose measurements were scored without the cache in this process. A state cached for them before
+    the outage misses those measurements, so it is deleted once the cache answers again and the next update
+    restores it from the database.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.patients = {}
+        self.sequence = itertools.count()
+
+    def add(self, patient_id: int):
+        with self.lock:
+            self.patients[patient_id] = next(self.sequence)
+
+    def pending(self) -> Dict[int, int]:
+        if not self.patients:
+            return {}
+        with self.lock:
+            return dict(self.patients)
+
+    def done(self, pending: Dict[int, int]):
+        # Patients that fell back again while their states were deleted stay pending
+        with self.lock:
+            for patient_id, sequence in pending.items():
+                if self.patients.get(patient_id) == sequence:
+                    del self.patients[patient_id]
+
+
+FALLBACK_PATIENTS = FallbackPatients()
+
+
+class ResilientReadmissionPredictionModel(FastReadmissionPredictionModel):
+    """
+    Fast prediction model that doesn't depend on the cache being available or filled.
+
+    * On a cold miss(nothing cached for the patient, e.g. after a Redis flush) the state is restored from
+      the measurements table with one aggregate query and saved to the cache.
+    * If the cache is down, the state is restored from the database the same way and the prediction is served
+      without the cache. Restored states are kept for the lifetime of the model, so a batch stays consistent.
+      Cached states of such patients are deleted when the cache is back, see FallbackPatients.
+    """
+
+    def __init__(self, cache: FastReadmissionCache, measurement_repo: MeasurementRepository,
+                 fallback_patients: FallbackPatients = FALLBACK_PATIENTS):
+        super().__init__(cache=cache)
+        self.measurement_repo = measurement_repo
+        self.fallback_states = {}
+        self.fallback_patients = fallback_patients
+
+    def calculate(self, patient: models.Patient, last_measurement: models.Measurement) -> float:
+        result = "hit"
+
+        def seed():
+            nonlocal result
+            result = "miss"
+            with stage("state_restore", self.name):
+                return self.get_state_from_database(patient.id, last_measurement)
+
+        try:
+            with stage("cache_update", self.name):
+                pending = self.fallback_patients.pending()
+                if pending:
+                    self.cache.delete_states(list(pending))
+                    self.fallback_patients.done(pending)
+                (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = self.cache.update(
+                    patient.id, last_measurement, seed=seed)
+        except redis.RedisError as e:
+            logger.warning("Cache is not available, restoring the state of patient %s from the database: %s",
+                           patient.id, e)
+            state = self.fallback_states.get(patient.id) or seed() or FastReadmissionState()
+            (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = apply_measurement(
+                state, last_measurement)
+            self.fallback_states[patient.id] = state
+            self.fallback_patients.add(patient.id)
+            result = "error"
+        FAST_CACHE_LOOKUPS.labels(self.name, result).inc()
+
+        with stage("probability", self.name):
+            return calculate_probability_v1(
+                age=patient.age,
+                last_blood_pressure=last_blood_pressure,
+                mean_respiratory_rate=mean_respiratory_rate,
+                standard_deviation_temperature=standard_deviation_temperature
+            )
+
+    def forget(self, patient_ids: Iterable[int]):
+        patient_ids = list(patient_ids)
+        for patient_id in patient_ids:
+            self.fallback_states.pop(patient_id, None)
+        try:
+            self.cache.delete_states(patient_ids)
+        except redis.RedisError as e:
+            logger.warning("Cache is not available, states of patients %s can't be deleted: %s", patient_ids, e)
+
+    def get_state_from_database(self, patient_id: int, last_measurement: models.Measurement) -> FastReadmissionState:
+        """
+        Returns the state as it was before the new measurement, or None if the patient has no measurements.
+        The new measurement can already be saved, then only measurements saved before it are used.
+        """
+        aggregates = self.measurement_repo.get_measurement_aggregates([patient_id], before_id=last_measurement.id)
+        if patient_id not in aggregates:
+            return None
+        return state_from_aggregates(aggregates[patient_id])
+
+
+class AsyncResilientReadmissionPredictionModel(AsyncReadmissionPredictionModel):
+    """
+    ResilientReadmissionPredictionModel of the async ingestion path, with the same cold miss and fallback handling.
+    """
+    name = "v2"
+
+    def __init__(self, cache: AsyncFastReadmissionCache, measurement_repo: AsyncMeasurementRepository,
+                 fallback_patients: FallbackPatients = FALLBACK_PATIENTS):
+        self.cache = cache
+        self.measurement_repo = measurement_repo
+        self.fallback_states = {}
+        self.fallback_patients = fallback_patients
+
+    async def calculate(self, patient: models.Patient, last_measurement: models.Measurement) -> float:
+        result = "hit"
+
+        async def seed():
+            nonlocal result
+            result = "miss"
+            with stage("state_restore", self.name):
+                return await self.get_state_from_database(patient.id, last_measurement)
+
+        try:
+            with stage("cache_update", self.name):
+                pending = self.fallback_patients.pending()
+                if pending:
+                    await self.cache.delete_states(list(pending))
+                    self.fallback_patients.done(pending)
+                (last_blood_pressure, mean_respiratory_rate,
+                 standard_deviation_temperature) = await self.cache.update(patient.id, last_measurement, seed=seed)
+        except redis.RedisError as e:
+            logger.warning("Cache is not available, restoring the state of patient %s from the database: %s",
+                           patient.id, e)
+            state = self.fallback_states.get(patient.id) or await seed() or FastReadmissionState()
+            (last_blood_pressure, mean_respiratory_rate, standard_deviation_temperature) = apply_measurement(
+                state, last_measurement)
+            self.fallback_states[patient.id] = state
+            self.fallback_patients.add(patient.id)
+            result = "error"
+        FAST_CACHE_LOOKUPS.labels(self.name, result).inc()
+
+        with stage("probability", self.name):
+            return calculate_probability_v1(
+                age=patient.age,
+                last_blood_pressure=last_blood_pressure,
+                mean_respiratory_rate=mean_respiratory_rate,
+                standard_deviation_temperature=standard_deviation_temperature
+            )
+
+    async def get_state_from_database(self, patient_id: int,
+                                      last_measurement: models.Measurement) -> FastReadmissionState:
+        aggregates = await self.measurement_repo.get_measurement_aggregates([patient_id],
+                                                                            before_id=last_measurement.id)
+        if patient_id not in aggregates:
+            return None
+        return state_from_aggregates(aggregates[patient_id])
@@ -1,7 +1,11 @@
+import math
+
 from src import models
-from src.measurements.prediction_math import calculate_probability_v1, calculate_mean, calculate_standard_deviation
+from src.measurements.prediction_math import calculate_probability_v1
 from src.measurements.prediction_model import ReadmissionPredictionModel
-from src.measurements.repository import MeasurementRepository
+from src.measurements.repository import MeasurementRepository, MeasurementAggregates
+from src.metrics import stage
+from src.schemas import MeasurementType
 
 
 class SlowReadmissionPredictionModel(ReadmissionPredictionModel):
@@ -9,47 +13,43 @@ class SlowReadmissionPredictionModel(ReadmissionPredictionModel):
     This prediction model on each new measurement goes to the database to fetch values
         and then calculates the probability of readmission.
 
-    It fetches from DB:
+    It fetches from DB with one grouped query:
     * last blood pressure O(1) (if index is created)
-    * mean respiratory rate O(n)
-    * standard deviation  of temperature O(n)
+    * count and sum of respiratory rate, the database scans O(n) rows, but only 1 row is transferred
+    * count, sum and sum of squares of temperature, the same
     """
+    name = "v0"
 
     def __init__(self, measurement_repo: MeasurementRepository):
         self.measurement_repo = measurement_repo
 
     def calculate(self, patient: models.Patient, last_measurement: models.Measurement) -> float:
-        age = patient.age
-        last_blood_pressure = self.get_last_blood_pressure(patient.id)
-        mean_respiratory_rate = self.get_mean_respiratory_rate(patient.id)
-        standard_deviation_temperature = self.get_standard_deviation_temperature(patient.id)
-
-        prob = calculate_probability_v1(
-            age=age,
-            last_blood_pressure=last_blood_pressure,
-            mean_respiratory_rate=mean_respiratory_rate,
-            standard_deviation_temperature=standard_deviation_temperature
-        )
+        with stage("aggregates_query", self.name):
+            aggregates = self.measurement_repo.get_measurement_aggregates([patient.id]).get(patient.id)
+        if not aggregates:
+            aggregates = MeasurementAggregates(patient.id)
+
+        with stage("probability", self.name):
+            prob = calculate_probability_v1(
+                age=patient.age,
+                last_blood_pressure=self.get_last_blood_pressure(aggregates),
+                mean_respiratory_rate=self.get_mean_respiratory_rate(aggregates),
+                standard_deviation_temperature=self.get_standard_deviation_temperature(aggregates)
+            )
         return prob
 
-    def get_mean_respiratory_rate(self, patient_id: int) -> float:
-        ms = self.measurement_repo.get_all_measurements(patient_id=patient_id, measurement_type="respiratory_rate",
-                                                        offset=0, limit=1000)
-        if not ms or len(ms) == 0:
-            return 0
-        values = [m.value for m in ms]
-
-        return calculate_mean(values)
+    @staticmethod
+    def get_mean_respiratory_rate(aggregates: MeasurementAggregates) -> float:
+        return aggregates.mean(MeasurementType.RESPIRATION_RATE.value)
 
-    def get_last_blood_pressure(self, patient_id: int) -> float:
-        m = self.measurement_repo.get_last_measurement(patient_id=patient_id, measurement_type="blood_pressure")
+    @staticmethod
+    def get_last_blood_pressure(aggregates: MeasurementAggregates) -> float:
+        m = aggregates.last_blood_pressure
         return m.value if m else 0
 
-    def get_standard_deviation_temperature(self, patient_id: int) -> float:
-        ms = self.measurement_repo.get_all_measurements(patient_id=patient_id, measurement_type="temperature",
-                                                        offset=0, limit=1000)
-        if not ms or len(ms) == 0:
+    @staticmethod
+    def get_standard_deviation_temperature(aggregates: MeasurementAggregates) -> float:
+        count = aggregates.count(MeasurementType.TEMPERATURE.value)
+        if count <= 1:
             return 0
-        values = [m.value for m in ms]
-
-        return calculate_standard_deviation(values)
+        return math.sqrt(aggregates.sum_of_squared_deviations(MeasurementType.TEMPERATURE.value) / count)
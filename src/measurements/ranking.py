@@ -0,0 +1,185 @@
+"""
+Ranking of admitted patients by their latest readmission probability, for "the K patients most at risk right now".
+
+The ranking is a Redis sorted set next to current_risk: it's updated with every prediction and read with
+ZREVRANGE, O(log n + k) for any amount of patients. Patients whose last admission is discharged are removed
+and stay out until they are admitted again.
+
+    python -m src.measurements.ranking
+
+rebuilds it from current_risk and admissions, e.g. after a Redis flush. It's also done by warm_cache.
+"""
+import argparse
+import logging
+import time
+from typing import Iterable, List, Set
+
+import redis
+import redis.asyncio
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import Session
+
+from src import models
+from src.config.cache import get_connection_pool
+from src.config.database import SessionLocal
+from src.measurements.cache import to_timestamp, from_timestamp
+
+logger = logging.getLogger(__name__)
+
+# patient ID -> probability
+RANKING_KEY = "readmission-probability:ranking"
+# patient ID -> timestamp of the ranked prediction, so an older prediction that arrives late doesn't replace it
+TIMES_KEY = "readmission-probability:ranking-times"
+DISCHARGED_KEY = "readmission-probability:discharged"
+
+# ARGV is patient ID, probability, timestamp of every prediction
+UPDATE_RANKING_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    local patient_id = ARGV[i]
+    if redis.call('SISMEMBER', KEYS[3], patient_id) == 0 then
+        local ranked = redis.call('HGET', KEYS[2], patient_id)
+        if not ranked or tonumber(ARGV[i + 2]) >= tonumber(ranked) then
+            redis.call('ZADD', KEYS[1], ARGV[i + 1], patient_id)
+            redis.call('HSET', KEYS[2], patient_id, ARGV[i + 2])
+        end
+    end
+end
+"""
+
+
+def update_arguments(predictions: Iterable[models.ReadmissionPrediction]) -> list:
+    args = []
+    for p in predictions:
+        args += [p.patient_id, repr(p.probability), repr(to_timestamp(p.time_created))]
+    return args
+
+
+class ReadmissionRanking:
+    """
+    Updates of the ranking are best effort: a failure is logged and the prediction is still saved,
+    the ranking catches up with the next prediction of the patient or a rebuild.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        self.redis_client = redis_client
+        self.update_script = redis_client.register_script(UPDATE_RANKING_SCRIPT)
+
+    def update(self, predictions: Iterable[models.ReadmissionPrediction]):
+        args = update_arguments(predictions)
+        if not args:
+            return
+        try:
+            self.update_script(keys=[RANKING_KEY, TIMES_KEY, DISCHARGED_KEY], args=args)
+        except redis.RedisError:
+            logger.warning("Readmission ranking was not updated", exc_info=True)
+
+    def discharge(self, patient_ids: Iterable[int]):
+        patient_ids = list(patient_ids)
+        if not patient_ids:
+            return
+        try:
+            with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.sadd(DISCHARGED_KEY, *patient_ids)
+                pipe.zrem(RANKING_KEY, *patient_ids)
+                pipe.hdel(TIMES_KEY, *patient_ids)
+                pipe.execute()
+        except redis.RedisError:
+            logger.warning("Discharged patients %s were not removed from the readmission ranking", patient_ids,
+                           exc_info=True)
+
+    def admit(self, patient_ids: Iterable[int]):
+        patient_ids = list(patient_ids)
+        if not patient_ids:
+            return
+        try:
+            self.redis_client.srem(DISCHARGED_KEY, *patient_ids)
+        except redis.RedisError:
+            logger.warning("Admitted patients %s were not added back to the readmission ranking", patient_ids,
+                           exc_info=True)
+
+    def top(self, k: int) -> List[models.CurrentRisk]:
+        """
+        The k patients with the highest probability, highest first. Raises redis.RedisError.
+        """
+        ranked = self.redis_client.zrevrange(RANKING_KEY, 0, k - 1, withscores=True)
+        if not ranked:
+            return []
+        times = self.redis_client.hmget(TIMES_KEY, [patient_id for patient_id, _ in ranked])
+        return [models.CurrentRisk(patient_id=int(patient_id), probability=probability,
+                                   time_created=from_timestamp(float(t)))
+                for (patient_id, probability), t in zip(ranked, times) if t is not None]
+
+    def size(self) -> int:
+        return self.redis_client.zcard(RANKING_KEY)
+
+    def discharged_ids(self) -> Set[int]:
+        return {int(patient_id) for patient_id in self.redis_client.smembers(DISCHARGED_KEY)}
+
+
+class AsyncReadmissionRanking:
+    """
+    ReadmissionRanking.update for the async ingestion path
+    """
+
+    def __init__(self, redis_client: redis.asyncio.Redis):
+        self.redis_client = redis_client
+        self.update_script = redis_client.register_script(UPDATE_RANKING_SCRIPT)
+
+    async def update(self, predictions: Iterable[models.ReadmissionPrediction]):
+        args = update_arguments(predictions)
+        if not args:
+            return
+        try:
+            await self.update_script(keys=[RANKING_KEY, TIMES_KEY, DISCHARGED_KEY], args=args)
+        except redis.RedisError:
+            logger.warning("Readmission ranking was not updated", exc_info=True)
+
+
+def discharged_patient_ids(db: Session) -> List[int]:
+    """
+    Patients whose last admission has a discharge date
+    """
+    a = models.Admission
+    last = select(a.patient_id, func.max(a.date_admission).label("date_admission")).group_by(a.patient_id).subquery()
+    return db.execute(select(a.patient_id).distinct().join(last, and_(
+        a.patient_id == last.c.patient_id, a.date_admission == last.c.date_admission)).where(
+        a.date_discharge.isnot(None))).scalars().all()
+
+
+def rebuild_ranking(db: Session, ranking: ReadmissionRanking, batch_size: int = 1000) -> int:
+    """
+    Adds the current risk of every admitted patient to the ranking, returns the size of the ranking.
+    Entries that are newer than current_risk(e.g. in the write-behind spool) are kept.
+    """
+    discharged = discharged_patient_ids(db)
+    ranking.admit(ranking.discharged_ids() - set(discharged))
+    for i in range(0, len(discharged), batch_size):
+        ranking.discharge(discharged[i:i + batch_size])
+    batch = []
+    for risk in db.execute(select(models.CurrentRisk).execution_options(yield_per=batch_size)).scalars():
+        batch.append(risk)
+        if len(batch) == batch_size:
+            ranking.update(batch)
+            batch = []
+    ranking.update(batch)
+    return ranking.size()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ranking = ReadmissionRanking(redis.Redis(connection_pool=get_connection_pool()))
+    db = SessionLocal()
+    start = time.monotonic()
+    try:
+        size = rebuild_ranking(db, ranking, batch_size=args.batch_size)
+    finally:
+        db.close()
+    print(f"ranked {size} patients in {time.monotonic() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
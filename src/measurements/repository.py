@@ -1,10 +1,224 @@
+import datetime
+import heapq
 from abc import ABCMeta, abstractmethod
-from typing import List
+from collections import Counter
+from typing import List, Dict, Iterable, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import func, literal, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql import Select
 
 from src import models
+from src.measurements.rollup import merge_rollups, rollup_measurements
+from src.metrics import timed_operation
 from src.models import Admission
+from src.schemas import MeasurementType
+
+
+class MeasurementAggregates:
+    """
+    Count, sum and sum of squares of measurement values per type and the latest blood pressure of a patient.
+    It's enough to restore means and variances without reading the measurements.
+    """
+
+    def __init__(self, patient_id: int, last_blood_pressure: models.Measurement = None):
+        self.patient_id = patient_id
+        self.last_blood_pressure = last_blood_pressure
+        self.totals = {}
+
+    def add(self, measurement_type: str, count: int, total: float, total_of_squares: float):
+        (prev_count, prev_total, prev_total_of_squares) = self.totals.get(measurement_type, (0, 0.0, 0.0))
+        self.totals[measurement_type] = (prev_count + count, prev_total + total,
+                                         prev_total_of_squares + total_of_squares)
+
+    def count(self, measurement_type: str) -> int:
+        return self.totals.get(measurement_type, (0, 0.0, 0.0))[0]
+
+    def mean(self, measurement_type: str) -> float:
+        (count, total, _) = self.totals.get(measurement_type, (0, 0.0, 0.0))
+        return total / count if count else 0.0
+
+    def sum_of_squared_deviations(self, measurement_type: str) -> float:
+        """
+        Returns M2 of Welford's algorithm, the variance multiplied by the count
+        """
+        (count, total, total_of_squares) = self.totals.get(measurement_type, (0, 0.0, 0.0))
+        if not count:
+            return 0.0
+        return max(total_of_squares - total * total / count, 0.0)
+
+    def is_empty(self) -> bool:
+        return not self.totals
+
+
+def measurement_aggregates_query(patient_ids: Iterable[int], before_id: int = None) -> Select:
+    """
+    One grouped query, the latest blood pressure comes from correlated subqueries on the same rows.
+    Shared by the sync and async repositories.
+    """
+
+    def last_blood_pressure(column):
+        last = aliased(models.Measurement)
+        query = select(getattr(last, column)).where(
+            last.patient_id == models.Measurement.patient_id,
+            last.type == MeasurementType.BLOOD_PRESSURE.value,
+        )
+        if before_id is not None:
+            query = query.where(last.id < before_id)
+        return query.order_by(last.time_created.desc(), last.id.desc()).limit(1).scalar_subquery()
+
+    query = select(
+        models.Measurement.patient_id,
+        models.Measurement.type,
+        func.count(models.Measurement.value),
+        func.sum(models.Measurement.value),
+        func.sum(models.Measurement.value * models.Measurement.value),
+        last_blood_pressure("value"),
+        last_blood_pressure("time_created"),
+    ).where(models.Measurement.patient_id.in_(list(patient_ids)))
+    if before_id is not None:
+        query = query.where(models.Measurement.id < before_id)
+    return query.group_by(models.Measurement.patient_id, models.Measurement.type)
+
+
+def rollup_aggregates_query(patient_ids: Iterable[int]) -> Select:
+    """
+    The same columns as measurement_aggregates_query from the hourly rollups of compacted measurements
+    """
+    r = models.MeasurementRollup
+
+    def last_blood_pressure(column):
+        last = aliased(r)
+        return select(getattr(last, column)).where(
+            last.patient_id == r.patient_id,
+            last.type == MeasurementType.BLOOD_PRESSURE.value,
+        ).order_by(last.hour.desc()).limit(1).scalar_subquery()
+
+    return select(
+        r.patient_id,
+        r.type,
+        func.sum(r.count),
+        func.sum(r.mean * r.count),
+        func.sum(r.m2 + r.mean * r.mean * r.count),
+        last_blood_pressure("last_value"),
+        last_blood_pressure("last_time_created"),
+    ).where(r.patient_id.in_(list(patient_ids))).group_by(r.patient_id, r.type)
+
+
+def aggregates_from_rows(rows, aggregates: Dict[int, MeasurementAggregates] = None) -> Dict[
+    int, MeasurementAggregates]:
+    """
+    Adds rows of the aggregate queries to `aggregates`. Rows of raw measurements should come after the rollups,
+    they win when the latest blood pressures have the same time.
+    """
+    aggregates = {} if aggregates is None else aggregates
+    for (patient_id, measurement_type, count, total, total_of_squares, bp_value, bp_time_created) in rows:
+        a = aggregates.get(patient_id)
+        if a is None:
+            a = aggregates[patient_id] = MeasurementAggregates(patient_id)
+        if bp_value is not None and (a.last_blood_pressure is None or
+                                     bp_time_created >= a.last_blood_pressure.time_created):
+            a.last_blood_pressure = models.Measurement(
+                patient_id=patient_id, type=MeasurementType.BLOOD_PRESSURE.value, value=bp_value,
+                time_created=bp_time_created)
+        a.add(measurement_type, count, total, total_of_squares)
+    return aggregates
+
+
+def hourly_measurements_query(patient_id: int, measurement_type: str, since: datetime.datetime = None,
+                              until: datetime.datetime = None) -> (Select, Select):
+    """
+    Rollups of the hours in [since, until) and raw measurements of the same range, see hourly_from_rows
+    """
+    r = models.MeasurementRollup
+    rollups = select(r).where(r.patient_id == patient_id, r.type == measurement_type)
+    m = models.Measurement
+    raw = select(m).where(m.patient_id == patient_id, m.type == measurement_type)
+    if since:
+        rollups = rollups.where(r.hour >= since)
+        raw = raw.where(m.time_created >= since)
+    if until:
+        rollups = rollups.where(r.hour < until)
+        raw = raw.where(m.time_created < until)
+    return rollups, raw.order_by(m.time_created, m.id)
+
+
+def hourly_from_rows(rollups: Iterable[models.MeasurementRollup],
+                     measurements: Iterable[models.Measurement]) -> List[models.MeasurementRollup]:
+    """
+    Folds the recent raw measurements into hourly rollups and merges them with the stored ones, oldest hour first.
+    Returned objects are detached copies, the stored rollups are not changed.
+    """
+    hours = {}
+    for rollup in rollups:
+        hours[rollup.hour] = models.MeasurementRollup(
+            patient_id=rollup.patient_id, type=rollup.type, hour=rollup.hour, count=rollup.count, mean=rollup.mean,
+            min=rollup.min, max=rollup.max, m2=rollup.m2, last_value=rollup.last_value,
+            last_time_created=rollup.last_time_created)
+    for (patient_id, measurement_type, hour), rollup in rollup_measurements(measurements).items():
+        hours[hour] = merge_rollups(hours[hour], rollup) if hour in hours else rollup
+    return [hours[hour] for hour in sorted(hours)]
+
+
+def keyset_before(time_column, id_column, before: Tuple[datetime.datetime, int]):
+    # The values are bound with the column types, so SQLite compares datetimes in the format it stores them
+    (time_created, item_id) = before
+    return tuple_(time_column, id_column) < tuple_(literal(time_created, time_column.type),
+                                                   literal(item_id, id_column.type))
+
+
+def history_key(item) -> Tuple[datetime.datetime, int]:
+    # Position of a measurement or a rollup in the history, a rollup is at the start of its hour
+    if isinstance(item, models.MeasurementRollup):
+        return item.hour, 0
+    return item.time_created, item.id
+
+
+def counter_increments(measurements: Iterable[models.Measurement] = (),
+                       predictions: Iterable[models.ReadmissionPrediction] = ()) -> List[dict]:
+    counts = Counter()
+    for m in measurements:
+        counts[(m.patient_id, m.type)] += 1
+    for p in predictions:
+        counts[(p.patient_id, models.PREDICTIONS_COUNTER)] += 1
+    return [{"patient_id": patient_id, "name": name, "value": value} for (patient_id, name), value in counts.items()]
+
+
+def increment_counters_statement(dialect_name: str):
+    """
+    Upsert that adds to the patient counters, executed with the rows of counter_increments
+    """
+    table = models.PatientCounter.__table__
+    insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    statement = insert(table)
+    return statement.on_conflict_do_update(index_elements=[table.c.patient_id, table.c.name],
+                                           set_={"value": table.c.value + statement.excluded.value})
+
+
+def current_risk_rows(predictions: Iterable[models.ReadmissionPrediction]) -> List[dict]:
+    # The latest prediction of every patient, the later one in the list on equal times
+    latest = {}
+    for p in predictions:
+        if p.patient_id not in latest or p.time_created >= latest[p.patient_id].time_created:
+            latest[p.patient_id] = p
+    return [{"patient_id": p.patient_id, "time_created": p.time_created, "probability": p.probability}
+            for p in latest.values()]
+
+
+def upsert_current_risk_statement(dialect_name: str):
+    """
+    Upsert of current_risk, executed with the rows of current_risk_rows.
+    Predictions older than the stored one don't replace it, e.g. of measurements that arrived late.
+    """
+    table = models.CurrentRisk.__table__
+    insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    statement = insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.patient_id],
+        set_={"time_created": statement.excluded.time_created, "probability": statement.excluded.probability},
+        where=statement.excluded.time_created >= table.c.time_created)
 
 
 class MeasurementRepository(metaclass=ABCMeta):
@@ -18,46 +232,182 @@ class MeasurementRepository(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100) -> List[
-        models.Measurement]:
+    def save_measurements_with_predictions(self,
+                                           measurements: List[models.Measurement],
+                                           predictions: List[models.ReadmissionPrediction]) -> None:
+        """
+        Saves measurements and their predictions in a single transaction.
+        """
+        pass
+
+    @abstractmethod
+    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100,
+                             before: Tuple[datetime.datetime, int] = None) -> List[models.Measurement]:
+        """
+        Returns measurements from the newest. `before` is a keyset cursor: (time_created, id) of the last
+        measurement of the previous page, then `offset` is not used.
+        """
+        pass
+
+    def get_measurement_rollups(self, patient_id: int, measurement_type: str, limit: int = 100,
+                                before: Tuple[datetime.datetime, int] = None) -> List[models.MeasurementRollup]:
+        """
+        Hourly rollups of compacted measurements from the newest, `before` is a cursor of get_measurement_history.
+        Storages without retention have none.
+        """
+        return []
+
+    def count_measurement_rollups(self, patient_id: int, measurement_type: str) -> int:
+        return 0
+
+    def get_measurement_history(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100,
+                                before: Tuple[datetime.datetime, int] = None) -> List:
+        """
+        Measurements and the hourly rollups of compacted ones from the newest, paged like get_all_measurements.
+        A rollup is at (hour, 0), see history_key. Both are read with a limit and merged, a patient without
+        rollups costs the same as get_all_measurements.
+        """
+        size = limit if before else offset + limit
+        rollups = self.get_measurement_rollups(patient_id, measurement_type, size, before)
+        if not rollups:
+            return self.get_all_measurements(patient_id, measurement_type, offset, limit, before)
+        measurements = self.get_all_measurements(patient_id, measurement_type, 0, size, before)
+        items = list(heapq.merge(measurements, rollups, key=history_key, reverse=True))
+        return items[:limit] if before else items[offset:offset + limit]
+
+    @abstractmethod
+    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100,
+                            before: Tuple[datetime.datetime, int] = None) -> List[models.ReadmissionPrediction]:
+        """
+        The same as get_all_measurements, the cursor is (time_created, internal_id)
+        """
+        pass
+
+    @abstractmethod
+    def count_measurements(self, patient_id: int, measurement_type: str) -> int:
+        """
+        Raw measurements, the compacted ones are counted by count_measurement_rollups
+        """
+        pass
+
+    @abstractmethod
+    def count_predictions(self, patient_id: int) -> int:
         pass
 
     @abstractmethod
-    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100) -> List[
-        models.ReadmissionPrediction]:
+    def get_current_risk(self, patient_ids: Iterable[int]) -> List[models.CurrentRisk]:
+        """
+        The latest prediction of the patients that have one
+        """
         pass
 
     @abstractmethod
     def get_last_measurement(self, patient_id: int, measurement_type: str) -> models.Measurement:
         pass
 
+    @abstractmethod
+    def get_measurement_aggregates(self, patient_ids: Iterable[int], before_id: int = None) -> Dict[
+        int, MeasurementAggregates]:
+        """
+        Returns aggregates of the patients that have measurements.
+        If before_id is given, only measurements saved before it are taken into account.
+        Hourly rollups of compacted measurements are always included.
+        """
+        pass
+
+    @abstractmethod
+    def get_hourly_measurements(self, patient_id: int, measurement_type: str, since: datetime.datetime = None,
+                                until: datetime.datetime = None) -> List[models.MeasurementRollup]:
+        """
+        Hourly aggregates of a patient's measurements of a type, from rollups and recent raw measurements
+        """
+        pass
+
+    @abstractmethod
+    def get_patient_ids_with_measurements(self, since: datetime.datetime = None) -> List[int]:
+        pass
+
 
 class MeasurementSQLiteRepository(MeasurementRepository):
 
     def __init__(self, db_session):
         self.db: Session = db_session
 
+    @timed_operation("measurement")
     def save_measurement(self, measurement: models.Measurement) -> models.Measurement:
         self.db.add(measurement)
+        self.increment_counters(counter_increments(measurements=[measurement]))
         self.db.commit()
         self.db.refresh(measurement)
         return measurement
 
+    @timed_operation("measurement")
     def save_prediction(self, prediction: models.ReadmissionPrediction) -> models.ReadmissionPrediction:
         self.db.add(prediction)
+        self.increment_counters(counter_increments(predictions=[prediction]))
+        self.update_current_risk([prediction])
         self.db.commit()
         self.db.refresh(prediction)
         return prediction
 
-    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100) -> List[
-        models.Measurement]:
-        if not measurement_type:
-            return self.db.query(models.Measurement).filter(models.Measurement.patient_id == patient_id).order_by(
-                models.Measurement.time_created.desc()).offset(offset).limit(limit).all()
-        return self.db.query(models.Measurement).filter(models.Measurement.patient_id == patient_id,
-                                                        models.Measurement.type == measurement_type).order_by(
-            models.Measurement.time_created.desc()).offset(offset).limit(limit).all()
+    @timed_operation("measurement")
+    def save_measurements_with_predictions(self,
+                                           measurements: List[models.Measurement],
+                                           predictions: List[models.ReadmissionPrediction]) -> None:
+        # Bulk inserts skip the per-object refresh, which is what makes a batch cheap
+        try:
+            self.db.bulk_save_objects(measurements)
+            self.db.bulk_save_objects(predictions)
+            self.increment_counters(counter_increments(measurements, predictions))
+            self.update_current_risk(predictions)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def increment_counters(self, increments: List[dict]):
+        # In the same transaction as the rows, so the counters can't drift
+        if increments:
+            self.db.execute(increment_counters_statement(self.db.get_bind().dialect.name), increments)
+
+    def update_current_risk(self, predictions: List[models.ReadmissionPrediction]):
+        if predictions:
+            self.db.execute(upsert_current_risk_statement(self.db.get_bind().dialect.name),
+                            current_risk_rows(predictions))
+
+    @timed_operation("measurement")
+    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100,
+                             before: Tuple[datetime.datetime, int] = None) -> List[models.Measurement]:
+        m = models.Measurement
+        query = self.db.query(m).filter(m.patient_id == patient_id)
+        if measurement_type:
+            query = query.filter(m.type == measurement_type)
+        query = query.order_by(m.time_created.desc(), m.id.desc())
+        if before:
+            query = query.filter(keyset_before(m.time_created, m.id, before))
+        else:
+            query = query.offset(offset)
+        return query.limit(limit).all()
+
+    @timed_operation("measurement")
+    def get_measurement_rollups(self, patient_id: int, measurement_type: str, limit: int = 100,
+                                before: Tuple[datetime.datetime, int] = None) -> List[models.MeasurementRollup]:
+        r = models.MeasurementRollup
+        query = self.db.query(r).filter(r.patient_id == patient_id, r.type == measurement_type)
+        if before:
+            # Measurements at the start of an hour come before its rollup, they have ids above 0
+            (time_created, item_id) = before
+            bound = literal(time_created, r.hour.type)
+            query = query.filter(r.hour <= bound if item_id > 0 else r.hour < bound)
+        return query.order_by(r.hour.desc()).limit(limit).all()
+
+    @timed_operation("measurement")
+    def count_measurement_rollups(self, patient_id: int, measurement_type: str) -> int:
+        r = models.MeasurementRollup
+        return self.db.query(func.count()).select_from(r).filter(r.patient_id == patient_id,
+                                                                 r.type == measurement_type).scalar()
 
+    @timed_operation("measurement")
     def get_last_measurement(self, patient_id: int, measurement_type: str) -> models.Measurement:
         if not measurement_type:
             return self.db.query(models.Measurement).filter(models.Measurement.patient_id == patient_id).order_by(
@@ -66,9 +416,104 @@ class MeasurementSQLiteRepository(MeasurementRepository):
                                                         models.Measurement.type == measurement_type).order_by(
             models.Measurement.time_created.desc()).first()
 
-    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100) -> List[
-        models.ReadmissionPrediction]:
-        return self.db.query(models.ReadmissionPrediction).filter(
-            models.ReadmissionPrediction.patient_id == patient_id).order_by(
-            models.ReadmissionPrediction.time_created.desc()).offset(offset).limit(
-            limit).all()
+    @timed_operation("measurement")
+    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100,
+                            before: Tuple[datetime.datetime, int] = None) -> List[models.ReadmissionPrediction]:
+        p = models.ReadmissionPrediction
+        query = self.db.query(p).filter(p.patient_id == patient_id)
+        query = query.order_by(p.time_created.desc(), p.internal_id.desc())
+        if before:
+            query = query.filter(keyset_before(p.time_created, p.internal_id, before))
+        else:
+            query = query.offset(offset)
+        return query.limit(limit).all()
+
+    @timed_operation("measurement")
+    def get_current_risk(self, patient_ids: Iterable[int]) -> List[models.CurrentRisk]:
+        return self.db.query(models.CurrentRisk).filter(models.CurrentRisk.patient_id.in_(list(patient_ids))).all()
+
+    @timed_operation("measurement")
+    def count_measurements(self, patient_id: int, measurement_type: str) -> int:
+        return self.get_counter(patient_id, measurement_type)
+
+    @timed_operation("measurement")
+    def count_predictions(self, patient_id: int) -> int:
+        return self.get_counter(patient_id, models.PREDICTIONS_COUNTER)
+
+    def get_counter(self, patient_id: int, name: str) -> int:
+        value = self.db.query(models.PatientCounter.value).filter(models.PatientCounter.patient_id == patient_id,
+                                                                  models.PatientCounter.name == name).scalar()
+        return value or 0
+
+    @timed_operation("measurement")
+    def get_measurement_aggregates(self, patient_ids: Iterable[int], before_id: int = None) -> Dict[
+        int, MeasurementAggregates]:
+        patient_ids = list(patient_ids)
+        aggregates = aggregates_from_rows(self.db.execute(rollup_aggregates_query(patient_ids)).all())
+        return aggregates_from_rows(self.db.execute(measurement_aggregates_query(patient_ids, before_id)).all(),
+                                    aggregates)
+
+    @timed_operation("measurement")
+    def get_hourly_measurements(self, patient_id: int, measurement_type: str, since: datetime.datetime = None,
+                                until: datetime.datetime = None) -> List[models.MeasurementRollup]:
+        (rollups, raw) = hourly_measurements_query(patient_id, measurement_type, since, until)
+        return hourly_from_rows(self.db.execute(rollups).scalars(), self.db.execute(raw).scalars())
+
+    def get_patient_ids_with_measurements(self, since: datetime.datetime = None) -> List[int]:
+        query = self.db.query(models.Measurement.patient_id).distinct()
+        if since:
+            query = query.filter(models.Measurement.time_created >= since)
+        return [patient_id for (patient_id,) in query.order_by(models.Measurement.patient_id).all()]
+
+
+class AsyncMeasurementRepository(metaclass=ABCMeta):
+    """
+    What the async ingestion path needs from the measurements storage, see AsyncMeasurementService
+    """
+
+    @abstractmethod
+    async def save_measurement(self, measurement: models.Measurement) -> models.Measurement:
+        pass
+
+    @abstractmethod
+    async def save_prediction(self, prediction: models.ReadmissionPrediction) -> models.ReadmissionPrediction:
+        pass
+
+    @abstractmethod
+    async def get_measurement_aggregates(self, patient_ids: Iterable[int], before_id: int = None) -> Dict[
+        int, MeasurementAggregates]:
+        pass
+
+
+class MeasurementAsyncSQLiteRepository(AsyncMeasurementRepository):
+
+    def __init__(self, db_session):
+        self.db: AsyncSession = db_session
+
+    @timed_operation("measurement_async")
+    async def save_measurement(self, measurement: models.Measurement) -> models.Measurement:
+        # The session doesn't expire objects on commit, so the generated id is known without a refresh
+        self.db.add(measurement)
+        await self.increment_counters(counter_increments(measurements=[measurement]))
+        await self.db.commit()
+        return measurement
+
+    @timed_operation("measurement_async")
+    async def save_prediction(self, prediction: models.ReadmissionPrediction) -> models.ReadmissionPrediction:
+        self.db.add(prediction)
+        await self.increment_counters(counter_increments(predictions=[prediction]))
+        await self.db.execute(upsert_current_risk_statement(self.db.get_bind().dialect.name),
+                              current_risk_rows([prediction]))
+        await self.db.commit()
+        return prediction
+
+    async def increment_counters(self, increments: List[dict]):
+        await self.db.execute(increment_counters_statement(self.db.get_bind().dialect.name), increments)
+
+    @timed_operation("measurement_async")
+    async def get_measurement_aggregates(self, patient_ids: Iterable[int], before_id: int = None) -> Dict[
+        int, MeasurementAggregates]:
+        patient_ids = list(patient_ids)
+        rollups = await self.db.execute(rollup_aggregates_query(patient_ids))
+        result = await self.db.execute(measurement_aggregates_query(patient_ids, before_id))
+        return aggregates_from_rows(result.all(), aggregates_from_rows(rollups.all()))
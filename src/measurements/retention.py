@@ -0,0 +1,157 @@
+"""
+Retention of raw measurements: rows older than the retention age are compacted into hourly rollups
+(see src.measurements.rollup), then deleted, or archived(gzipped CSV or columnar) and deleted.
+
+    python -m src.measurements.retention --older-than-hours 168 --archive-dir archive
+
+The aggregates of the prediction models and the hourly endpoint combine rollups with the raw rows that are left,
+so compaction doesn't change predictions. Runs are incremental: a batch of raw rows is merged into the rollups
+and removed in one transaction, and late measurements of an hour that is already compacted are merged into it.
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import logging
+import os
+import time
+from collections import Counter
+from typing import Callable, List
+
+import redis
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from src import models
+from src.config.cache import get_connection_pool
+from src.config.database import SessionLocal
+from src.measurements.archive import write_archive
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.measurements.rollup import hour_of, merge_rollups, rollup_measurements
+from src.patient.versions import PatientVersionRedisStore
+
+logger = logging.getLogger(__name__)
+
+# Raw measurements older than that are compacted
+RETENTION_HOURS = float(os.getenv("MEASUREMENT_RAW_RETENTION_HOURS", 7 * 24))
+
+
+class CsvArchive:
+    """
+    Writes compacted raw rows to gzipped CSV files, one per batch, before they are deleted
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, measurements: List[models.Measurement]):
+        path = os.path.join(self.directory, f"measurements-{measurements[0].id}-{measurements[-1].id}.csv.gz")
+        with gzip.open(path, "wt", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "patient_id", "type", "value", "time_created"])
+            writer.writerows((m.id, m.patient_id, m.type, m.value, m.time_created.isoformat()) for m in measurements)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ColumnarArchive(CsvArchive):
+    """
+    Writes compacted raw rows to columnar archives(see src.measurements.archive), one per batch
+    """
+
+    def __call__(self, measurements: List[models.Measurement]):
+        path = os.path.join(self.directory, f"measurements-{measurements[0].id}-{measurements[-1].id}.mca")
+        write_archive(path, sorted(measurements, key=lambda m: (m.patient_id, m.time_created, m.id)))
+
+
+ARCHIVES = {"csv": CsvArchive, "columnar": ColumnarArchive}
+
+
+def compact_batch(db: Session, cutoff: datetime.datetime, after_id: int, batch_size: int,
+                  archive: Callable[[List[models.Measurement]], None] = None) -> (int, int):
+    """
+    Compacts up to batch_size raw measurements older than the cutoff with ids after `after_id`.
+    Returns the amount of compacted measurements and the last id.
+    """
+    m = models.Measurement
+    measurements = db.execute(select(m).where(m.time_created < cutoff, m.id > after_id).order_by(m.id).limit(
+        batch_size)).scalars().all()
+    if not measurements:
+        return 0, after_id
+    last_id = measurements[-1].id
+    try:
+        rollups = rollup_measurements(measurements)
+        r = models.MeasurementRollup
+        existing = db.execute(select(r).where(
+            r.patient_id.in_({key[0] for key in rollups}),
+            r.hour >= min(key[2] for key in rollups),
+            r.hour <= max(key[2] for key in rollups),
+        )).scalars()
+        for rollup in existing:
+            key = (rollup.patient_id, rollup.type, rollup.hour)
+            if key in rollups:
+                rollups[key] = merge_rollups(rollup, rollups[key])
+        db.add_all(rollups.values())
+
+        if archive:
+            archive(measurements)
+        db.execute(delete(m).where(m.time_created < cutoff, m.id > after_id, m.id <= last_id))
+        # Totals of the history endpoints count raw rows
+        counts = Counter((x.patient_id, x.type) for x in measurements)
+        MeasurementSQLiteRepository(db).increment_counters(
+            [{"patient_id": patient_id, "name": name, "value": -value} for (patient_id, name), value in counts.items()])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(measurements), last_id
+
+
+def compact_measurements(db: Session, older_than: datetime.timedelta = datetime.timedelta(hours=RETENTION_HOURS),
+                         batch_size: int = 10000, archive: Callable[[List[models.Measurement]], None] = None,
+                         now: datetime.datetime = None, versions: PatientVersionRedisStore = None) -> int:
+    """
+    Compacts all raw measurements before the start of the hour `older_than` ago, returns their amount.
+    Whole hours are compacted, so an hour never has both rollups and raw rows unless measurements arrive late.
+    Pages of raw measurements change, so cached responses are invalidated with `versions` after every batch.
+    """
+    cutoff = hour_of((now or datetime.datetime.utcnow()) - older_than)
+    (compacted, last_id) = (0, 0)
+    while True:
+        (n, last_id) = compact_batch(db, cutoff, last_id, batch_size, archive)
+        compacted += n
+        if n and versions:
+            versions.bump_all()
+        if n:
+            logger.info("Compacted %d measurements before %s", compacted, cutoff)
+        if n < batch_size:
+            return compacted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--older-than-hours", type=float, default=RETENTION_HOURS,
+                        help="Retention of raw measurements, MEASUREMENT_RAW_RETENTION_HOURS by default")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Raw measurements per transaction")
+    parser.add_argument("--archive-dir", default=None,
+                        help="Write compacted raw measurements to files there, they are only deleted by default")
+    parser.add_argument("--archive-format", choices=list(ARCHIVES), default="csv",
+                        help="Gzipped CSV or columnar archives that MeasurementArchive can read")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    archive = ARCHIVES[args.archive_format](args.archive_dir) if args.archive_dir else None
+    db = SessionLocal()
+    start = time.monotonic()
+    try:
+        compacted = compact_measurements(db, datetime.timedelta(hours=args.older_than_hours), args.batch_size,
+                                         archive=archive, versions=PatientVersionRedisStore(
+                                             redis.Redis(connection_pool=get_connection_pool())))
+    finally:
+        db.close()
+    print(f"compacted {compacted} measurements in {time.monotonic() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
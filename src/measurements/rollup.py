@@ -0,0 +1,58 @@
+"""
+Hourly rollups of measurements per patient and type: count, mean, min, max, M2 and the last value.
+Rollups are built with Welford's updates and merged with Chan's formula, so they can be combined with each other
+and with raw measurements of the same hour without losing precision.
+"""
+import datetime
+from typing import Dict, Iterable, Tuple
+
+from src import models
+
+RollupKey = Tuple[int, str, datetime.datetime]
+
+
+def hour_of(t: datetime.datetime) -> datetime.datetime:
+    return t.replace(minute=0, second=0, microsecond=0)
+
+
+def add_measurement(rollup: models.MeasurementRollup, m: models.Measurement) -> models.MeasurementRollup:
+    """
+    Adds a measurement to the rollup of its hour with Welford's update, a new rollup is created for None
+    """
+    if rollup is None:
+        return models.MeasurementRollup(patient_id=m.patient_id, type=m.type, hour=hour_of(m.time_created), count=1,
+                                        mean=m.value, min=m.value, max=m.value, m2=0.0, last_value=m.value,
+                                        last_time_created=m.time_created)
+    rollup.count += 1
+    delta = m.value - rollup.mean
+    rollup.mean += delta / rollup.count
+    rollup.m2 += delta * (m.value - rollup.mean)
+    rollup.min = min(rollup.min, m.value)
+    rollup.max = max(rollup.max, m.value)
+    if m.time_created >= rollup.last_time_created:
+        (rollup.last_value, rollup.last_time_created) = (m.value, m.time_created)
+    return rollup
+
+
+def merge_rollups(into: models.MeasurementRollup, other: models.MeasurementRollup) -> models.MeasurementRollup:
+    """
+    Merges two rollups of the same hour into the first one, M2 is combined with Chan's formula
+    """
+    count = into.count + other.count
+    delta = other.mean - into.mean
+    into.m2 = into.m2 + other.m2 + delta * delta * into.count * other.count / count
+    into.mean = into.mean + delta * other.count / count
+    into.count = count
+    into.min = min(into.min, other.min)
+    into.max = max(into.max, other.max)
+    if other.last_time_created >= into.last_time_created:
+        (into.last_value, into.last_time_created) = (other.last_value, other.last_time_created)
+    return into
+
+
+def rollup_measurements(measurements: Iterable[models.Measurement]) -> Dict[RollupKey, models.MeasurementRollup]:
+    rollups = {}
+    for m in measurements:
+        key = (m.patient_id, m.type, hour_of(m.time_created))
+        rollups[key] = add_measurement(rollups.get(key), m)
+    return rollups
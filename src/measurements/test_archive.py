@@ -0,0 +1,86 @@
+import datetime
+import random
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models
+from src.config.database import Base
+from src.measurements.archive import export_archive, MeasurementArchive, write_archive
+from src.measurements.repository import MeasurementSQLiteRepository
+
+START = datetime.datetime(2021, 1, 1)
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+def as_tuples(items) -> list:
+    return [(getattr(i, "id", None) or i.internal_id, i.patient_id, i.time_created, getattr(i, "type", None),
+             getattr(i, "value", None) or getattr(i, "probability", None)) for i in items]
+
+
+def test_archive_answers_like_the_repository(db, tmp_path):
+    rnd = random.Random(1)
+    measurements, predictions = [], []
+    for _ in range(600):
+        # Whole minutes, so rows share timestamps and pages have to break ties by id
+        t = START + datetime.timedelta(minutes=rnd.randrange(3 * 24 * 60) // 30 * 30)
+        patient_id = rnd.choice([1, 2, 7])
+        measurements.append(models.Measurement(patient_id=patient_id, type=rnd.choice(TYPES[:3]),
+                                               value=rnd.uniform(30, 140), time_created=t))
+        predictions.append(models.ReadmissionPrediction(patient_id=patient_id, time_created=t,
+                                                        probability=rnd.random()))
+    repo = MeasurementSQLiteRepository(db)
+    repo.save_measurements_with_predictions(measurements, predictions)
+
+    path = str(tmp_path / "archive.mca")
+    # The last day stays out of the archive
+    assert export_archive(db, path, since=START, until=START + datetime.timedelta(days=2), batch_size=50) == {
+        "measurements": sum(m.time_created < START + datetime.timedelta(days=2) for m in measurements),
+        "predictions": sum(p.time_created < START + datetime.timedelta(days=2) for p in predictions),
+    }
+    until = (START + datetime.timedelta(days=2), 0)
+
+    with MeasurementArchive(path) as archive:
+        assert archive.patient_ids() == [1, 2, 7]
+        for patient_id in (1, 2, 7, 3):
+            for measurement_type in ("temperature", "blood_pressure", "heart_rate", None):
+                # Everything the repository has before the end of the archive, newest first
+                expected = repo.get_all_measurements(patient_id, measurement_type, limit=1000, before=until)
+                for offset, limit in ((0, 100), (5, 7), (1000, 10)):
+                    assert as_tuples(archive.get_all_measurements(patient_id, measurement_type, offset, limit)) == \
+                           as_tuples(expected[offset:offset + limit])
+                if len(expected) > 10:
+                    before = (expected[9].time_created, expected[9].id)
+                    assert as_tuples(archive.get_all_measurements(patient_id, measurement_type, limit=5,
+                                                                  before=before)) == as_tuples(expected[10:15])
+
+            expected = repo.get_all_predictions(patient_id, limit=1000, before=until)
+            assert as_tuples(archive.get_all_predictions(patient_id, 3, 20)) == as_tuples(expected[3:23])
+            if expected:
+                before = (expected[4].time_created, expected[4].internal_id)
+                assert as_tuples(archive.get_all_predictions(patient_id, before=before)) == as_tuples(
+                    expected[5:105])
+
+
+def test_write_archive_from_objects(tmp_path):
+    measurements = [models.Measurement(id=i, patient_id=5, type="temperature", value=36 + i / 10,
+                                       time_created=START + datetime.timedelta(minutes=i)) for i in range(1, 100)]
+    path = str(tmp_path / "archive.mca")
+    assert write_archive(path, measurements) == {"measurements": 99, "predictions": 0}
+
+    with MeasurementArchive(path) as archive:
+        # A minute between measurements fits in uint32 microseconds
+        assert archive.footer["tables"]["measurements"]["columns"]["time_delta"]["dtype"] == "<u4"
+        assert as_tuples(archive.get_all_measurements(5, "temperature", limit=1000)) == as_tuples(measurements[::-1])
+        assert archive.get_all_predictions(5) == []
@@ -0,0 +1,169 @@
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models, schemas
+from src.config.database import Base
+from src.measurement_service import MeasurementService
+from src.measurements import bulk_import
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel, FastReadmissionState
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+from src.patient.repository import PatientSQLiteRepository
+
+SIGNALS = [
+    (1, "2021-01-01", 2, "temperature", 36.6),
+    (2, "2021-01-01", 1, "blood_pressure", 120),
+    (1, "2021-01-01", 1, "blood_pressure", 130),
+    (1, "2021-01-01", 3, "respiration_rate", 12),
+    (3, "2021-01-01", 1, "temperature", 37),
+    (1, "2021-01-01", 4, "temperature", 38.1),
+    (2, "2021-01-01", 2, "temperature", 39),
+]
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+def write_csv(path, header, rows):
+    path.write_text("\n".join([";".join(header)] + [";".join(str(v) for v in row) for row in rows]) + "\n")
+    return str(path)
+
+
+def test_bulk_import_matches_the_service(engine, tmp_path):
+    ages = write_csv(tmp_path / "age.csv", ["", "pat_id", "age"], [(0, 1, 50.0), (1, 2, 70.0)])
+    signals = write_csv(tmp_path / "signal.csv", ["pat_id", "day", "hour", "parameter", "value"], SIGNALS)
+
+    assert bulk_import.import_patients(engine, ages, transaction_size=1) == 2
+    (imported, patient_ids) = bulk_import.import_signals(engine, signals, transaction_size=4)
+    # Signals of unknown patients are skipped
+    assert (imported, patient_ids) == (6, [1, 2])
+    states = bulk_import.calculate_predictions(engine, patient_ids, patients_per_pass=1)
+    assert sorted(states) == [1, 2]
+
+    # The service with the fast model, signals sent in the order of time
+    service_engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=service_engine)
+    db = sessionmaker(bind=service_engine)()
+    db.add_all([models.Patient(id=1, age=50), models.Patient(id=2, age=70)])
+    db.commit()
+    service = MeasurementService(patient_repo=PatientSQLiteRepository(db),
+                                 measurement_repo=MeasurementSQLiteRepository(db),
+                                 prediction_model=FastReadmissionPredictionModel(cache=DummyFastReadmissionCache()))
+    for (patient_id, day, hour, parameter, value) in sorted(SIGNALS, key=lambda s: (s[0], s[2])):
+        if patient_id != 3:
+            service.save_measurement(schemas.MeasurementIn(patient_id=patient_id, day=day, hour=hour,
+                                                           parameter=parameter, value=value))
+
+    def predictions(e):
+        p = models.ReadmissionPrediction
+        with e.connect() as conn:
+            return conn.execute(select(p.patient_id, p.time_created, p.probability).order_by(
+                p.patient_id, p.time_created)).all()
+
+    assert predictions(engine) == predictions(service_engine)
+
+    def counters(e):
+        c = models.PatientCounter
+        with e.connect() as conn:
+            return conn.execute(select(c.patient_id, c.name, c.value).order_by(c.patient_id, c.name)).all()
+
+    assert counters(engine) == counters(service_engine)
+
+    def current_risk(e):
+        c = models.CurrentRisk
+        with e.connect() as conn:
+            return conn.execute(select(c.patient_id, c.time_created, c.probability).order_by(c.patient_id)).all()
+
+    assert current_risk(engine) == current_risk(service_engine) != []
+
+
+def test_bulk_import_keeps_earlier_history(engine, tmp_path):
+    ages = write_csv(tmp_path / "age.csv", ["", "pat_id", "age"], [(0, 1, 50.0)])
+    bulk_import.import_patients(engine, ages, transaction_size=10)
+    first = write_csv(tmp_path / "first.csv", ["pat_id", "day", "hour", "parameter", "value"], SIGNALS[:3])
+    second = write_csv(tmp_path / "second.csv", ["pat_id", "day", "hour", "parameter", "value"], SIGNALS[3:])
+
+    (_, patient_ids) = bulk_import.import_signals(engine, first, transaction_size=10)
+    bulk_import.calculate_predictions(engine, patient_ids)
+    (imported, patient_ids) = bulk_import.import_signals(engine, second, transaction_size=10)
+    states = bulk_import.calculate_predictions(engine, patient_ids)
+
+    assert (imported, patient_ids) == (2, [1])
+    # Predictions are added only for the new signals, but the state includes all of them
+    with engine.connect() as conn:
+        assert len(conn.execute(select(models.ReadmissionPrediction.patient_id)).all()) == 4
+    assert states[1].temperature_count == 2
+    assert states[1].last_blood_pressure.value == 130
+
+
+def test_seed_cache_replaces_states_cached_before_the_import(engine, tmp_path):
+    ages = write_csv(tmp_path / "age.csv", ["", "pat_id", "age"], [(0, 1, 50.0), (1, 2, 70.0)])
+    signals = write_csv(tmp_path / "signal.csv", ["pat_id", "day", "hour", "parameter", "value"], SIGNALS)
+    bulk_import.import_patients(engine, ages, transaction_size=10)
+    (_, patient_ids) = bulk_import.import_signals(engine, signals, transaction_size=10)
+    states = bulk_import.calculate_predictions(engine, patient_ids)
+
+    cache = DummyFastReadmissionCache()
+    cache.seed_state(1, FastReadmissionState(temperature_mean=30.0, temperature_count=5))
+    bulk_import.seed_cache(cache, states)
+
+    # The state cached before the import doesn't hide the imported signals
+    assert cache.get_standard_deviation_temperature(1)[2] == 2
+    assert cache.get_last_blood_pressure(1).value == 130
+    assert cache.get_last_blood_pressure(2).value == 120
+
+
+def test_rerun_of_admissions_import_skips_existing_admissions(engine, tmp_path):
+    header = ["", "pat_id", "date_admission", "date_discharge"]
+    first = write_csv(tmp_path / "first.csv", header, [(0, 1, "01/01/2021", "05/01/2021"), (1, 2, "02/01/2021", "")])
+    second = write_csv(tmp_path / "second.csv", header, [(0, 1, "01/01/2021", "05/01/2021"),
+                                                        (1, 2, "02/01/2021", ""), (2, 2, "10/01/2021", "")])
+
+    assert bulk_import.import_admissions(engine, first, transaction_size=10) == 2
+    assert bulk_import.import_admissions(engine, second, transaction_size=10) == 1
+    with engine.connect() as conn:
+        assert len(conn.execute(select(models.Admission.internal_id)).all()) == 3
+
+
+def test_rerun_after_a_failed_chunk_completes_the_import(engine, tmp_path):
+    ages = write_csv(tmp_path / "age.csv", ["", "pat_id", "age"], [(0, 1, 50.0), (1, 2, 70.0)])
+    header = ["pat_id", "day", "hour", "parameter", "value"]
+    broken = write_csv(tmp_path / "broken.csv", header, SIGNALS[:4] + [(1, "2021-01-01", 4, "temperature", "?")])
+    signals = write_csv(tmp_path / "signal.csv", header, SIGNALS)
+    bulk_import.import_patients(engine, ages, transaction_size=10)
+
+    # Two transactions are committed, the third one fails and nothing gets predictions
+    with pytest.raises(ValueError):
+        bulk_import.import_signals(engine, broken, transaction_size=2)
+    (imported, patient_ids) = bulk_import.import_signals(engine, signals, transaction_size=2)
+    states = bulk_import.calculate_predictions(engine, patient_ids)
+    assert imported == 2
+    # A rerun of a complete import changes nothing
+    assert bulk_import.import_signals(engine, signals, transaction_size=2) == (0, [1, 2])
+    assert bulk_import.calculate_predictions(engine, patient_ids)[1].temperature_count == 2
+
+    expected = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=expected)
+    bulk_import.import_patients(expected, ages, transaction_size=10)
+    expected_states = bulk_import.calculate_predictions(
+        expected, bulk_import.import_signals(expected, signals, transaction_size=10)[1])
+
+    def rows(e):
+        p = models.ReadmissionPrediction
+        m = models.Measurement
+        c = models.PatientCounter
+        with e.connect() as conn:
+            return (conn.execute(select(m.patient_id, m.type, m.value, m.time_created).order_by(
+                        m.patient_id, m.time_created, m.type)).all(),
+                    conn.execute(select(p.patient_id, p.time_created, p.probability).order_by(
+                        p.patient_id, p.time_created)).all(),
+                    conn.execute(select(c.patient_id, c.name, c.value).order_by(c.patient_id, c.name)).all())
+
+    assert rows(engine) == rows(expected)
+    assert {k: vars(s) for k, s in states.items()} == {k: vars(s) for k, s in expected_states.items()}
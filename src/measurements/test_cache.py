@@ -0,0 +1,217 @@
+import datetime
+import os
+import pickle
+import threading
+
+import pytest
+import redis
+
+from src import models
+from src.measurements.cache import FastReadmissionRedisCache, FastReadmissionRedisScriptCache, FastReadmissionLRUCache
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel, FastReadmissionState
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+
+MEASUREMENTS = [("heart_rate", 80), ("blood_pressure", 120), ("respiration_rate", 12), ("temperature", 36.6),
+                ("temperature", 37.2), ("respiration_rate", 17), ("temperature", 38.1), ("heart_rate", 90),
+                ("temperature", 36.9), ("blood_pressure", 135)]
+
+
+@pytest.fixture
+def redis_client():
+    """
+    Uses a real Redis if REDIS_TEST_URL is set(e.g. redis://localhost:6379/15), fakeredis otherwise.
+    """
+    url = os.getenv("REDIS_TEST_URL")
+    if url:
+        client = redis.Redis.from_url(url)
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        client = fakeredis.FakeRedis()
+    client.flushdb()
+    yield client
+    client.flushdb()
+
+
+def new_measurement(patient_id: int, hour: int, parameter: str, value: float) -> models.Measurement:
+    return models.Measurement(patient_id=patient_id, type=parameter, value=value,
+                              time_created=datetime.datetime(2021, 1, 1) + datetime.timedelta(hours=hour))
+
+
+@pytest.mark.parametrize("cache_class", [FastReadmissionRedisCache, FastReadmissionRedisScriptCache])
+def test_redis_caches_match_in_memory_cache(redis_client, cache_class):
+    redis_cache = cache_class(redis_client=redis_client)
+    redis_model = FastReadmissionPredictionModel(cache=redis_cache)
+    dummy_model = FastReadmissionPredictionModel(cache=DummyFastReadmissionCache())
+
+    p = models.Patient(id=1, age=50)
+    for hour, (parameter, value) in enumerate(MEASUREMENTS):
+        m = new_measurement(1, hour, parameter, value)
+        assert redis_model.calculate(patient=p, last_measurement=m) == dummy_model.calculate(patient=p,
+                                                                                             last_measurement=m)
+
+    state = redis_cache.get_state(1)
+    assert state.last_blood_pressure.value == 135
+    assert state.last_blood_pressure.time_created == datetime.datetime(2021, 1, 1, 9)
+    assert state.respiratory_rate_count == 2
+    assert state.temperature_count == 4
+    assert state.temperature_mean == dummy_model.cache.get_state(1).temperature_mean
+
+
+def test_script_cache_keeps_newest_blood_pressure(redis_client):
+    cache = FastReadmissionRedisScriptCache(redis_client=redis_client)
+    assert cache.update(1, new_measurement(1, 5, "blood_pressure", 120))[0] == 120
+    # An older measurement doesn't replace the cached one
+    assert cache.update(1, new_measurement(1, 4, "blood_pressure", 125))[0] == 120
+    assert cache.update(1, new_measurement(1, 6, "heart_rate", 80))[0] == 120
+    assert cache.get_last_blood_pressure(1).value == 120
+
+
+def test_script_cache_has_no_lost_updates(redis_client):
+    cache = FastReadmissionRedisScriptCache(redis_client=redis_client)
+    workers, updates = 8, 50
+
+    def send():
+        for i in range(updates):
+            cache.update(1, new_measurement(1, i, "respiration_rate", 10.0))
+
+    threads = [threading.Thread(target=send) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert cache.get_mean_respiratory_rate(1) == (10.0, workers * updates)
+
+
+def save_legacy_state(client, patient_id: int):
+    # The format of the pickled keys before the state hash
+    client.set(f'patient:{patient_id}:last_blood_pressure', pickle.dumps(
+        new_measurement(patient_id, 3, "blood_pressure", 130)))
+    client.set(f'patient:{patient_id}:mean_respiratory_rate', pickle.dumps({'mean': 15.0, 'count': 4}))
+    client.set(f'patient:{patient_id}:standard_deviation_temperature', pickle.dumps(
+        {'mean': 37.0, 'variance': 2.5, 'count': 6}))
+
+
+@pytest.mark.parametrize("cache_class", [FastReadmissionRedisCache, FastReadmissionRedisScriptCache])
+def test_legacy_pickled_state_is_migrated(redis_client, cache_class):
+    save_legacy_state(redis_client, 1)
+    cache = cache_class(redis_client=redis_client)
+
+    (last_blood_pressure, mean_respiratory_rate, _) = cache.update(1, new_measurement(1, 4, "respiration_rate", 20))
+    assert last_blood_pressure == 130
+    assert mean_respiratory_rate == 16.0
+
+    assert redis_client.keys('patient:1:*') == [b'patient:1:state']
+    state = cache.get_state(1)
+    assert state.last_blood_pressure.time_created == datetime.datetime(2021, 1, 1, 3)
+    assert (state.respiratory_rate_mean, state.respiratory_rate_count) == (16.0, 5)
+    assert (state.temperature_mean, state.temperature_variance, state.temperature_count) == (37.0, 2.5, 6)
+
+
+def test_migrate_all_legacy_states(redis_client, monkeypatch):
+    for patient_id in range(1, 11):
+        save_legacy_state(redis_client, patient_id)
+    cache = FastReadmissionRedisCache(redis_client=redis_client)
+    cache.update(11, new_measurement(11, 1, "temperature", 37))
+    redis_client.set('patient:11:version', 3)
+    migrate_legacy_state = cache.migrate_legacy_state
+    migrated = []
+
+    def counting_migrate_legacy_state(patient_id, values=None):
+        migrated.append(patient_id)
+        return migrate_legacy_state(patient_id, values)
+
+    monkeypatch.setattr(cache, "migrate_legacy_state", counting_migrate_legacy_state)
+
+    assert cache.migrate_all_legacy_states() == 10
+    # State hashes and version keys aren't read, every patient is migrated once
+    assert sorted(migrated) == list(range(1, 11))
+    assert sorted(redis_client.keys('patient:*')) == sorted(
+        [f'patient:{patient_id}:state'.encode() for patient_id in range(1, 12)] + [b'patient:11:version'])
+
+
+def test_cold_update_of_the_keys_backend_takes_two_round_trips(redis_client, monkeypatch):
+    cache = FastReadmissionRedisCache(redis_client=redis_client)
+    get_connection = redis_client.connection_pool.get_connection
+    round_trips = []
+
+    def counting_get_connection(*args, **kwargs):
+        round_trips.append(args)
+        return get_connection(*args, **kwargs)
+
+    monkeypatch.setattr(redis_client.connection_pool, "get_connection", counting_get_connection)
+    cache.update(1, new_measurement(1, 1, "respiration_rate", 20),
+                 seed=lambda: FastReadmissionState(respiratory_rate_mean=15.0, respiratory_rate_count=4))
+
+    # The state and legacy keys are read in one pipeline, then the seeded state is saved
+    assert len(round_trips) == 2
+    assert cache.get_mean_respiratory_rate(1) == (16.0, 5)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_cache():
+    backend = DummyFastReadmissionCache()
+    clock = FakeClock()
+    cache = FastReadmissionLRUCache(cache=backend, max_size=2, ttl=10, clock=clock)
+    lru_model = FastReadmissionPredictionModel(cache=cache)
+    dummy_model = FastReadmissionPredictionModel(cache=DummyFastReadmissionCache())
+
+    p = models.Patient(id=1, age=50)
+    for hour, (parameter, value) in enumerate(MEASUREMENTS):
+        m = new_measurement(1, hour, parameter, value)
+        assert lru_model.calculate(patient=p, last_measurement=m) == dummy_model.calculate(patient=p,
+                                                                                           last_measurement=m)
+    assert cache.stats() == {'size': 1, 'hits': len(MEASUREMENTS) - 1, 'misses': 1, 'evictions': 0}
+    # Write-through
+    assert backend.get_mean_respiratory_rate(1) == (14.5, 2)
+
+    # Expired states are read again from the backend
+    backend.save_mean_respiratory_rate(1, 20.0, 3)
+    assert cache.get_mean_respiratory_rate(1) == (14.5, 2)
+    clock.now = 11
+    assert cache.get_mean_respiratory_rate(1) == (20.0, 3)
+
+    # The least recently used patient is evicted
+    cache.get_state(2)
+    cache.get_state(1)
+    cache.get_state(3)
+    assert list(cache.states) == [1, 3]
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_caches_of_workers_on_the_script_cache_have_no_lost_updates(redis_client):
+    workers = [FastReadmissionLRUCache(cache=FastReadmissionRedisScriptCache(redis_client=redis_client), ttl=60)
+               for _ in range(2)]
+    for hour, value in enumerate([10.0, 20.0, 30.0, 40.0]):
+        workers[hour % 2].update(1, new_measurement(1, hour, "respiration_rate", value))
+    workers[1].update(1, new_measurement(1, 4, "blood_pressure", 120))
+
+    assert FastReadmissionRedisCache(redis_client).get_mean_respiratory_rate(1) == (25.0, 4)
+    # The local copy is the state after the worker's last update
+    assert workers[0].get_mean_respiratory_rate(1) == (20.0, 3)
+    state = workers[1].get_state(1)
+    assert (state.respiratory_rate_mean, state.respiratory_rate_count) == (25.0, 4)
+    assert state.last_blood_pressure.value == 120
+
+
+@pytest.mark.parametrize("cache_class", [FastReadmissionRedisCache, FastReadmissionRedisScriptCache])
+def test_cold_state_is_seeded(redis_client, cache_class):
+    cache = cache_class(redis_client=redis_client)
+
+    def seed():
+        return FastReadmissionState(respiratory_rate_mean=15.0, respiratory_rate_count=4)
+
+    assert cache.update(1, new_measurement(1, 1, "respiration_rate", 20), seed=seed)[1] == 16.0
+    # The seed is used only when nothing is cached
+    assert cache.update(1, new_measurement(1, 2, "respiration_rate", 22), seed=seed)[1] == 17.0
+    cache.seed_states({1: seed(), 2: seed()})
+    assert cache.get_mean_respiratory_rate(1) == (17.0, 6)
+    assert cache.get_mean_respiratory_rate(2) == (15.0, 4)
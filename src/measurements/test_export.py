@@ -0,0 +1,58 @@
+import csv
+import datetime
+import io
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models
+from src.config.database import Base
+from src.measurements.export import export_chunks, measurements_query, predictions_query, MEASUREMENT_COLUMNS, \
+    PREDICTION_COLUMNS
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.schemas import ExportFormat
+
+START = datetime.datetime(2021, 1, 1)
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = factory()
+    repo = MeasurementSQLiteRepository(db)
+    for i in range(25):
+        for patient_id in (1, 2):
+            m = models.Measurement(patient_id=patient_id, type="temperature" if i % 2 else "heart_rate",
+                                   value=36 + i / 7, time_created=START + datetime.timedelta(minutes=i))
+            repo.save_measurements_with_predictions([m], [models.ReadmissionPrediction(
+                patient_id=patient_id, time_created=m.time_created, probability=i / 100)])
+    db.close()
+    return factory
+
+
+def test_ndjson_export_of_measurements_is_streamed_in_batches(session_factory):
+    chunks = list(export_chunks(session_factory, measurements_query(1, "temperature"), MEASUREMENT_COLUMNS,
+                                ExportFormat.NDJSON, batch_size=5))
+    rows = [json.loads(line) for chunk in chunks for line in chunk.decode().splitlines()]
+
+    db = session_factory()
+    expected = MeasurementSQLiteRepository(db).get_all_measurements(1, "temperature", limit=100)[::-1]
+    assert len(chunks) == 3
+    assert rows == [{"id": m.id, "patient_id": 1, "time_created": m.time_created.isoformat(), "type": "temperature",
+                     "value": m.value, "count": 1, "rollup": False} for m in expected]
+
+
+def test_csv_export_of_predictions_in_a_time_range(session_factory):
+    since = START + datetime.timedelta(minutes=10)
+    until = START + datetime.timedelta(minutes=20)
+    body = b"".join(export_chunks(session_factory, predictions_query(2, since, until), PREDICTION_COLUMNS,
+                                  ExportFormat.CSV, batch_size=4)).decode()
+
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert [(r["patient_id"], r["time_created"], float(r["probability"])) for r in rows] == [
+        ("2", (START + datetime.timedelta(minutes=i)).isoformat(), i / 100) for i in range(10, 20)]
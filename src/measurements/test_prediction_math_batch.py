@@ -0,0 +1,63 @@
+import datetime
+import random
+
+import numpy as np
+import pytest
+
+from src.measurements import prediction_math, prediction_math_batch
+from src.models import Measurement
+
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+def test_probability_matches_scalar():
+    rnd = random.Random(1)
+    rows = [(rnd.randrange(100), rnd.uniform(0, 200), rnd.uniform(0, 40), rnd.uniform(0, 5)) for _ in range(1000)]
+    got = prediction_math_batch.calculate_probability_v1(*np.array(rows).T)
+    assert got.tolist() == pytest.approx([prediction_math.calculate_probability_v1(*r) for r in rows], rel=1e-12)
+
+
+def score_patient(age: int, measurements: list) -> float:
+    def values(t):
+        return [m.value for m in measurements if m.type == t]
+
+    blood_pressures = sorted((m for m in measurements if m.type == "blood_pressure"), key=lambda m: m.time_created)
+    return prediction_math.calculate_probability_v1(
+        age=age,
+        last_blood_pressure=blood_pressures[-1].value if blood_pressures else 0,
+        mean_respiratory_rate=prediction_math.calculate_mean(values("respiration_rate")),
+        standard_deviation_temperature=prediction_math.calculate_standard_deviation(values("temperature")),
+    )
+
+
+def test_score_measurements_matches_scalar():
+    rnd = random.Random(2)
+    start = datetime.datetime(2021, 1, 1)
+    ages = {patient_id: rnd.randrange(100) for patient_id in (3, 10, 42, 1000)}
+    # patient 1000 has no measurements
+    measurements = [Measurement(patient_id=rnd.choice([3, 10, 42]), type=rnd.choice(TYPES), value=rnd.uniform(30, 140),
+                                time_created=start + datetime.timedelta(hours=rnd.randrange(48)))
+                    for _ in range(500)]
+    expected = {patient_id: score_patient(age, [m for m in measurements if m.patient_id == patient_id])
+                for patient_id, age in ages.items()}
+
+    (patient_ids, groups) = prediction_math_batch.group_index(list(ages) + [m.patient_id for m in measurements])
+    got = prediction_math_batch.score_measurements(
+        [ages[patient_id] for patient_id in patient_ids.tolist()], groups[len(ages):],
+        [m.type for m in measurements], [m.value for m in measurements],
+        np.array([m.time_created for m in measurements], dtype="datetime64[us]"))
+
+    assert dict(zip(patient_ids.tolist(), got.tolist())) == pytest.approx(expected, rel=1e-12)
+
+
+def test_aggregates_match_scalar():
+    rnd = random.Random(3)
+    values = [[rnd.uniform(35, 41) for _ in range(rnd.randrange(4))] for _ in range(50)]
+    groups = np.repeat(np.arange(len(values)), [len(v) for v in values])
+
+    (mean, variance, count) = prediction_math_batch.group_mean_and_variance(groups, np.concatenate(values), len(values))
+
+    assert mean.tolist() == pytest.approx([prediction_math.calculate_mean(v) for v in values], rel=1e-12)
+    assert prediction_math_batch.standard_deviation(variance, count).tolist() == pytest.approx(
+        [prediction_math.calculate_standard_deviation(v) for v in values], rel=1e-12)
+    assert count.tolist() == [len(v) for v in values]
@@ -0,0 +1,184 @@
+import asyncio
+import datetime
+
+import pytest
+import redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models, schemas
+from src.config.database import Base
+from src.measurement_service import AsyncMeasurementService
+from src.measurements.cache import AsyncFastReadmissionRedisCache
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel
+from src.measurements.prediction_model_resilient import ResilientReadmissionPredictionModel, \
+    AsyncResilientReadmissionPredictionModel, FallbackPatients
+from src.measurements.repository import MeasurementSQLiteRepository, MeasurementAsyncSQLiteRepository
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+from src.measurements.test_repository import db, save_measurements, START  # noqa: F401
+from src.measurements.warm_cache import warm_cache
+from src.patient.exceptions import PatientNotFoundException
+from src.patient.repository import PatientAsyncSQLiteRepository
+
+MEASUREMENTS = [("blood_pressure", 120), ("temperature", 36.5), ("respiration_rate", 12), ("temperature", 37.5),
+                ("temperature", 38.5), ("respiration_rate", 18), ("blood_pressure", 125)]
+
+
+class BrokenCache(DummyFastReadmissionCache):
+
+    def get_state(self, patient_id: int):
+        raise redis.ConnectionError("Connection refused")
+
+
+class FlakyCache(DummyFastReadmissionCache):
+    down = False
+
+    def get_state(self, patient_id: int):
+        if self.down:
+            raise redis.ConnectionError("Connection refused")
+        return super().get_state(patient_id)
+
+    def delete_states(self, patient_ids):
+        if self.down:
+            raise redis.ConnectionError("Connection refused")
+        super().delete_states(patient_ids)
+
+
+def expected_probability(measurements) -> float:
+    model = FastReadmissionPredictionModel(cache=DummyFastReadmissionCache())
+    p = models.Patient(id=1, age=60)
+    prob = None
+    for hour, (parameter, value) in enumerate(measurements):
+        prob = model.calculate(patient=p, last_measurement=models.Measurement(
+            patient_id=1, type=parameter, value=value, time_created=START + datetime.timedelta(hours=hour)))
+    return prob
+
+
+def test_cold_cache_is_restored_from_database(db):
+    repo = MeasurementSQLiteRepository(db)
+    saved = save_measurements(repo, 1, MEASUREMENTS)
+    cache = DummyFastReadmissionCache()
+    model = ResilientReadmissionPredictionModel(cache=cache, measurement_repo=repo)
+
+    # The last measurement is already saved, the state is restored from the ones before it
+    prob = model.calculate(patient=models.Patient(id=1, age=60), last_measurement=saved[-1])
+
+    assert abs(prob - expected_probability(MEASUREMENTS)) < 1e-12
+    state = cache.get_state(1)
+    assert (state.respiratory_rate_mean, state.respiratory_rate_count) == (15.0, 2)
+    assert state.temperature_count == 3
+    assert state.last_blood_pressure.value == 125
+
+
+def test_prediction_without_cache(db):
+    repo = MeasurementSQLiteRepository(db)
+    saved = save_measurements(repo, 1, MEASUREMENTS)
+    model = ResilientReadmissionPredictionModel(cache=BrokenCache(), measurement_repo=repo,
+                                                fallback_patients=FallbackPatients())
+
+    prob = model.calculate(patient=models.Patient(id=1, age=60), last_measurement=saved[-1])
+
+    assert abs(prob - expected_probability(MEASUREMENTS)) < 1e-12
+
+
+def test_state_cached_before_an_outage_is_restored_after_it(db):
+    repo = MeasurementSQLiteRepository(db)
+    saved = save_measurements(repo, 1, MEASUREMENTS)
+    cache = FlakyCache()
+    fallback_patients = FallbackPatients()
+
+    for i, measurement in enumerate(saved):
+        # Redis is down for one measurement and keeps its data, every request has its own model
+        cache.down = i == 3
+        model = ResilientReadmissionPredictionModel(cache=cache, measurement_repo=repo,
+                                                    fallback_patients=fallback_patients)
+        prob = model.calculate(patient=models.Patient(id=1, age=60), last_measurement=measurement)
+
+    assert abs(prob - expected_probability(MEASUREMENTS)) < 1e-12
+    assert cache.get_state(1).temperature_count == 3
+    assert fallback_patients.pending() == {}
+
+
+def test_warm_cache(db):
+    repo = MeasurementSQLiteRepository(db)
+    save_measurements(repo, 1, MEASUREMENTS)
+    save_measurements(repo, 2, MEASUREMENTS[:2])
+    cache = DummyFastReadmissionCache()
+    cache.save_mean_respiratory_rate(2, 99.0, 1)
+
+    assert warm_cache(db, cache, batch_size=1) == 2
+    assert cache.get_mean_respiratory_rate(1) == (15.0, 2)
+    # States that are already cached are kept
+    assert cache.get_mean_respiratory_rate(2) == (99.0, 1)
+
+
+def test_async_service_matches_sync_model():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def run() -> list:
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        db = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)()
+        db.add(models.Patient(id=7, age=60))
+        await db.commit()
+
+        cache = AsyncFastReadmissionRedisCache(redis_client=fakeredis.aioredis.FakeRedis())
+        repo = MeasurementAsyncSQLiteRepository(db)
+        service = AsyncMeasurementService(patient_repo=PatientAsyncSQLiteRepository(db), measurement_repo=repo,
+                                          prediction_model=AsyncResilientReadmissionPredictionModel(
+                                              cache=cache, measurement_repo=repo))
+        for hour, (parameter, value) in enumerate(MEASUREMENTS):
+            if hour == 4:
+                # Redis is flushed, the state is restored from the database
+                await cache.redis_client.flushdb()
+            await service.save_measurement(schemas.MeasurementIn(patient_id=7, day="2021-01-01", hour=hour,
+                                                                 parameter=parameter, value=value))
+        with pytest.raises(PatientNotFoundException):
+            await service.save_measurement(schemas.MeasurementIn(patient_id=1, day="2021-01-01", hour=1,
+                                                                 parameter="temperature", value=37))
+        predictions = (await db.execute(select(models.ReadmissionPrediction.probability))).scalars().all()
+        await db.close()
+        await engine.dispose()
+        return predictions
+
+    predictions = asyncio.run(run())
+
+    assert len(predictions) == len(MEASUREMENTS)
+    assert abs(predictions[-1] - expected_probability(MEASUREMENTS)) < 1e-12
+
+
+def test_async_state_cached_before_an_outage_is_restored_after_it():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    class FlakyAsyncCache(AsyncFastReadmissionRedisCache):
+        down = False
+
+        async def update(self, patient_id, last_measurement, seed=None):
+            if self.down:
+                raise redis.ConnectionError("Connection refused")
+            return await super().update(patient_id, last_measurement, seed=seed)
+
+    async def run() -> float:
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        db = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)()
+        repo = MeasurementAsyncSQLiteRepository(db)
+        cache = FlakyAsyncCache(redis_client=fakeredis.aioredis.FakeRedis())
+        fallback_patients = FallbackPatients()
+        prob = None
+        for hour, (parameter, value) in enumerate(MEASUREMENTS):
+            measurement = await repo.save_measurement(models.Measurement(
+                patient_id=1, type=parameter, value=value, time_created=START + datetime.timedelta(hours=hour)))
+            cache.down = hour == 3
+            model = AsyncResilientReadmissionPredictionModel(cache=cache, measurement_repo=repo,
+                                                             fallback_patients=fallback_patients)
+            prob = await model.calculate(models.Patient(id=1, age=60), measurement)
+        await db.close()
+        await engine.dispose()
+        return prob
+
+    assert abs(asyncio.run(run()) - expected_probability(MEASUREMENTS)) < 1e-12
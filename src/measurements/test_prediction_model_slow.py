@@ -0,0 +1,34 @@
+from src import models
+from src.measurements.prediction_math import calculate_probability_v1, calculate_mean, calculate_standard_deviation
+from src.measurements.prediction_model_slow import SlowReadmissionPredictionModel
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.measurements.test_repository import db, save_measurements, START  # noqa: F401
+
+
+def test_slow_model(db):
+    repo = MeasurementSQLiteRepository(db)
+    temperatures = [36 + i / 10 % 4 for i in range(0, 1500)]
+    respiration_rates = [float(i % 30) for i in range(0, 1200)]
+    repo.save_measurements_with_predictions(
+        [models.Measurement(patient_id=1, type="temperature", value=t, time_created=START) for t in temperatures] +
+        [models.Measurement(patient_id=1, type="respiration_rate", value=r, time_created=START)
+         for r in respiration_rates], [])
+    saved = save_measurements(repo, 1, [("blood_pressure", 120.0), ("blood_pressure", 125.0)])
+    model = SlowReadmissionPredictionModel(measurement_repo=repo)
+
+    prob = model.calculate(patient=models.Patient(id=1, age=50), last_measurement=saved[-1])
+
+    # All rows are used, not only the first 1000 of each type
+    expected = calculate_probability_v1(
+        age=50,
+        last_blood_pressure=125.0,
+        mean_respiratory_rate=calculate_mean(respiration_rates),
+        standard_deviation_temperature=calculate_standard_deviation(temperatures),
+    )
+    assert abs(prob - expected) < 1e-12
+
+
+def test_slow_model_without_measurements(db):
+    model = SlowReadmissionPredictionModel(measurement_repo=MeasurementSQLiteRepository(db))
+    assert model.calculate(patient=models.Patient(id=1, age=50), last_measurement=None) == calculate_probability_v1(
+        age=50)
@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models, schemas
+from src.config.database import Base
+from src.measurements.ranking import ReadmissionRanking, rebuild_ranking
+from src.patient.repository import PatientSQLiteRepository
+from src.patient_service import PatientService
+
+START = datetime.datetime(2021, 1, 1)
+
+
+@pytest.fixture
+def ranking():
+    fakeredis = pytest.importorskip("fakeredis")
+    return ReadmissionRanking(fakeredis.FakeRedis())
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+def prediction(patient_id: int, probability: float, minutes: int = 0) -> models.ReadmissionPrediction:
+    return models.ReadmissionPrediction(patient_id=patient_id, probability=probability,
+                                        time_created=START + datetime.timedelta(minutes=minutes))
+
+
+def top(ranking: ReadmissionRanking, k: int) -> list:
+    return [(r.patient_id, r.probability) for r in ranking.top(k)]
+
+
+def test_top_has_the_latest_probability_of_every_patient(ranking):
+    ranking.update([prediction(1, 0.2), prediction(2, 0.5), prediction(3, 0.1)])
+    ranking.update([prediction(1, 0.7, minutes=10)])
+    # Measured earlier, arrived later
+    ranking.update([prediction(2, 0.9, minutes=-10)])
+
+    assert top(ranking, 2) == [(1, 0.7), (2, 0.5)]
+    assert top(ranking, 10) == [(1, 0.7), (2, 0.5), (3, 0.1)]
+    assert ranking.top(1)[0].time_created == START + datetime.timedelta(minutes=10)
+
+
+def test_discharged_patients_are_left_out_until_admitted(ranking, db):
+    svc = PatientService(PatientSQLiteRepository(db), ranking=ranking)
+    for patient_id in (1, 2):
+        svc.save_patient(schemas.PatientIn(id=patient_id, age=50))
+    ranking.update([prediction(1, 0.2), prediction(2, 0.5)])
+
+    svc.save_admission(2, schemas.AdmissionIn(patient_id=2, date_admission="01/01/2021", date_discharge="03/01/2021"))
+    ranking.update([prediction(2, 0.9, minutes=10)])
+    assert top(ranking, 10) == [(1, 0.2)]
+
+    # An older stay doesn't discharge a patient who is in the hospital now
+    svc.save_admission(2, schemas.AdmissionIn(patient_id=2, date_admission="05/01/2021"))
+    svc.save_admission(2, schemas.AdmissionIn(patient_id=2, date_admission="01/12/2020", date_discharge="02/12/2020"))
+    ranking.update([prediction(2, 0.9, minutes=20)])
+    assert top(ranking, 10) == [(2, 0.9), (1, 0.2)]
+
+
+def test_rebuild_from_current_risk(ranking, db):
+    db.add_all([
+        models.CurrentRisk(patient_id=1, time_created=START, probability=0.3),
+        models.CurrentRisk(patient_id=2, time_created=START, probability=0.6),
+        models.CurrentRisk(patient_id=3, time_created=START, probability=0.9),
+        models.Admission(patient_id=3, date_admission=START, date_discharge=START + datetime.timedelta(days=1)),
+    ])
+    db.commit()
+    # Newer than the database, e.g. still in the write-behind spool
+    ranking.update([prediction(1, 0.8, minutes=5)])
+
+    assert rebuild_ranking(db, ranking, batch_size=2) == 2
+    assert top(ranking, 10) == [(1, 0.8), (2, 0.6)]
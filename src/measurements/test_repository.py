@@ -0,0 +1,102 @@
+import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models
+from src.config.database import Base
+from src.measurements.repository import MeasurementSQLiteRepository
+
+START = datetime.datetime(2021, 1, 1)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+def save_measurements(repo: MeasurementSQLiteRepository, patient_id: int, measurements) -> list:
+    saved = []
+    for hour, (parameter, value) in enumerate(measurements):
+        saved.append(repo.save_measurement(models.Measurement(
+            patient_id=patient_id, type=parameter, value=value, time_created=START + datetime.timedelta(hours=hour))))
+    return saved
+
+
+def test_get_measurement_aggregates(db):
+    repo = MeasurementSQLiteRepository(db)
+    saved = save_measurements(repo, 1, [("blood_pressure", 120), ("temperature", 36), ("temperature", 38),
+                                        ("blood_pressure", 130), ("respiration_rate", 10)])
+    save_measurements(repo, 2, [("temperature", 37)])
+
+    aggregates = repo.get_measurement_aggregates([1, 2, 3])
+    assert sorted(aggregates) == [1, 2]
+    a = aggregates[1]
+    assert (a.count("temperature"), a.mean("temperature"), a.sum_of_squared_deviations("temperature")) == (2, 37, 2)
+    assert (a.count("respiration_rate"), a.mean("respiration_rate")) == (1, 10)
+    assert (a.last_blood_pressure.value, a.last_blood_pressure.time_created) == (130, START + datetime.timedelta(hours=3))
+    assert aggregates[2].last_blood_pressure is None
+
+    # Only measurements saved before the given one
+    a = repo.get_measurement_aggregates([1], before_id=saved[3].id)[1]
+    assert a.last_blood_pressure.value == 120
+    assert a.count("respiration_rate") == 0
+
+    assert repo.get_patient_ids_with_measurements() == [1, 2]
+    assert repo.get_patient_ids_with_measurements(since=START + datetime.timedelta(hours=1)) == [1]
+
+
+def test_keyset_pagination_and_counters(db):
+    repo = MeasurementSQLiteRepository(db)
+    # Two measurements per hour, so pages have to break ties of time_created by id
+    for hour in range(5):
+        for value in (36, 37):
+            repo.save_measurement(models.Measurement(patient_id=1, type="temperature", value=value,
+                                                     time_created=START + datetime.timedelta(hours=hour)))
+    ms = [models.Measurement(patient_id=1, type="temperature", value=38, time_created=START)]
+    ps = [models.ReadmissionPrediction(patient_id=1, time_created=START, probability=0.1) for _ in range(3)]
+    repo.save_measurements_with_predictions(ms, ps)
+
+    pages, before = [], None
+    while True:
+        page = repo.get_all_measurements(1, "temperature", limit=4, before=before)
+        if not page:
+            break
+        pages.append([m.id for m in page])
+        before = (page[-1].time_created, page[-1].id)
+
+    everything = [m.id for m in repo.get_all_measurements(1, "temperature", limit=100)]
+    assert [m_id for page in pages for m_id in page] == everything
+    assert [len(page) for page in pages] == [4, 4, 3]
+
+    first = repo.get_all_predictions(1, limit=2)
+    rest = repo.get_all_predictions(1, limit=2, before=(first[-1].time_created, first[-1].internal_id))
+    assert len(rest) == 1 and rest[0].internal_id not in {p.internal_id for p in first}
+
+    assert repo.count_measurements(1, "temperature") == 11
+    assert repo.count_measurements(1, "blood_pressure") == 0
+    assert repo.count_predictions(1) == 3
+
+
+def test_current_risk(db):
+    repo = MeasurementSQLiteRepository(db)
+
+    def prediction(patient_id: int, hour: int, probability: float):
+        return models.ReadmissionPrediction(patient_id=patient_id, probability=probability,
+                                            time_created=START + datetime.timedelta(hours=hour))
+
+    repo.save_prediction(prediction(1, 2, 0.2))
+    # A prediction of a measurement that arrived late doesn't replace the newer one
+    repo.save_prediction(prediction(1, 1, 0.1))
+    repo.save_measurements_with_predictions([], [prediction(2, 1, 0.3), prediction(2, 3, 0.5), prediction(2, 2, 0.4),
+                                                 prediction(1, 2, 0.25)])
+
+    risks = {r.patient_id: (r.time_created, r.probability) for r in repo.get_current_risk([1, 2, 3])}
+    assert risks == {1: (START + datetime.timedelta(hours=2), 0.25), 2: (START + datetime.timedelta(hours=3), 0.5)}
+    assert [(p.time_created, p.probability) for p in repo.get_all_predictions(2, limit=1)] == [risks[2]]
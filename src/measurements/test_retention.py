@@ -0,0 +1,142 @@
+import csv
+import datetime
+import gzip
+import json
+import os
+import random
+
+import pytest
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models
+from src.config.database import Base
+from src.measurements.archive import MeasurementArchive
+from src.measurements.export import export_chunks, measurements_query, MEASUREMENT_COLUMNS
+from src.measurements.prediction_model_slow import SlowReadmissionPredictionModel
+from src.measurements.repository import MeasurementSQLiteRepository, history_key
+from src.measurements.retention import compact_measurements, CsvArchive, ColumnarArchive
+from src.schemas import ExportFormat
+
+START = datetime.datetime(2021, 1, 1)
+TYPES = ["blood_pressure", "temperature", "respiration_rate"]
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+def save_random_measurements(repo: MeasurementSQLiteRepository, hours: int):
+    rnd = random.Random(1)
+    for minute in range(0, hours * 60, 7):
+        repo.save_measurement(models.Measurement(patient_id=rnd.choice([1, 2]), type=rnd.choice(TYPES),
+                                                 value=rnd.uniform(30, 140),
+                                                 time_created=START + datetime.timedelta(minutes=minute)))
+
+
+def hourly(repo: MeasurementSQLiteRepository, patient_id: int, measurement_type: str) -> list:
+    return [(h.hour, h.count, pytest.approx(h.mean), h.min, h.max, pytest.approx(h.m2), h.last_value)
+            for h in repo.get_hourly_measurements(patient_id, measurement_type)]
+
+
+def test_compaction_keeps_aggregates_and_hourly_values(db, tmp_path):
+    repo = MeasurementSQLiteRepository(db)
+    save_random_measurements(repo, hours=10)
+    patient = models.Patient(id=1, age=40)
+    model = SlowReadmissionPredictionModel(repo)
+    before = {
+        "probability": model.calculate(patient, None),
+        "hourly": {t: hourly(repo, 1, t) for t in TYPES},
+        "counter": repo.count_measurements(1, "temperature"),
+    }
+
+    # Everything before 06:00 is compacted, whole hours only
+    compacted = compact_measurements(db, datetime.timedelta(hours=4), batch_size=7, archive=CsvArchive(tmp_path),
+                                     now=START + datetime.timedelta(hours=10, minutes=30))
+
+    assert compacted == db.query(func.sum(models.MeasurementRollup.count)).scalar()
+    assert db.query(func.min(models.Measurement.time_created)).scalar() >= START + datetime.timedelta(hours=6)
+    assert model.calculate(patient, None) == pytest.approx(before["probability"], rel=1e-12)
+    assert {t: hourly(repo, 1, t) for t in TYPES} == before["hourly"]
+    remaining = db.query(models.Measurement).filter_by(patient_id=1, type="temperature").count()
+    assert repo.count_measurements(1, "temperature") == remaining < before["counter"]
+
+    archived = []
+    for name in os.listdir(tmp_path):
+        with gzip.open(os.path.join(tmp_path, name), "rt") as f:
+            archived += list(csv.DictReader(f))
+    assert len(archived) == compacted
+
+
+def test_late_measurements_are_merged_into_rollups(db):
+    repo = MeasurementSQLiteRepository(db)
+    for minute, value in ((0, 36.0), (30, 38.0)):
+        repo.save_measurement(models.Measurement(patient_id=1, type="temperature", value=value,
+                                                 time_created=START + datetime.timedelta(minutes=minute)))
+    now = START + datetime.timedelta(hours=5)
+    assert compact_measurements(db, datetime.timedelta(hours=1), now=now) == 2
+
+    # Arrives after its hour was compacted
+    repo.save_measurement(models.Measurement(patient_id=1, type="temperature", value=40.0,
+                                             time_created=START + datetime.timedelta(minutes=10)))
+    [h] = repo.get_hourly_measurements(1, "temperature")
+    assert (h.count, h.mean, h.min, h.max, h.last_value) == (3, 38.0, 36.0, 40.0, 38.0)
+    assert h.m2 == pytest.approx(8.0)
+
+    assert compact_measurements(db, datetime.timedelta(hours=1), now=now) == 1
+    [rollup] = db.query(models.MeasurementRollup).all()
+    assert (rollup.count, rollup.mean, rollup.m2) == (3, pytest.approx(38.0), pytest.approx(8.0))
+    a = repo.get_measurement_aggregates([1])[1]
+    assert (a.count("temperature"), a.mean("temperature")) == (3, pytest.approx(38.0))
+
+
+def test_columnar_archive_of_compacted_measurements(db, tmp_path):
+    repo = MeasurementSQLiteRepository(db)
+    save_random_measurements(repo, hours=3)
+    expected = repo.get_all_measurements(1, "temperature", limit=1000)
+
+    compact_measurements(db, datetime.timedelta(hours=1), batch_size=10, archive=ColumnarArchive(tmp_path),
+                         now=START + datetime.timedelta(hours=10))
+
+    archived = []
+    for name in sorted(os.listdir(tmp_path)):
+        with MeasurementArchive(os.path.join(tmp_path, name)) as archive:
+            archived += archive.get_all_measurements(1, "temperature", limit=1000)
+    assert sorted((m.id, m.value, m.time_created) for m in archived) == sorted(
+        (m.id, m.value, m.time_created) for m in expected)
+
+
+def test_history_and_export_include_compacted_hours(db):
+    repo = MeasurementSQLiteRepository(db)
+    save_random_measurements(repo, hours=10)
+    measured = repo.count_measurements(1, "temperature")
+    compact_measurements(db, datetime.timedelta(hours=4), now=START + datetime.timedelta(hours=10, minutes=30))
+
+    # Pages of the list endpoint, by cursor and by offset
+    (pages, before) = ([], None)
+    while True:
+        page = repo.get_measurement_history(1, "temperature", limit=4, before=before)
+        pages += page
+        if len(page) < 4:
+            break
+        before = history_key(page[-1])
+    total = repo.count_measurements(1, "temperature") + repo.count_measurement_rollups(1, "temperature")
+    assert len(pages) == total
+    assert [history_key(i) for i in pages] == sorted((history_key(i) for i in pages), reverse=True)
+    assert repo.get_measurement_history(1, "temperature", offset=total - 9, limit=4) == pages[-9:-5]
+    rollups = [i for i in pages if isinstance(i, models.MeasurementRollup)]
+    assert rollups and all(r.hour < START + datetime.timedelta(hours=6) for r in rollups)
+    assert sum(r.count for r in rollups) + total - len(rollups) == measured
+
+    rows = [r for chunk in export_chunks(sessionmaker(bind=db.get_bind()), measurements_query(1, "temperature"),
+                                         MEASUREMENT_COLUMNS, ExportFormat.NDJSON, batch_size=5)
+            for r in map(json.loads, chunk.decode().splitlines())]
+    assert [(r["id"], r["time_created"], r["value"], r["count"], r["rollup"]) for r in rows] == [
+        (None, i.hour.isoformat(), pytest.approx(i.mean), i.count, True) if isinstance(i, models.MeasurementRollup)
+        else (i.id, i.time_created.isoformat(), i.value, 1, False) for i in reversed(pages)]
@@ -0,0 +1,109 @@
+import datetime
+import os
+import random
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src import models
+from src.config.database import Base
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.measurements.timeseries import MeasurementTimeSeriesRepository, RECORD
+
+START = datetime.datetime(2021, 1, 1)
+TYPES = ["blood_pressure", "temperature", "respiration_rate", "heart_rate"]
+
+
+@pytest.fixture
+def sqlite_repo():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield MeasurementSQLiteRepository(session)
+    session.close()
+
+
+def measurement(m) -> tuple:
+    # Ids are positions in the patient's file there and global in SQLite, they aren't compared
+    return m.patient_id, m.type, m.value, m.time_created
+
+
+def save_random(repos, in_order: bool):
+    """
+    Saves the same measurements and predictions to every repository
+    """
+    rnd = random.Random(1)
+    for i in range(400):
+        minutes = i if in_order else rnd.randrange(200)
+        t = START + datetime.timedelta(minutes=minutes // 3 * 3)
+        patient_id = rnd.choice([1, 2])
+        m = dict(patient_id=patient_id, type=rnd.choice(TYPES[:3]), value=rnd.uniform(30, 140), time_created=t)
+        for repo in repos:
+            repo.save_measurement(models.Measurement(**m))
+            repo.save_prediction(models.ReadmissionPrediction(patient_id=patient_id, time_created=t,
+                                                              probability=m["value"] / 1000))
+
+
+@pytest.mark.parametrize("in_order", [True, False])
+def test_answers_like_the_sqlite_repository(sqlite_repo, tmp_path, in_order):
+    repo = MeasurementTimeSeriesRepository(str(tmp_path))
+    save_random([sqlite_repo, repo], in_order)
+
+    for patient_id in (1, 2, 3):
+        for measurement_type in TYPES + [None]:
+            expected = sqlite_repo.get_all_measurements(patient_id, measurement_type, limit=1000)
+            got = repo.get_all_measurements(patient_id, measurement_type, limit=1000)
+            assert [measurement(m) for m in got] == [measurement(m) for m in expected]
+            assert [measurement(m) for m in repo.get_all_measurements(patient_id, measurement_type, 5, 7)] == \
+                   [measurement(m) for m in expected[5:12]]
+            if len(got) > 20:
+                before = (got[9].time_created, got[9].id)
+                assert [m.id for m in repo.get_all_measurements(patient_id, measurement_type, limit=10,
+                                                                before=before)] == [m.id for m in got[10:20]]
+            if measurement_type:
+                assert repo.count_measurements(patient_id, measurement_type) == len(got)
+                last = repo.get_last_measurement(patient_id, measurement_type)
+                assert (measurement(last) if last else None) == (measurement(expected[0]) if expected else None)
+
+        assert [(p.time_created, p.probability) for p in repo.get_all_predictions(patient_id, limit=1000)] == \
+               [(p.time_created, p.probability) for p in sqlite_repo.get_all_predictions(patient_id, limit=1000)]
+        assert repo.count_predictions(patient_id) == len(sqlite_repo.get_all_predictions(patient_id, limit=1000))
+
+    expected = sqlite_repo.get_measurement_aggregates([1, 2, 3])
+    got = repo.get_measurement_aggregates([1, 2, 3])
+    assert sorted(got) == sorted(expected) == [1, 2]
+    for patient_id, a in got.items():
+        for t in TYPES:
+            assert (a.count(t), a.mean(t), a.sum_of_squared_deviations(t)) == pytest.approx(
+                (expected[patient_id].count(t), expected[patient_id].mean(t),
+                 expected[patient_id].sum_of_squared_deviations(t)))
+        assert measurement(a.last_blood_pressure) == measurement(expected[patient_id].last_blood_pressure)
+    assert repo.get_patient_ids_with_measurements() == [1, 2]
+
+
+def test_ids_keyset_and_reopening(tmp_path):
+    repo = MeasurementTimeSeriesRepository(str(tmp_path))
+    saved = [repo.save_measurement(models.Measurement(patient_id=9, type="temperature", value=36 + i,
+                                                      time_created=START + datetime.timedelta(hours=i // 2)))
+             for i in range(6)]
+    assert [m.id for m in saved] == [1, 2, 3, 4, 5, 6]
+    # Ties of time are broken by id, like the SQL keyset queries
+    page = repo.get_all_measurements(9, "temperature", limit=3)
+    assert [m.id for m in page] == [6, 5, 4]
+    assert [m.id for m in repo.get_all_measurements(9, "temperature", limit=3,
+                                                    before=(page[-1].time_created, page[-1].id))] == [3, 2, 1]
+    assert repo.get_measurement_aggregates([9], before_id=3)[9].count("temperature") == 2
+
+    # A record torn by a crash is dropped by the next append, another instance sees everything
+    with open(repo.path("ts", 9), "ab") as f:
+        f.write(b"\1" * (RECORD.itemsize // 2))
+    repo.save_measurement(models.Measurement(patient_id=9, type="temperature", value=50, time_created=START))
+    other = MeasurementTimeSeriesRepository(str(tmp_path))
+    assert os.path.getsize(repo.path("ts", 9)) == 7 * RECORD.itemsize
+    assert other.count_measurements(9, "temperature") == 7
+    assert other.get_last_measurement(9, "temperature").value == 41
+    assert other.get_all_measurements(9, "temperature", limit=1)[0].id == 6
+    assert other.get_patient_ids_with_measurements(since=START + datetime.timedelta(hours=2)) == [9]
+    assert other.get_patient_ids_with_measurements(since=START + datetime.timedelta(hours=3)) == []
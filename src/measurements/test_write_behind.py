@@ -0,0 +1,119 @@
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from src import models, schemas
+from src.measurement_service import MeasurementService
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+from src.measurements.test_repository import db  # noqa: F401
+from src.measurements.write_behind import MeasurementSpool, WriteBehindFlusher, SPOOL_FLUSH_FAILURES
+from src.patient.repository import PatientSQLiteRepository
+from src.test_measurement_service import MockMeasurementRepository
+
+MEASUREMENTS = [("blood_pressure", 120), ("temperature", 36.5), ("respiration_rate", 12), ("temperature", 38.5)]
+
+
+def spool_measurements(db, spool: MeasurementSpool) -> MockMeasurementRepository:
+    db.add(models.Patient(id=1, age=60))
+    db.commit()
+    repo = MockMeasurementRepository()
+    service = MeasurementService(patient_repo=PatientSQLiteRepository(db), measurement_repo=repo,
+                                 prediction_model=FastReadmissionPredictionModel(cache=DummyFastReadmissionCache()),
+                                 spool=spool)
+    for hour, (parameter, value) in enumerate(MEASUREMENTS):
+        service.save_measurement(schemas.MeasurementIn(patient_id=1, day="2021-01-01", hour=hour,
+                                                       parameter=parameter, value=value))
+    return repo
+
+
+def failing_session():
+    raise ConnectionError("database is down")
+
+
+def test_spool_survives_crash(db, tmp_path):
+    path = str(tmp_path / "spool.db")
+    spool = MeasurementSpool(path)
+    repo = spool_measurements(db, spool)
+    # Nothing is written to the database by the request
+    assert repo.transactions == 0 and spool.depth() == len(MEASUREMENTS)
+
+    # The database fails during the flush, then the worker crashes
+    try:
+        WriteBehindFlusher(spool, failing_session, batch_size=3).flush()
+    except ConnectionError:
+        pass
+    spool.close()
+
+    restarted = MeasurementSpool(path)
+    assert restarted.depth() == len(MEASUREMENTS)
+    session_factory = sessionmaker(bind=db.get_bind())
+    assert WriteBehindFlusher(restarted, session_factory, batch_size=3).flush() == len(MEASUREMENTS)
+    assert restarted.depth() == 0
+
+    rows = db.query(models.Measurement).order_by(models.Measurement.time_created).all()
+    assert [(m.type, m.value) for m in rows] == MEASUREMENTS
+    predictions = db.query(models.ReadmissionPrediction).order_by(models.ReadmissionPrediction.time_created).all()
+    assert len(predictions) == len(MEASUREMENTS) and predictions[-1].probability > 0
+
+
+def test_flusher_retries_until_database_is_back(db, tmp_path):
+    spool = MeasurementSpool(str(tmp_path / "spool.db"))
+    spool_measurements(db, spool)
+    session_factory = sessionmaker(bind=db.get_bind())
+    calls = []
+
+    def flaky_session():
+        calls.append(1)
+        return failing_session() if len(calls) <= 2 else session_factory()
+
+    failures = SPOOL_FLUSH_FAILURES._value.get()
+    flusher = WriteBehindFlusher(spool, flaky_session, interval=0.01)
+    flusher.start()
+    deadline = time.monotonic() + 5
+    while spool.depth() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    flusher.stop()
+
+    assert spool.depth() == 0
+    assert SPOOL_FLUSH_FAILURES._value.get() - failures == 2
+    assert db.query(models.Measurement).count() == len(MEASUREMENTS)
+
+
+def test_batch_delivered_again_is_not_written_twice(db, tmp_path):
+    path = str(tmp_path / "spool.db")
+    spool = MeasurementSpool(path)
+    spool_measurements(db, spool)
+    session_factory = sessionmaker(bind=db.get_bind())
+
+    # The worker crashes after the commit, before the batch is removed from the spool
+    def crash(last_id: int):
+        raise SystemExit()
+    spool.ack = crash
+    try:
+        WriteBehindFlusher(spool, session_factory, batch_size=2).flush()
+    except SystemExit:
+        pass
+    spool.close()
+
+    restarted = MeasurementSpool(path)
+    assert restarted.depth() == len(MEASUREMENTS)
+    WriteBehindFlusher(restarted, session_factory, batch_size=2).flush()
+    assert restarted.depth() == 0
+    assert db.query(models.Measurement).count() == len(MEASUREMENTS)
+    assert db.query(models.ReadmissionPrediction).count() == len(MEASUREMENTS)
+    counters = db.query(models.PatientCounter).filter(models.PatientCounter.name == "temperature").one()
+    assert counters.value == 2
+
+
+def test_one_thread_flushes_at_a_time(tmp_path):
+    spool = MeasurementSpool(str(tmp_path / "spool.db"))
+    assert spool.try_lock_flush()
+    other = []
+    thread = threading.Thread(target=lambda: other.append(spool.try_lock_flush()))
+    thread.start()
+    thread.join()
+    assert other == [False]
+    spool.unlock_flush()
+    assert spool.try_lock_flush()
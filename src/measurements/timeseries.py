@@ -0,0 +1,307 @@
+"""
+MeasurementRepository on append-only memory-mapped files instead of ORM rows.
+
+Every patient has a file of fixed-width (time, value, type code) records for measurements and another one for
+predictions, in 256 shard directories. A save is one append, reads are numpy views over the mapped file:
+
+* ids are positions in the patient's file(starting from 1), so they order the saves of a patient
+* the latest measurement of every type, counts per type and whether the file is ordered by time are kept
+  in memory and updated from the appended records only, also when another process appended them
+* pages of a file that is ordered by time are slices of the map, out of order files are sorted on read
+
+Saves of several patients are not atomic and the files are not synced unless `fsync` is set.
+"""
+import datetime
+import fcntl
+import mmap
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from src import models
+from src.measurements.archive import from_micros, to_micros
+from src.measurements.repository import MeasurementRepository, MeasurementAggregates, hourly_from_rows
+from src.schemas import MeasurementType
+
+RECORD = np.dtype([("time", "<i8"), ("value", "<f8"), ("type", "u1")], align=True)
+TYPES = [t.value for t in MeasurementType]
+TYPE_CODES = {t: code for code, t in enumerate(TYPES)}
+
+
+class Series:
+    """
+    Append-only file of records of one patient, memory-mapped for reads
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.records = np.empty(0, dtype=RECORD)
+        self.in_order = True
+        self.counts = np.zeros(len(TYPES), dtype=np.int64)
+        # Type code -> position of the latest record by time, the later saved one on equal times
+        self.latest = {}
+        self.sorted_positions = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def refresh(self):
+        """
+        Maps records appended since the last call, by this or another process, and updates the index with them
+        """
+        n = os.fstat(self.fd).st_size // RECORD.itemsize
+        if n == len(self.records):
+            return
+        # The old map is closed once the views returned from it are gone
+        mm = mmap.mmap(self.fd, n * RECORD.itemsize, access=mmap.ACCESS_READ)
+        (old, self.records) = (len(self.records), np.frombuffer(mm, dtype=RECORD, count=n))
+        self.index(old)
+
+    def index(self, start: int):
+        new = self.records[start:]
+        times = new["time"]
+        if self.in_order:
+            self.in_order = bool(np.all(times[1:] >= times[:-1])) and (
+                    start == 0 or times[0] >= self.records["time"][start - 1])
+        self.sorted_positions = None
+        self.counts += np.bincount(new["type"], minlength=len(TYPES))[:len(TYPES)]
+        for code in np.unique(new["type"]).tolist():
+            positions = np.flatnonzero(new["type"] == code)
+            # The last of the maximums
+            candidate = start + int(positions[len(positions) - 1 - np.argmax(times[positions][::-1])])
+            current = self.latest.get(code)
+            if current is None or self.records["time"][candidate] >= self.records["time"][current]:
+                self.latest[code] = candidate
+
+    def append(self, records: np.ndarray, fsync: bool = False) -> int:
+        """
+        Appends the records and returns the position of the first one
+        """
+        data = records.tobytes()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size % RECORD.itemsize:
+                # A record torn by a crash
+                size -= size % RECORD.itemsize
+                os.ftruncate(self.fd, size)
+            written = 0
+            while written < len(data):
+                written += os.write(self.fd, data[written:])
+            if fsync:
+                os.fsync(self.fd)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.refresh()
+        return size // RECORD.itemsize
+
+    def ordered(self) -> (np.ndarray, np.ndarray):
+        """
+        Records and their positions ordered by time and position. Views of the map if the file is ordered.
+        """
+        if self.in_order:
+            return self.records, np.arange(len(self.records))
+        if self.sorted_positions is None:
+            self.sorted_positions = np.lexsort((np.arange(len(self.records)), self.records["time"]))
+        return self.records[self.sorted_positions], self.sorted_positions
+
+    def close(self):
+        self.records = np.empty(0, dtype=RECORD)
+        os.close(self.fd)
+
+
+def new_records(items: Iterable[Tuple[datetime.datetime, float, int]]) -> np.ndarray:
+    items = list(items)
+    records = np.empty(len(items), dtype=RECORD)
+    for i, (time_created, value, code) in enumerate(items):
+        records[i] = (to_micros(time_created), value, code)
+    return records
+
+
+def page(records: np.ndarray, positions: np.ndarray, offset: int, limit: int,
+         before: Tuple[datetime.datetime, int]) -> (np.ndarray, np.ndarray):
+    """
+    A page of records ordered by time and position, newest first. `before` is (time, id) of a keyset cursor.
+    """
+    end = len(records)
+    if before:
+        times = records["time"]
+        before_time = to_micros(before[0])
+        (lo, hi) = (np.searchsorted(times, before_time, "left"), np.searchsorted(times, before_time, "right"))
+        end = int(lo + np.searchsorted(positions[lo:hi] + 1, before[1], "left"))
+        offset = 0
+    stop = max(end - offset, 0)
+    start = max(stop - limit, 0)
+    return records[start:stop][::-1], positions[start:stop][::-1]
+
+
+class MeasurementTimeSeriesRepository(MeasurementRepository):
+    """
+    Files are kept open for the last `max_open` patients
+    """
+
+    def __init__(self, directory: str, fsync: bool = False, max_open: int = 1024):
+        self.directory = directory
+        self.fsync = fsync
+        self.max_open = max_open
+        self.series: Dict[Tuple[str, int], Series] = OrderedDict()
+
+    def path(self, kind: str, patient_id: int) -> str:
+        return os.path.join(self.directory, f"{patient_id % 256:02x}", f"{patient_id}.{kind}")
+
+    def get_series(self, kind: str, patient_id: int, create: bool = False) -> Series:
+        key = (kind, patient_id)
+        series = self.series.get(key)
+        if series is None:
+            path = self.path(kind, patient_id)
+            if not create and not os.path.exists(path):
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            series = self.series[key] = Series(path)
+            if len(self.series) > self.max_open:
+                self.series.popitem(last=False)[1].close()
+        else:
+            self.series.move_to_end(key)
+        series.refresh()
+        return series
+
+    def save_measurement(self, measurement: models.Measurement) -> models.Measurement:
+        self.save_measurements_with_predictions([measurement], [])
+        return measurement
+
+    def save_prediction(self, prediction: models.ReadmissionPrediction) -> models.ReadmissionPrediction:
+        self.save_measurements_with_predictions([], [prediction])
+        return prediction
+
+    def save_measurements_with_predictions(self,
+                                           measurements: List[models.Measurement],
+                                           predictions: List[models.ReadmissionPrediction]) -> None:
+        for kind, items, id_attribute in (("ts", measurements, "id"), ("pred", predictions, "internal_id")):
+            by_patient = OrderedDict()
+            for item in items:
+                if item.time_created is None:
+                    item.time_created = datetime.datetime.utcnow()
+                by_patient.setdefault(item.patient_id, []).append(item)
+            for patient_id, patient_items in by_patient.items():
+                records = new_records((i.time_created, i.value, TYPE_CODES[i.type]) if kind == "ts" else
+                                      (i.time_created, i.probability, 0) for i in patient_items)
+                first = self.get_series(kind, patient_id, create=True).append(records, self.fsync)
+                for position, item in enumerate(patient_items, start=first + 1):
+                    setattr(item, id_attribute, position)
+
+    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100,
+                             before: Tuple[datetime.datetime, int] = None) -> List[models.Measurement]:
+        series = self.get_series("ts", patient_id)
+        if series is None:
+            return []
+        (records, positions) = series.ordered()
+        if measurement_type:
+            keep = records["type"] == TYPE_CODES[measurement_type]
+            (records, positions) = (records[keep], positions[keep])
+        (records, positions) = page(records, positions, offset, limit, before)
+        return self.to_measurements(patient_id, records, positions)
+
+    @staticmethod
+    def to_measurements(patient_id: int, records: np.ndarray, positions: np.ndarray) -> List[models.Measurement]:
+        return [models.Measurement(id=position + 1, patient_id=patient_id, type=TYPES[code], value=value,
+                                   time_created=from_micros(t))
+                for position, t, value, code in zip(positions.tolist(), records["time"].tolist(),
+                                                    records["value"].tolist(), records["type"].tolist())]
+
+    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100,
+                            before: Tuple[datetime.datetime, int] = None) -> List[models.ReadmissionPrediction]:
+        series = self.get_series("pred", patient_id)
+        if series is None:
+            return []
+        (records, positions) = page(*series.ordered(), offset, limit, before)
+        return [models.ReadmissionPrediction(internal_id=position + 1, patient_id=patient_id, probability=value,
+                                             time_created=from_micros(t))
+                for position, t, value in zip(positions.tolist(), records["time"].tolist(),
+                                              records["value"].tolist())]
+
+    def get_current_risk(self, patient_ids: Iterable[int]) -> List[models.CurrentRisk]:
+        risks = []
+        for patient_id in patient_ids:
+            series = self.get_series("pred", patient_id)
+            if series is not None and 0 in series.latest:
+                record = series.records[series.latest[0]]
+                risks.append(models.CurrentRisk(patient_id=patient_id, probability=float(record["value"]),
+                                                time_created=from_micros(int(record["time"]))))
+        return risks
+
+    def count_measurements(self, patient_id: int, measurement_type: str) -> int:
+        series = self.get_series("ts", patient_id)
+        return int(series.counts[TYPE_CODES[measurement_type]]) if series else 0
+
+    def count_predictions(self, patient_id: int) -> int:
+        series = self.get_series("pred", patient_id)
+        return len(series) if series else 0
+
+    def get_last_measurement(self, patient_id: int, measurement_type: str) -> models.Measurement:
+        series = self.get_series("ts", patient_id)
+        if series is None:
+            return None
+        if measurement_type:
+            position = series.latest.get(TYPE_CODES[measurement_type])
+        else:
+            position = max(series.latest.values(), key=lambda p: (series.records["time"][p], p), default=None)
+        if position is None:
+            return None
+        return self.to_measurements(patient_id, series.records[position:position + 1], np.array([position]))[0]
+
+    def get_measurement_aggregates(self, patient_ids: Iterable[int], before_id: int = None) -> Dict[
+        int, MeasurementAggregates]:
+        aggregates = {}
+        for patient_id in patient_ids:
+            series = self.get_series("ts", patient_id)
+            if series is None or not len(series):
+                continue
+            records = series.records if before_id is None else series.records[:max(before_id - 1, 0)]
+            a = aggregates[patient_id] = MeasurementAggregates(patient_id)
+            for code in np.unique(records["type"]).tolist():
+                values = records["value"][records["type"] == code]
+                a.add(TYPES[code], len(values), float(values.sum()), float(np.dot(values, values)))
+            bp = np.flatnonzero(records["type"] == TYPE_CODES[MeasurementType.BLOOD_PRESSURE.value])
+            if len(bp):
+                times = records["time"][bp]
+                position = int(bp[len(bp) - 1 - np.argmax(times[::-1])])
+                a.last_blood_pressure = self.to_measurements(patient_id, records[position:position + 1],
+                                                             np.array([position]))[0]
+        return aggregates
+
+    def get_hourly_measurements(self, patient_id: int, measurement_type: str, since: datetime.datetime = None,
+                                until: datetime.datetime = None) -> List[models.MeasurementRollup]:
+        series = self.get_series("ts", patient_id)
+        if series is None:
+            return []
+        (records, positions) = series.ordered()
+        keep = records["type"] == TYPE_CODES[measurement_type]
+        if since:
+            keep &= records["time"] >= to_micros(since)
+        if until:
+            keep &= records["time"] < to_micros(until)
+        return hourly_from_rows([], self.to_measurements(patient_id, records[keep], positions[keep]))
+
+    def get_patient_ids_with_measurements(self, since: datetime.datetime = None) -> List[int]:
+        patient_ids = []
+        if not os.path.isdir(self.directory):
+            return patient_ids
+        for shard in os.listdir(self.directory):
+            for name in os.listdir(os.path.join(self.directory, shard)):
+                if name.endswith(".ts"):
+                    patient_ids.append(int(name[:-len(".ts")]))
+        if since:
+            patient_ids = [patient_id for patient_id in patient_ids if self.last_time(patient_id) >= to_micros(since)]
+        return sorted(patient_ids)
+
+    def last_time(self, patient_id: int) -> int:
+        series = self.get_series("ts", patient_id)
+        return max((int(series.records["time"][p]) for p in series.latest.values()), default=-1)
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+        self.series.clear()
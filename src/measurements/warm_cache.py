@@ -0,0 +1,67 @@
+"""
+Rebuilds the fast model cache from the measurements table, e.g. after a Redis flush or restart,
+so the first measurements of every patient don't have to restore their state one by one.
+The readmission ranking is rebuilt too, see src.measurements.ranking.
+
+    python -m src.measurements.warm_cache --since-hours 48
+
+States that are already in the cache are not overwritten.
+"""
+import argparse
+import datetime
+import logging
+import time
+
+import redis
+from sqlalchemy.orm import Session
+
+from src.config.cache import get_connection_pool
+from src.config.database import SessionLocal
+from src.measurements.cache import FastReadmissionRedisCache
+from src.measurements.prediction_model_fast import FastReadmissionCache
+from src.measurements.prediction_model_resilient import state_from_aggregates
+from src.measurements.ranking import ReadmissionRanking, rebuild_ranking
+from src.measurements.repository import MeasurementSQLiteRepository
+
+logger = logging.getLogger(__name__)
+
+
+def warm_cache(db: Session, cache: FastReadmissionCache, since: datetime.datetime = None,
+               batch_size: int = 500) -> int:
+    """
+    Restores the state of every patient with measurements(since the given time, if any) and returns
+    the amount of patients. Every batch of patients is one aggregate query and one cache pipeline.
+    """
+    repo = MeasurementSQLiteRepository(db)
+    patient_ids = repo.get_patient_ids_with_measurements(since=since)
+    for i in range(0, len(patient_ids), batch_size):
+        aggregates = repo.get_measurement_aggregates(patient_ids[i:i + batch_size])
+        cache.seed_states({patient_id: state_from_aggregates(a) for patient_id, a in aggregates.items()})
+        logger.info("Warmed up %d of %d patients", min(i + batch_size, len(patient_ids)), len(patient_ids))
+    return len(patient_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--since-hours", type=float, default=None,
+                        help="Only patients with measurements in the last hours, all patients by default")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    since = None
+    if args.since_hours is not None:
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=args.since_hours)
+    cache = FastReadmissionRedisCache(redis_client=redis.Redis(connection_pool=get_connection_pool()))
+    db = SessionLocal()
+    start = time.monotonic()
+    try:
+        patients = warm_cache(db, cache, since=since, batch_size=args.batch_size)
+        ranked = rebuild_ranking(db, ReadmissionRanking(redis.Redis(connection_pool=get_connection_pool())))
+    finally:
+        db.close()
+    print(f"warmed up {patients} patients and ranked {ranked} in {time.monotonic() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
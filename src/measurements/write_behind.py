@@ -0,0 +1,229 @@
+"""
+Write-behind mode of the measurement endpoints(MEASUREMENT_WRITE_BEHIND=true).
+
+A request calculates the prediction, appends the measurement and the prediction to a durable local spool
+and is answered with 202. A background flusher moves the spool to the database in large transactions
+and retries with backoff while the database is failing.
+
+If a worker dies after a batch is committed to the database but before it's removed from the spool, the batch
+is delivered again on restart. The database keeps the last written item of every spool(SpoolCheckpoint), updated
+in the transaction of the batch, so the items that were already written are skipped then.
+"""
+import datetime
+import fcntl
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Tuple, Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy.orm import Session
+
+from src import models
+from src.measurements.repository import MeasurementSQLiteRepository
+from src.patient.versions import PatientVersionRedisStore
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DEPTH = Gauge("measurement_spool_depth", "Measurements waiting in the write-behind spool")
+SPOOL_FLUSH_SECONDS = Histogram("measurement_spool_flush_seconds",
+                                "Time to write a batch of the write-behind spool to the database")
+SPOOL_FLUSHED = Counter("measurement_spool_flushed_total", "Measurements written from the spool to the database")
+SPOOL_FLUSH_FAILURES = Counter("measurement_spool_flush_failures_total", "Failed flushes of the spool")
+
+
+class MeasurementSpool:
+    """
+    FIFO of measurements with their predictions in a local SQLite file. An append is synced to disk
+    before it returns, so accepted measurements survive a crash of the worker.
+    Workers of one host can share the file, only one thread of one of them flushes at a time.
+    The file has a random id, which identifies the spool in SpoolCheckpoint.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('spool_id', ?)", (uuid.uuid4().hex,))
+        self.spool_id = self.conn.execute("SELECT value FROM meta WHERE key = 'spool_id'").fetchone()[0]
+        self.lock = threading.Lock()
+        # flock excludes other processes, the lock other threads of this one
+        self.flush_lock_file = open(path + ".lock", "a")
+        self.flush_thread_lock = threading.Lock()
+        SPOOL_DEPTH.set(self.depth())
+
+    def append(self, items: List[Tuple[models.Measurement, models.ReadmissionPrediction]]):
+        rows = [(json.dumps(self.to_payload(m, p)),) for m, p in items]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("INSERT INTO spool (payload) VALUES (?)", rows)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        SPOOL_DEPTH.inc(len(rows))
+
+    def peek(self, limit: int) -> List[Tuple[int, models.Measurement, models.ReadmissionPrediction]]:
+        """
+        Returns the oldest items with their spool ids, without removing them
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT id, payload FROM spool ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(spool_id, *self.from_payload(json.loads(payload))) for spool_id, payload in rows]
+
+    def ack(self, last_id: int):
+        """
+        Removes the items up to last_id, after they are written to the database
+        """
+        with self.lock:
+            deleted = self.conn.execute("DELETE FROM spool WHERE id <= ?", (last_id,)).rowcount
+        SPOOL_DEPTH.dec(deleted)
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def try_lock_flush(self) -> bool:
+        if not self.flush_thread_lock.acquire(blocking=False):
+            return False
+        try:
+            fcntl.flock(self.flush_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self.flush_thread_lock.release()
+            return False
+
+    def unlock_flush(self):
+        fcntl.flock(self.flush_lock_file, fcntl.LOCK_UN)
+        self.flush_thread_lock.release()
+
+    def close(self):
+        self.conn.close()
+        self.flush_lock_file.close()
+
+    @staticmethod
+    def to_payload(m: models.Measurement, p: models.ReadmissionPrediction) -> dict:
+        return {
+            "patient_id": m.patient_id,
+            "type": m.type,
+            "value": m.value,
+            "time_created": m.time_created.isoformat(),
+            "probability": p.probability,
+        }
+
+    @staticmethod
+    def from_payload(payload: dict) -> (models.Measurement, models.ReadmissionPrediction):
+        time_created = datetime.datetime.fromisoformat(payload["time_created"])
+        return (
+            models.Measurement(patient_id=payload["patient_id"], type=payload["type"], value=payload["value"],
+                               time_created=time_created),
+            models.ReadmissionPrediction(patient_id=payload["patient_id"], time_created=time_created,
+                                         probability=payload["probability"]),
+        )
+
+
+class WriteBehindFlusher:
+    """
+    Background thread that drains the spool to the database in batches of `batch_size`.
+    A batch is removed from the spool only after its transaction is committed.
+    """
+
+    def __init__(self, spool: MeasurementSpool, session_factory: Callable[[], Session], batch_size: int = 1000,
+                 interval: float = 0.2, max_backoff: float = 30.0, versions: PatientVersionRedisStore = None):
+        self.spool = spool
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.versions = versions
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def flush_once(self) -> int:
+        """
+        Writes the next batch, returns its size. Database errors are raised, the batch stays in the spool.
+        """
+        batch = self.spool.peek(self.batch_size)
+        if not batch:
+            return 0
+        start = time.perf_counter()
+        db = self.session_factory()
+        try:
+            checkpoint = db.get(models.SpoolCheckpoint, self.spool.spool_id)
+            if checkpoint is None:
+                checkpoint = models.SpoolCheckpoint(spool_id=self.spool.spool_id, last_item_id=0)
+                db.add(checkpoint)
+            new = [(m, p) for spool_id, m, p in batch if spool_id > checkpoint.last_item_id]
+            if new:
+                # Committed together with the batch
+                checkpoint.last_item_id = batch[-1][0]
+                MeasurementSQLiteRepository(db).save_measurements_with_predictions([m for m, _ in new],
+                                                                                   [p for _, p in new])
+            else:
+                logger.warning("Items up to %d of the spool are already written, skipping them", batch[-1][0])
+        finally:
+            db.close()
+        self.spool.ack(batch[-1][0])
+        if self.versions:
+            # The measurements become visible to reads only now
+            self.versions.bump(m.patient_id for _, m, _ in batch)
+        SPOOL_FLUSH_SECONDS.observe(time.perf_counter() - start)
+        SPOOL_FLUSHED.inc(len(batch))
+        return len(batch)
+
+    def flush(self) -> int:
+        """
+        Writes batches until the spool is empty, returns the amount of written items
+        """
+        if not self.spool.try_lock_flush():
+            return 0
+        try:
+            flushed = 0
+            while True:
+                n = self.flush_once()
+                flushed += n
+                if n < self.batch_size:
+                    return flushed
+        finally:
+            self.spool.unlock_flush()
+
+    def run(self):
+        backoff = self.interval
+        while not self.stopped.is_set():
+            try:
+                self.flush()
+                backoff = self.interval
+            except Exception:
+                SPOOL_FLUSH_FAILURES.inc()
+                logger.exception("Flush of the measurement spool failed, retrying in %.1fs", backoff)
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="measurement-spool-flusher", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Stops the thread and tries to write what's left. Whatever fails stays in the spool for the next start.
+        """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                # Its flush holds the lock, so the one below writes nothing twice
+                logger.warning("The flusher didn't stop in %.0fs", timeout)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Final flush of the measurement spool failed, %d items are kept", self.spool.depth())
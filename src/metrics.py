@@ -0,0 +1,100 @@
+"""
+Prometheus metrics of the ingestion hot path, exposed on /metrics next to the per-route ones of PrometheusMiddleware.
+
+* measurement_ingestion_stage_seconds{stage, model}: stages of saving a measurement. `model` is v0(slow),
+  v1(fast) or v2(async fast). Stages are patient_lookup, measurement_save, aggregates_query(v0), cache_update
+  and state_restore(v1, v2, the restore is a part of the update), probability, prediction_save or spool_append,
+  and post_write(patient versions and the ranking).
+* repository_operation_seconds{repository, operation}: every call of the instrumented repository methods.
+* fast_cache_lookups_total{model, result}: `hit` if the cache had the patient's state, `miss` if it was restored
+  from the database, `error` if the cache was down.
+* fast_cache_lru_lookups_total{result}: hits and misses of the in-process LRU in front of Redis.
+
+Stages and repository calls(as `db`) are also added to the Server-Timing header of the request, see src.diagnostics.
+"""
+import functools
+import inspect
+import time
+
+from prometheus_client import Counter, Histogram
+
+from src.diagnostics import record
+
+# Most stages take well under a millisecond, the default buckets start at 5ms
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+
+STAGE_SECONDS = Histogram("measurement_ingestion_stage_seconds", "Time of a stage of saving a measurement",
+                          ["stage", "model"], buckets=BUCKETS)
+REPOSITORY_SECONDS = Histogram("repository_operation_seconds", "Time of a repository call",
+                               ["repository", "operation"], buckets=BUCKETS)
+FAST_CACHE_LOOKUPS = Counter("fast_cache_lookups_total", "Lookups of patient states in the fast model cache",
+                             ["model", "result"])
+FAST_CACHE_LRU_LOOKUPS = Counter("fast_cache_lru_lookups_total", "Lookups of the in-process LRU of patient states",
+                                 ["result"])
+
+
+_stage_histograms = {}
+
+
+class _StageTimer:
+    __slots__ = ("histogram", "name", "start")
+
+    def __init__(self, histogram, name: str):
+        self.histogram = histogram
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        self.histogram.observe(duration)
+        record(self.name, duration)
+
+
+def stage(name: str, model: str):
+    """
+    with stage("patient_lookup", "v1"): ...
+    """
+    # labels() takes a lock on every call, children are looked up once
+    histogram = _stage_histograms.get((name, model))
+    if histogram is None:
+        histogram = _stage_histograms[(name, model)] = STAGE_SECONDS.labels(name, model)
+    return _StageTimer(histogram, name)
+
+
+def timed_operation(repository: str):
+    """
+    Decorator of repository methods, sync or async, the operation is the name of the method
+    """
+    def decorator(method):
+        histogram = None
+
+        def observe(start: float):
+            nonlocal histogram
+            if histogram is None:
+                histogram = REPOSITORY_SECONDS.labels(repository, method.__name__)
+            duration = time.perf_counter() - start
+            histogram.observe(duration)
+            record("db", duration)
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    observe(start)
+            return timed_async
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                observe(start)
+        return timed
+
+    return decorator
@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, DateTime, func, Float, String
+import math
+
+from sqlalchemy import Column, Integer, DateTime, func, Float, String, Index, PrimaryKeyConstraint
 
 from src.config.database import Base
 
@@ -10,6 +12,11 @@ class Patient(Base):
     id = Column(Integer, nullable=False)
     age = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        # Every measurement write looks the patient up by the hospital ID
+        Index("ix_patients_id", "id", unique=True),
+    )
+
     def __repr__(self):
         return f"Patient(internal_id={self.internal_id}, id={self.id}, age={self.age})"
 
@@ -22,6 +29,10 @@ class Admission(Base):
     date_admission = Column(DateTime, nullable=False)
     date_discharge = Column(DateTime, nullable=True)
 
+    __table_args__ = (
+        Index("ix_admissions_patient_id", "patient_id"),
+    )
+
 
 class ReadmissionPrediction(Base):
     __tablename__ = "readmission_predictions"
@@ -31,6 +42,23 @@ class ReadmissionPrediction(Base):
     time_created = Column(DateTime(timezone=True), nullable=False)
     probability = Column(Float, nullable=False)
 
+    __table_args__ = (
+        # The ID breaks ties of time_created for keyset pagination
+        Index("ix_readmission_predictions_patient_id_time_created", "patient_id", "time_created", "internal_id"),
+    )
+
+
+class CurrentRisk(Base):
+    """
+    The latest prediction of every patient, upserted together with the history row,
+    so the current risk is a primary key lookup instead of a sort of the history.
+    """
+    __tablename__ = "current_risk"
+
+    patient_id = Column(Integer, primary_key=True)
+    time_created = Column(DateTime(timezone=True), nullable=False)
+    probability = Column(Float, nullable=False)
+
 
 class Measurement(Base):
     __tablename__ = "measurements"
@@ -40,3 +68,67 @@ class Measurement(Base):
     time_created = Column(DateTime(timezone=True), server_default=func.now())
     type = Column(String, nullable=False)
     value = Column(Float, nullable=False)
+
+    __table_args__ = (
+        # Reads filter by patient(and type) and order by time_created desc, the ID breaks ties for keyset pagination
+        Index("ix_measurements_patient_id_type_time_created", "patient_id", "type", "time_created", "id"),
+        Index("ix_measurements_patient_id_time_created", "patient_id", "time_created", "id"),
+    )
+
+
+class MeasurementRollup(Base):
+    """
+    Measurements of a patient of one type in one hour, compacted from raw rows older than the retention age.
+    `m2` is the sum of squared deviations from the mean(M2 of Welford's algorithm),
+    `last_value` and `last_time_created` are of the latest measurement in the hour.
+    """
+    __tablename__ = "measurement_rollups"
+
+    patient_id = Column(Integer, nullable=False)
+    type = Column(String, nullable=False)
+    hour = Column(DateTime(timezone=True), nullable=False)
+    count = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    min = Column(Float, nullable=False)
+    max = Column(Float, nullable=False)
+    m2 = Column(Float, nullable=False)
+    last_value = Column(Float, nullable=False)
+    last_time_created = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("patient_id", "type", "hour"),
+    )
+
+    @property
+    def standard_deviation(self) -> float:
+        return math.sqrt(self.m2 / self.count) if self.count > 1 else 0.0
+
+
+class PatientCounter(Base):
+    """
+    Running counts of a patient's rows, so totals of paginated endpoints don't need COUNT(*).
+    `name` is a measurement type or PREDICTIONS_COUNTER.
+    """
+    __tablename__ = "patient_counters"
+
+    patient_id = Column(Integer, nullable=False)
+    name = Column(String, nullable=False)
+    value = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("patient_id", "name"),
+    )
+
+
+class SpoolCheckpoint(Base):
+    """
+    The last item of a write-behind spool(src.measurements.write_behind) that is written to the database.
+    It's updated in the transaction of every batch, so items delivered again after a crash are skipped.
+    """
+    __tablename__ = "spool_checkpoints"
+
+    spool_id = Column(String, primary_key=True)
+    last_item_id = Column(Integer, nullable=False)
+
+
+PREDICTIONS_COUNTER = "readmission_predictions"
@@ -1,9 +1,12 @@
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import List, Iterable
 
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from src import models
+from src.metrics import timed_operation
 from src.models import Admission
 
 
@@ -13,6 +16,10 @@ class PatientRepository(metaclass=ABCMeta):
     def get_by_id(self, patient_id: int) -> models.Patient or None:
         pass
 
+    @abstractmethod
+    def get_by_ids(self, patient_ids: Iterable[int]) -> List[models.Patient]:
+        pass
+
     @abstractmethod
     def get_all(self, offset: int = 0, limit: int = 100) -> List[models.Patient]:
         pass
@@ -33,18 +40,33 @@ class PatientRepository(metaclass=ABCMeta):
     def get_all_admissions(self, patient_id: int, offset: int = 0, limit: int = 100):
         pass
 
+    @abstractmethod
+    def get_last_admission(self, patient_id: int) -> models.Admission or None:
+        pass
+
 
 class PatientSQLiteRepository(PatientRepository):
 
     def __init__(self, db_session):
         self.db: Session = db_session
 
+    @timed_operation("patient")
     def get_by_id(self, patient_id: int) -> models.Patient or None:
         return self.db.query(models.Patient).filter(models.Patient.id == patient_id).first()
 
+    @timed_operation("patient")
+    def get_by_ids(self, patient_ids: Iterable[int]) -> List[models.Patient]:
+        # SQLite limits the number of bound parameters, so large batches are resolved in chunks
+        ids = list(set(patient_ids))
+        patients = []
+        for i in range(0, len(ids), 500):
+            patients += self.db.query(models.Patient).filter(models.Patient.id.in_(ids[i:i + 500])).all()
+        return patients
+
     def get_all(self, offset: int = 0, limit: int = 100) -> List[models.Patient]:
         return self.db.query(models.Patient).filter(models.Patient.id is not None).offset(offset).limit(limit).all()
 
+    @timed_operation("patient")
     def save(self, patient: models.Patient) -> models.Patient or None:
         self.db.add(patient)
         self.db.commit()
@@ -55,13 +77,39 @@ class PatientSQLiteRepository(PatientRepository):
         self.db.delete(patient)
         self.db.commit()
 
+    @timed_operation("patient")
     def save_admission(self, admission: models.Admission) -> models.Admission:
         self.db.add(admission)
         self.db.commit()
         self.db.refresh(admission)
         return admission
 
+    @timed_operation("patient")
     def get_all_admissions(self, patient_id: int, offset: int = 0, limit: int = 100):
         return self.db.query(models.Admission) \
             .filter(models.Admission.patient_id == patient_id) \
             .offset(offset).limit(limit).all()
+
+    @timed_operation("patient")
+    def get_last_admission(self, patient_id: int) -> models.Admission or None:
+        return self.db.query(models.Admission) \
+            .filter(models.Admission.patient_id == patient_id) \
+            .order_by(models.Admission.date_admission.desc(), models.Admission.internal_id.desc()).first()
+
+
+class AsyncPatientRepository(metaclass=ABCMeta):
+
+    @abstractmethod
+    async def get_by_id(self, patient_id: int) -> models.Patient or None:
+        pass
+
+
+class PatientAsyncSQLiteRepository(AsyncPatientRepository):
+
+    def __init__(self, db_session):
+        self.db: AsyncSession = db_session
+
+    @timed_operation("patient_async")
+    async def get_by_id(self, patient_id: int) -> models.Patient or None:
+        result = await self.db.execute(select(models.Patient).where(models.Patient.id == patient_id).limit(1))
+        return result.scalars().first()
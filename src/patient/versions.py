@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+import uuid
+from collections import namedtuple
+from typing import Dict, Iterable, List
+
+import redis
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+# `token` changes on every write of the patient, `modified` is the UTC timestamp of the write
+PatientVersion = namedtuple("PatientVersion", ["token", "modified"])
+
+EPOCH_KEY = "patients:version-epoch"
+# Seconds a version lives, which is how long responses can be stale if a bump is lost
+VERSION_TTL = int(os.getenv("HTTP_VERSION_TTL", 600))
+
+
+def new_version_value() -> str:
+    # Random tokens instead of a counter: a counter that starts over after a Redis flush would repeat old ETags
+    return f"{uuid.uuid4().hex}:{time.time():.6f}"
+
+
+def parse_version(value: bytes) -> PatientVersion:
+    (token, modified) = value.decode().split(":")
+    return PatientVersion(token, float(modified))
+
+
+class PatientVersionRedisStore:
+    """
+    Version of every patient's data for conditional GETs, in the key patient:{id}:version.
+    Writers bump the patients they changed after the commit, readers compare the version with the client's ETag
+    without touching the database.
+
+    Offline jobs that change many patients(bulk import, retention) bump the epoch instead, which is part of
+    every version. Keys expire after `ttl` seconds, which bounds how long a version can be stale
+    if a bump was lost because Redis was unavailable.
+    """
+
+    def __init__(self, redis_client: redis.Redis, ttl: int = VERSION_TTL):
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(patient_id: int) -> str:
+        return f"patient:{patient_id}:version"
+
+    def get_versions(self, patient_ids: List[int]) -> Dict[int, PatientVersion]:
+        """
+        Versions of the patients, created for those that have none. Raises redis.RedisError.
+        """
+        keys = [EPOCH_KEY] + [self.key(patient_id) for patient_id in patient_ids]
+        values = self.redis_client.mget(keys)
+        if None in values:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for key, value in zip(keys, values):
+                    if value is None:
+                        pipe.set(key, new_version_value(), nx=True, ex=self.ttl)
+                pipe.mget(keys)
+                values = pipe.execute()[-1]
+        return self.versions(patient_ids, values)
+
+    @staticmethod
+    def versions(patient_ids: List[int], values: List[bytes]) -> Dict[int, PatientVersion]:
+        epoch = parse_version(values[0])
+        versions = {}
+        for patient_id, value in zip(patient_ids, values[1:]):
+            version = parse_version(value)
+            versions[patient_id] = PatientVersion(f"{epoch.token}.{version.token}",
+                                                  max(epoch.modified, version.modified))
+        return versions
+
+    def bump(self, patient_ids: Iterable[int]):
+        """
+        Called after the changes of the patients are committed. Failures are logged, not raised,
+        the write itself has succeeded.
+        """
+        try:
+            with self.redis_client.pipeline(transaction=False) as pipe:
+                for patient_id in set(patient_ids):
+                    pipe.set(self.key(patient_id), new_version_value(), ex=self.ttl)
+                pipe.execute()
+        except redis.RedisError:
+            logger.warning("Patient versions were not bumped, conditional GETs may be stale for up to %ds",
+                           self.ttl, exc_info=True)
+
+    def bump_all(self):
+        try:
+            self.redis_client.set(EPOCH_KEY, new_version_value(), ex=self.ttl)
+        except redis.RedisError:
+            logger.warning("The patient version epoch was not bumped, conditional GETs may be stale for up to %ds",
+                           self.ttl, exc_info=True)
+
+
+class AsyncPatientVersionRedisStore:
+    """
+    PatientVersionRedisStore.bump for the async ingestion path
+    """
+
+    def __init__(self, redis_client: redis.asyncio.Redis, ttl: int = VERSION_TTL):
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    async def bump(self, patient_ids: Iterable[int]):
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for patient_id in set(patient_ids):
+                    pipe.set(PatientVersionRedisStore.key(patient_id), new_version_value(), ex=self.ttl)
+                await pipe.execute()
+        except redis.RedisError:
+            logger.warning("Patient versions were not bumped, conditional GETs may be stale for up to %ds",
+                           self.ttl, exc_info=True)
@@ -4,13 +4,18 @@ from typing import List
 from src import models, schemas
 from src.patient.exceptions import PatientAlreadyExistsException, PatientNotFoundException
 from src.patient.repository import PatientRepository
+from src.measurements.ranking import ReadmissionRanking
+from src.patient.versions import PatientVersionRedisStore
 from src.schemas import PatientOut
 
 
 class PatientService:
 
-    def __init__(self, patient_repo: PatientRepository):
+    def __init__(self, patient_repo: PatientRepository, versions: PatientVersionRedisStore = None,
+                 ranking: ReadmissionRanking = None):
         self.patient_repo = patient_repo
+        self.versions = versions
+        self.ranking = ranking
 
     def get_patient(self, patient_id: int) -> PatientOut or None:
         patient = self.patient_repo.get_by_id(patient_id=patient_id)
@@ -32,6 +37,8 @@ class PatientService:
             pass
         patient = models.Patient(**patient.dict())
         patient = self.patient_repo.save(patient=patient)
+        if self.versions:
+            self.versions.bump([patient.id])
         return PatientOut.from_orm(patient)
 
     def save_admission(self, patient_id: int, admission: schemas.AdmissionIn) -> schemas.AdmissionOut:
@@ -52,6 +59,15 @@ class PatientService:
             adm_db.date_discharge = datetime.strptime(admission.date_discharge, '%d/%m/%Y').date()
 
         adm = self.patient_repo.save_admission(admission=adm_db)
+        if self.versions:
+            self.versions.bump([patient_id])
+        if self.ranking:
+            # Only the last admission tells if the patient is in the hospital now
+            last = self.patient_repo.get_last_admission(patient_id=patient_id)
+            if last.date_discharge:
+                self.ranking.discharge([patient_id])
+            else:
+                self.ranking.admit([patient_id])
         return schemas.AdmissionOut.from_orm(adm)
 
     def get_admissions(self, patient_id: int, offset: int = 0, limit: int = 100) -> List[schemas.AdmissionOut]:
@@ -1,6 +1,6 @@
 import datetime
 from enum import Enum
-from typing import Union
+from typing import Union, List
 
 from pydantic import BaseModel, Field
 
@@ -49,6 +49,11 @@ class MeasurementType(str, Enum):
     HEART_RATE: str = "heart_rate"
 
 
+class ExportFormat(str, Enum):
+    NDJSON: str = "ndjson"
+    CSV: str = "csv"
+
+
 class MeasurementIn(BaseModel):
     patient_id: int = Field(gte=0, description="The ID of the patient in the hospital", example=42)
     day: str = Field(description="The date of the measurement", example="2021-01-01")
@@ -58,11 +63,60 @@ class MeasurementIn(BaseModel):
 
 
 class MeasurementOut(BaseModel):
-    id: int = Field(description="The ID of the measurement", example=12)
+    id: Union[int, None] = Field(description="The ID of the measurement, null for a rollup", example=12)
     patient_id: int = Field(description="The ID of the patient in the hospital", example=42)
-    time_created: datetime.datetime = Field(description="The timestamp of the measurement", example="2021-01-01T00:00:00Z")
+    time_created: datetime.datetime = Field(description="The timestamp of the measurement, the start of the hour "
+                                                        "for a rollup", example="2021-01-01T00:00:00Z")
     type: MeasurementType = Field(description="The parameter of the measurement", example="blood_pressure")
-    value: float = Field(description="Measurement value", example=120.0)
+    value: float = Field(description="Measurement value, the mean for a rollup", example=120.0)
+    count: int = Field(1, description="Amount of measurements in the item", example=1)
+    rollup: bool = Field(False, description="The item is an hourly rollup of measurements compacted by retention",
+                         example=False)
+
+    class Config:
+        orm_mode = True
+
+
+class MeasurementHourlyOut(BaseModel):
+    hour: datetime.datetime = Field(description="Start of the hour", example="2021-01-01T07:00:00Z")
+    type: MeasurementType = Field(description="The parameter of the measurements", example="temperature")
+    count: int = Field(description="Amount of measurements in the hour", example=60)
+    mean: float = Field(description="Mean value", example=36.9)
+    min: float = Field(description="Minimum value", example=36.5)
+    max: float = Field(description="Maximum value", example=37.4)
+    standard_deviation: float = Field(description="Population standard deviation of the values", example=0.2)
+    last_value: float = Field(description="Value of the latest measurement in the hour", example=37.1)
+
+    class Config:
+        orm_mode = True
+
+
+class MeasurementBatchItemStatus(str, Enum):
+    CREATED: str = "created"
+    PATIENT_NOT_FOUND: str = "patient_not_found"
+    INVALID: str = "invalid"
+
+
+class MeasurementBatchItemOut(BaseModel):
+    index: int = Field(description="Position of the measurement in the batch", example=0)
+    status: MeasurementBatchItemStatus = Field(description="Outcome for this measurement", example="created")
+    patient_id: Union[int, None] = Field(description="The ID of the patient in the hospital", example=42)
+    probability: Union[float, None] = Field(description="The probability of readmission", example=0.44)
+    detail: Union[str, None] = Field(description="Why the measurement was rejected", example=None)
+
+
+class MeasurementBatchOut(BaseModel):
+    created: int = Field(description="Amount of saved measurements", example=1)
+    failed: int = Field(description="Amount of rejected measurements", example=0)
+    items: List[MeasurementBatchItemOut]
+
+
+class ProfileOut(BaseModel):
+    id: int = Field(description="The ID of the profile", example=1)
+    time_created: datetime.datetime = Field(description="When the request finished", example="2021-01-01T00:00:00Z")
+    method: str = Field(description="HTTP method of the request", example="POST")
+    path: str = Field(description="Path of the request", example="/v1/measurements")
+    duration_ms: float = Field(description="Duration of the request in milliseconds", example=153.2)
 
     class Config:
         orm_mode = True
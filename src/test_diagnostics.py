@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src import models, schemas
+from src.diagnostics import ProfileStore, ServerTimingMiddleware
+from src.measurement_service import MeasurementService
+from src.measurements.prediction_model_resilient import ResilientReadmissionPredictionModel
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+from src.metrics import timed_operation
+from src.test_measurement_service import MockMeasurementRepository
+from src.test_patient_service import MockPatientRepository
+
+
+def new_client(profiles: ProfileStore) -> TestClient:
+    patients = MockPatientRepository()
+    patients.save(models.Patient(id=1, age=60))
+    repo = MockMeasurementRepository()
+    svc = MeasurementService(patient_repo=patients, measurement_repo=repo,
+                             prediction_model=ResilientReadmissionPredictionModel(DummyFastReadmissionCache(), repo))
+
+    @timed_operation("test")
+    def query():
+        return 1
+
+    app = FastAPI()
+    app.add_middleware(ServerTimingMiddleware, profiles=profiles, allow_header=True, slow_seconds=0)
+
+    @app.post("/measurements")
+    def save_measurement(m: schemas.MeasurementIn):
+        query()
+        svc.save_measurement(m)
+        return {}
+
+    return TestClient(app)
+
+
+MEASUREMENT = {"patient_id": 1, "day": "2021-01-01", "hour": 1, "parameter": "temperature", "value": 36.6}
+
+
+def test_server_timing_has_stages_of_the_request():
+    client = new_client(ProfileStore())
+    response = client.post("/measurements", json=MEASUREMENT)
+
+    entries = dict(e.split(";dur=") for e in response.headers["Server-Timing"].split(", "))
+    assert {"db", "patient_lookup", "cache_update", "probability", "total"} <= set(entries)
+    assert all(float(d) >= 0 for d in entries.values())
+    assert float(entries["total"]) >= float(entries["cache_update"])
+
+
+def test_profile_is_kept_only_for_requests_that_ask_for_it():
+    profiles = ProfileStore(size=1)
+    client = new_client(profiles)
+
+    client.post("/measurements", json=MEASUREMENT)
+    assert profiles.list() == []
+
+    for _ in range(2):
+        client.post("/measurements", json=MEASUREMENT, headers={"X-Profile": "1"})
+    [profile] = profiles.list()
+    assert (profile.id, profile.method, profile.path) == (2, "POST", "/measurements")
+    assert "save_measurement" in profile.text()
+
+
+def test_profile_text_renders_a_copy_of_the_stats():
+    profiles = ProfileStore()
+    client = new_client(profiles)
+    client.post("/measurements", json=MEASUREMENT, headers={"X-Profile": "1"})
+    [profile] = profiles.list()
+    stream = profile.stats.stream
+    expected = {sort: profile.text(sort) for sort in ("cumulative", "tottime")}
+
+    with ThreadPoolExecutor(4) as pool:
+        texts = list(pool.map(lambda i: (i % 2, profile.text(("cumulative", "tottime")[i % 2])), range(40)))
+    assert all(text == expected[("cumulative", "tottime")[i]] for i, text in texts)
+    assert profile.stats.stream is stream
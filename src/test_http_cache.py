@@ -0,0 +1,84 @@
+import email.utils
+import time
+
+import pytest
+from starlette.requests import Request
+
+from src.http_cache import ConditionalGet, ResponseCache
+from src.patient.versions import PatientVersionRedisStore, EPOCH_KEY
+from src.schemas import PatientOut
+
+
+@pytest.fixture
+def versions():
+    fakeredis = pytest.importorskip("fakeredis")
+    return PatientVersionRedisStore(fakeredis.FakeRedis())
+
+
+def new_request(headers: dict = None, query: str = "") -> Request:
+    return Request({
+        "type": "http", "method": "GET", "path": "/v1/patients/7", "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    })
+
+
+def respond(versions, reads: list, headers: dict = None, response_cache: ResponseCache = None, query: str = ""):
+    def read():
+        reads.append(1)
+        return PatientOut(id=7, age=50)
+
+    return ConditionalGet(new_request(headers, query), [7], versions, response_cache).respond(read, PatientOut)
+
+
+def test_not_modified_until_the_patient_is_bumped(versions):
+    reads = []
+    response = respond(versions, reads)
+    etag = response.headers["etag"]
+    assert (response.status_code, response.body) == (200, b'{"id":7,"age":50}')
+
+    assert respond(versions, reads, {"If-None-Match": etag}).status_code == 304
+    assert respond(versions, reads, {"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    assert len(reads) == 1
+    # Another URL of the same patient is another representation
+    assert respond(versions, reads, {"If-None-Match": etag}, query="limit=1").status_code == 200
+
+    versions.bump([8])
+    assert respond(versions, reads, {"If-None-Match": etag}).status_code == 304
+    versions.bump([7])
+    assert respond(versions, reads, {"If-None-Match": etag}).status_code == 200
+    etag = respond(versions, reads).headers["etag"]
+    versions.bump_all()
+    assert respond(versions, reads, {"If-None-Match": etag}).status_code == 200
+
+
+def test_last_modified_is_sent_once_the_second_of_the_write_is_over(versions):
+    versions.bump([7])
+    assert "last-modified" not in respond(versions, []).headers
+
+    modified = time.time() - 10
+    for key in (versions.key(7), EPOCH_KEY):
+        versions.redis_client.set(key, f"token:{modified}")
+    last_modified = respond(versions, []).headers["last-modified"]
+    assert last_modified == email.utils.formatdate(modified, usegmt=True)
+    assert respond(versions, [], {"If-Modified-Since": last_modified}).status_code == 304
+    earlier = email.utils.formatdate(modified - 1, usegmt=True)
+    assert respond(versions, [], {"If-Modified-Since": earlier}).status_code == 200
+    # If-None-Match wins over If-Modified-Since
+    assert respond(versions, [], {"If-Modified-Since": last_modified, "If-None-Match": '"x"'}).status_code == 200
+
+
+def test_response_cache_serves_the_body_of_the_current_version(versions):
+    reads = []
+    cache = ResponseCache(max_size=10)
+    first = respond(versions, reads, response_cache=cache)
+    second = respond(versions, reads, response_cache=cache)
+    assert (second.body, second.headers["etag"]) == (first.body, first.headers["etag"])
+    assert len(reads) == 1
+
+    versions.bump([7])
+    respond(versions, reads, response_cache=cache)
+    assert len(reads) == 2
+
+
+def test_without_versions_the_data_is_returned_as_is():
+    assert ConditionalGet(new_request(), [7]).respond(lambda: "data", PatientOut) == "data"
@@ -0,0 +1,68 @@
+import fakeredis
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.config.cache import get_cache
+from src.config.database import Base, get_db
+from src.main import app
+
+HISTORY_PATHS = ["/v1/patients/1/measurements/temperature", "/v1/patients/1/readmission-probability"]
+
+
+@pytest.fixture
+def client():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_test_db():
+        db = factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    cache = fakeredis.FakeRedis()
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[get_cache] = lambda: cache
+    client = TestClient(app)
+    client.post("/v1/patients", json={"id": 1, "age": 60})
+    for hour in range(5):
+        response = client.post("/v1/measurements", json={"patient_id": 1, "day": "2021-01-01", "hour": hour,
+                                                         "parameter": "temperature", "value": 36 + hour / 10})
+        assert response.status_code == 201
+    yield client
+    app.dependency_overrides.clear()
+
+
+def pages(client: TestClient, path: str, limit: int) -> list:
+    result = [client.get(path, params={"limit": limit}).json()]
+    while result[-1]["next_cursor"]:
+        result.append(client.get(path, params={"limit": limit, "cursor": result[-1]["next_cursor"]}).json())
+    return result
+
+
+@pytest.mark.parametrize("path", HISTORY_PATHS)
+def test_limit_zero_returns_only_the_total(client, path):
+    response = client.get(path, params={"limit": 0})
+    assert response.status_code == 200
+    assert (response.json()["total"], response.json()["items"], response.json()["next_cursor"]) == (5, [], None)
+
+
+@pytest.mark.parametrize("path", HISTORY_PATHS)
+@pytest.mark.parametrize("limit", [1, 2, 5])
+def test_cursor_pages_cover_the_history_and_the_last_page_has_no_cursor(client, path, limit):
+    result = pages(client, path, limit)
+    everything = client.get(path, params={"limit": 100}).json()["items"]
+
+    assert [len(page["items"]) for page in result] == [limit] * (5 // limit) + ([5 % limit] if 5 % limit else [])
+    assert [item for page in result for item in page["items"]] == everything
+    assert result[-1]["next_cursor"] is None
+
+
+@pytest.mark.parametrize("path", HISTORY_PATHS)
+def test_negative_limit_is_rejected(client, path):
+    assert client.get(path, params={"limit": -1}).status_code == 422
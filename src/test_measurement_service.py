@@ -0,0 +1,170 @@
+import datetime
+from typing import List, Iterable, Dict, Tuple
+from unittest import TestCase
+
+import src.models as models
+import src.schemas as schemas
+from src.measurement_service import MeasurementService
+from src.measurements.prediction_model_fast import FastReadmissionPredictionModel
+from src.measurements.prediction_model_resilient import ResilientReadmissionPredictionModel
+from src.measurements.repository import MeasurementRepository, MeasurementAggregates, hourly_from_rows, \
+    current_risk_rows
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+from src.test_patient_service import MockPatientRepository
+
+
+class MockMeasurementRepository(MeasurementRepository):
+
+    def __init__(self):
+        self.measurements = []
+        self.predictions = []
+        self.transactions = 0
+
+    def save_measurement(self, measurement: models.Measurement) -> models.Measurement:
+        self.transactions += 1
+        measurement.id = len(self.measurements) + 1
+        self.measurements.append(measurement)
+        return measurement
+
+    def save_prediction(self, prediction: models.ReadmissionPrediction) -> models.ReadmissionPrediction:
+        self.transactions += 1
+        self.predictions.append(prediction)
+        return prediction
+
+    def save_measurements_with_predictions(self,
+                                           measurements: List[models.Measurement],
+                                           predictions: List[models.ReadmissionPrediction]) -> None:
+        self.transactions += 1
+        self.measurements += measurements
+        self.predictions += predictions
+
+    def get_all_measurements(self, patient_id: int, measurement_type: str, offset: int = 0, limit: int = 100,
+                             before: Tuple[datetime.datetime, int] = None) -> List[models.Measurement]:
+        ms = [m for m in self.measurements if m.patient_id == patient_id and m.type == measurement_type]
+        ms.sort(key=lambda m: (m.time_created, m.id or 0), reverse=True)
+        if before:
+            return [m for m in ms if (m.time_created, m.id or 0) < before][:limit]
+        return ms[offset:offset + limit]
+
+    def get_all_predictions(self, patient_id: int, offset: int = 0, limit: int = 100,
+                            before: Tuple[datetime.datetime, int] = None) -> List[models.ReadmissionPrediction]:
+        ps = [p for p in self.predictions if p.patient_id == patient_id]
+        ps.sort(key=lambda p: (p.time_created, p.internal_id or 0), reverse=True)
+        if before:
+            return [p for p in ps if (p.time_created, p.internal_id or 0) < before][:limit]
+        return ps[offset:offset + limit]
+
+    def count_measurements(self, patient_id: int, measurement_type: str) -> int:
+        return sum(1 for m in self.measurements if m.patient_id == patient_id and m.type == measurement_type)
+
+    def get_current_risk(self, patient_ids: Iterable[int]) -> List[models.CurrentRisk]:
+        patient_ids = set(patient_ids)
+        return [models.CurrentRisk(**row) for row in
+                current_risk_rows(p for p in self.predictions if p.patient_id in patient_ids)]
+
+    def count_predictions(self, patient_id: int) -> int:
+        return sum(1 for p in self.predictions if p.patient_id == patient_id)
+
+    def get_last_measurement(self, patient_id: int, measurement_type: str) -> models.Measurement:
+        ms = self.get_all_measurements(patient_id, measurement_type, 0, len(self.measurements))
+        return ms[0] if ms else None
+
+    def get_measurement_aggregates(self, patient_ids: Iterable[int], before_id: int = None) -> Dict[
+        int, MeasurementAggregates]:
+        patient_ids = set(patient_ids)
+        aggregates = {}
+        for m in self.measurements:
+            if m.patient_id not in patient_ids or (before_id is not None and m.id >= before_id):
+                continue
+            a = aggregates.setdefault(m.patient_id, MeasurementAggregates(m.patient_id))
+            a.add(m.type, 1, m.value, m.value * m.value)
+            if m.type == "blood_pressure":
+                a.last_blood_pressure = m
+        return aggregates
+
+    def get_hourly_measurements(self, patient_id: int, measurement_type: str, since: datetime.datetime = None,
+                                until: datetime.datetime = None) -> List[models.MeasurementRollup]:
+        return hourly_from_rows([], sorted((m for m in self.measurements if m.patient_id == patient_id and
+                                            m.type == measurement_type and (not since or m.time_created >= since) and
+                                            (not until or m.time_created < until)), key=lambda m: m.time_created))
+
+    def get_patient_ids_with_measurements(self, since: datetime.datetime = None) -> List[int]:
+        return sorted({m.patient_id for m in self.measurements if not since or m.time_created >= since})
+
+
+class FailingMeasurementRepository(MockMeasurementRepository):
+
+    def save_measurements_with_predictions(self,
+                                           measurements: List[models.Measurement],
+                                           predictions: List[models.ReadmissionPrediction]) -> None:
+        raise RuntimeError("database is down")
+
+
+def new_service(patient_repo: MockPatientRepository, measurement_repo: MockMeasurementRepository):
+    return MeasurementService(
+        patient_repo=patient_repo,
+        measurement_repo=measurement_repo,
+        prediction_model=FastReadmissionPredictionModel(cache=DummyFastReadmissionCache()),
+    )
+
+
+class TestMeasurementService(TestCase):
+
+    def setUp(self):
+        self.patient_repo = MockPatientRepository()
+        self.patient_repo.save(models.Patient(id=1, age=50))
+        self.patient_repo.save(models.Patient(id=2, age=70))
+        self.batch = [
+            schemas.MeasurementIn(patient_id=1, day="2021-01-01", hour=1, parameter="respiration_rate", value=10),
+            schemas.MeasurementIn(patient_id=3, day="2021-01-01", hour=1, parameter="temperature", value=36.6),
+            schemas.MeasurementIn(patient_id=2, day="2021-01-01", hour=1, parameter="blood_pressure", value=120),
+            schemas.MeasurementIn(patient_id=1, day="2021-01-01", hour=2, parameter="respiration_rate", value=20),
+        ]
+
+    def test_save_measurements_batch(self):
+        measurement_repo = MockMeasurementRepository()
+        results = new_service(self.patient_repo, measurement_repo).save_measurements(self.batch)
+
+        self.assertEqual([r.index for r in results], [0, 1, 2, 3])
+        self.assertEqual([r.status for r in results], [
+            schemas.MeasurementBatchItemStatus.CREATED,
+            schemas.MeasurementBatchItemStatus.PATIENT_NOT_FOUND,
+            schemas.MeasurementBatchItemStatus.CREATED,
+            schemas.MeasurementBatchItemStatus.CREATED,
+        ])
+        self.assertEqual(results[1].detail, "Patient 3 is not found")
+        # Everything is saved at once
+        self.assertEqual(measurement_repo.transactions, 1)
+        self.assertEqual(len(measurement_repo.measurements), 3)
+        self.assertEqual(len(measurement_repo.predictions), 3)
+
+    def test_save_measurements_batch_matches_single_saves(self):
+        batch_repo = MockMeasurementRepository()
+        batch_results = new_service(self.patient_repo, batch_repo).save_measurements(self.batch)
+
+        single_repo = MockMeasurementRepository()
+        single_svc = new_service(self.patient_repo, single_repo)
+        for m in self.batch:
+            if m.patient_id != 3:
+                single_svc.save_measurement(m)
+
+        self.assertEqual([r.probability for r in batch_results if r.probability is not None],
+                         [p.probability for p in single_repo.predictions])
+
+    def test_failed_batch_save_forgets_the_cached_states(self):
+        cache = DummyFastReadmissionCache()
+        measurement_repo = MockMeasurementRepository()
+        measurement_repo.save_measurement(models.Measurement(patient_id=1, type="respiration_rate", value=30,
+                                                             time_created=datetime.datetime(2020, 12, 31)))
+        failing = MeasurementService(self.patient_repo, FailingMeasurementRepository(),
+                                     ResilientReadmissionPredictionModel(cache, measurement_repo))
+        with self.assertRaises(RuntimeError):
+            failing.save_measurements(self.batch)
+
+        # Nothing of the failed batch is left in the cache, the state is restored from the saved measurement
+        self.assertTrue(cache.get_state(1).is_empty())
+        self.assertTrue(cache.get_state(2).is_empty())
+        svc = MeasurementService(self.patient_repo, measurement_repo,
+                                 ResilientReadmissionPredictionModel(cache, measurement_repo))
+        svc.save_measurement(self.batch[3])
+        self.assertEqual(cache.get_mean_respiratory_rate(1), (25.0, 2))
@@ -0,0 +1,61 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+
+from src import models, schemas
+from src.measurement_service import MeasurementService
+from src.measurements.prediction_model_resilient import ResilientReadmissionPredictionModel
+from src.measurements.test_prediction_model import DummyFastReadmissionCache
+from src.metrics import timed_operation
+from src.test_measurement_service import MockMeasurementRepository
+from src.test_patient_service import MockPatientRepository
+
+STAGES = ["patient_lookup", "measurement_save", "cache_update", "state_restore", "probability", "prediction_save",
+          "post_write"]
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def stage_counts(model: str) -> dict:
+    return {s: sample("measurement_ingestion_stage_seconds_count", stage=s, model=model) for s in STAGES}
+
+
+def test_stages_and_cache_lookups_of_the_fast_model():
+    patients = MockPatientRepository()
+    patients.save(models.Patient(id=1, age=60))
+    repo = MockMeasurementRepository()
+    svc = MeasurementService(patient_repo=patients, measurement_repo=repo,
+                             prediction_model=ResilientReadmissionPredictionModel(DummyFastReadmissionCache(), repo))
+    before = stage_counts("v1")
+    (hits, misses) = (sample("fast_cache_lookups_total", model="v1", result=r) for r in ("hit", "miss"))
+
+    for value in (36.6, 37.2):
+        svc.save_measurement(schemas.MeasurementIn(patient_id=1, day="2021-01-01", hour=1, parameter="temperature",
+                                                   value=value))
+
+    after = stage_counts("v1")
+    assert {s: after[s] - before[s] for s in STAGES} == {
+        "patient_lookup": 2, "measurement_save": 2, "cache_update": 2, "state_restore": 1, "probability": 2,
+        "prediction_save": 2, "post_write": 2}
+    # The first measurement of the patient restores the state, the second one finds it
+    assert sample("fast_cache_lookups_total", model="v1", result="miss") - misses == 1
+    assert sample("fast_cache_lookups_total", model="v1", result="hit") - hits == 1
+
+
+def test_timed_operation_of_sync_and_async_methods():
+    class Repository:
+        @timed_operation("test")
+        def get(self, x):
+            return x
+
+        @timed_operation("test")
+        async def get_async(self, x):
+            return x
+
+    repo = Repository()
+    assert repo.get(1) == 1
+    assert asyncio.run(repo.get_async(2)) == 2
+    assert sample("repository_operation_seconds_count", repository="test", operation="get") == 1
+    assert sample("repository_operation_seconds_count", repository="test", operation="get_async") == 1
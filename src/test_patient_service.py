@@ -20,6 +20,10 @@ class MockPatientRepository(PatientRepository):
     def get_by_id(self, patient_id: int) -> models.Patient or None:
         return next((patient for patient in self.patients if patient.id == patient_id), None)
 
+    def get_by_ids(self, patient_ids) -> List[models.Patient]:
+        ids = set(patient_ids)
+        return [patient for patient in self.patients if patient.id in ids]
+
     def get_all(self, offset: int = 0, limit: int = 100) -> List[models.Patient]:
         return self.patients[offset:offset + limit]
 
@@ -42,6 +46,10 @@ class MockPatientRepository(PatientRepository):
     def get_all_admissions(self, patient_id: int, offset: int = 0, limit: int = 100):
         return self.admissions[offset:offset + limit]
 
+    def get_last_admission(self, patient_id: int) -> models.Admission or None:
+        admissions = [a for a in self.admissions if a.patient_id == patient_id]
+        return max(admissions, key=lambda a: (a.date_admission, a.internal_id), default=None)
+
 
 class TestPatientService(TestCase):
 